@@ -0,0 +1,231 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import sys
+import time
+
+import websockets
+
+from bidi_client import BiDiClient, BiDiError
+
+# Latency and throughput benchmark of the BiDi server.
+#
+# Runs each scenario at each concurrency level against an already running
+# server and writes the results as JSON. When a baseline produced by an earlier
+# run is given, results are compared against it and the script exits with
+# status 1 if any scenario regressed by more than the tolerance.
+#
+#   python3 bidiClient/benchmark.py --output results.json
+#   python3 bidiClient/benchmark.py --baseline results.json
+
+# Page loaded in every context before measuring. Holds a node with attributes
+# and children for the node serialization scenario.
+BENCHMARK_PAGE = "data:text/html," + "<div id='target'{}>{}</div>".format(
+    "".join(f" attr_{i}='value_{i}'" for i in range(10)),
+    "".join(f"<span>{i}</span>" for i in range(50)))
+
+# Scenario name -> (method, params factory). The factory gets the context
+# dedicated to the worker running the command.
+SCENARIOS = {
+    "session.status": (
+        "session.status",
+        lambda context: {}),
+    "browsingContext.getTree": (
+        "browsingContext.getTree",
+        lambda context: {}),
+    "PROTO.page.evaluate": (
+        "PROTO.page.evaluate",
+        lambda context: {
+            "function": "({a: 1, b: 'str', c: [1, 2, 3]})",
+            "context": context}),
+    "nodeSerialization": (
+        "PROTO.page.evaluate",
+        lambda context: {
+            "function": "document.getElementById('target')",
+            "context": context}),
+    "navigation": (
+        "PROTO.browsingContext.navigate",
+        lambda context: {
+            "url": BENCHMARK_PAGE,
+            "context": context}),
+}
+
+# Nearest-rank percentile of sorted `values`.
+def percentile(values, p):
+    if not values:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(values)))
+    return values[rank - 1]
+
+def summarize(scenario, concurrency, latencies, errors, duration):
+    latencies = sorted(latencies)
+    ms = lambda seconds: None if seconds is None else round(seconds * 1000, 3)
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "iterations": len(latencies),
+        "errors": errors,
+        "duration": round(duration, 3),
+        "commandsPerSecond": round(len(latencies) / duration, 2) if duration else None,
+        "latencyMs": {
+            "p50": ms(percentile(latencies, 50)),
+            "p95": ms(percentile(latencies, 95)),
+            "p99": ms(percentile(latencies, 99)),
+            "mean": ms(sum(latencies) / len(latencies)) if latencies else None,
+            "max": ms(latencies[-1]) if latencies else None,
+        },
+    }
+
+# Runs `count` commands of the scenario, `concurrency` of them in flight at a
+# time: each worker sends its next command as soon as the previous one is
+# answered, using its own context from `contexts`. Returns the latencies of the
+# successful commands and the number of errors.
+async def run_commands(client, scenario, concurrency, count, contexts):
+    method, make_params = SCENARIOS[scenario]
+    latencies = []
+    errors = 0
+    remaining = count
+
+    async def worker(context):
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            try:
+                await client.execute(method, make_params(context))
+            except BiDiError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*[worker(contexts[i]) for i in range(concurrency)])
+    return latencies, errors
+
+async def run_scenario(client, scenario, concurrency, iterations, contexts, warmup=0):
+    if warmup:
+        await run_commands(client, scenario, concurrency, warmup, contexts)
+    start = time.perf_counter()
+    latencies, errors = await run_commands(
+        client, scenario, concurrency, iterations, contexts)
+    return summarize(scenario, concurrency, latencies, errors,
+        time.perf_counter() - start)
+
+async def open_contexts(client, count):
+    contexts = await asyncio.gather(*[
+        client.execute("PROTO.browsingContext.createContext", {
+            "url": BENCHMARK_PAGE})
+        for _ in range(count)])
+    return [context["context"] for context in contexts]
+
+async def close_contexts(client, contexts):
+    await asyncio.gather(*[
+        client.send_and_wait("DEBUG.Page.close", {"context": context})
+        for context in contexts])
+
+async def run_benchmark(url, scenarios, concurrency_levels, iterations, warmup):
+    results = []
+    async with websockets.connect(url) as connection:
+        async with BiDiClient(connection) as client:
+            contexts = await open_contexts(client, max(concurrency_levels))
+            try:
+                for scenario in scenarios:
+                    for concurrency in concurrency_levels:
+                        result = await run_scenario(client, scenario, concurrency,
+                            iterations, contexts, warmup)
+                        print_result(result)
+                        results.append(result)
+            finally:
+                await close_contexts(client, contexts)
+    return {
+        "server": url,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "iterations": iterations,
+        "results": results,
+    }
+
+# Compares `results` against `baseline` (both as written by `run_benchmark`).
+# A scenario regressed when its p95 latency grew, or its throughput dropped, by
+# more than `tolerance` (a fraction). Returns the list of regression messages.
+def compare_with_baseline(results, baseline, tolerance):
+    baseline_by_key = {(r["scenario"], r["concurrency"]): r
+        for r in baseline["results"]}
+    regressions = []
+    for result in results["results"]:
+        key = (result["scenario"], result["concurrency"])
+        base = baseline_by_key.get(key)
+        if base is None:
+            continue
+        name = f"{key[0]} @ concurrency {key[1]}"
+
+        p95, base_p95 = result["latencyMs"]["p95"], base["latencyMs"]["p95"]
+        if p95 is not None and base_p95 and p95 > base_p95 * (1 + tolerance):
+            regressions.append(
+                f"{name}: p95 latency {p95} ms, baseline {base_p95} ms")
+
+        cps, base_cps = result["commandsPerSecond"], base["commandsPerSecond"]
+        if cps is not None and base_cps and cps < base_cps * (1 - tolerance):
+            regressions.append(
+                f"{name}: {cps} commands/sec, baseline {base_cps} commands/sec")
+
+        if result["errors"] > base["errors"]:
+            regressions.append(
+                f"{name}: {result['errors']} errors, baseline {base['errors']}")
+    return regressions
+
+def print_result(result):
+    latency = result["latencyMs"]
+    print(f"{result['scenario']:<26} c={result['concurrency']:<3} "
+        f"{str(result['commandsPerSecond']):>9} cmd/s  "
+        f"p50={latency['p50']}ms p95={latency['p95']}ms p99={latency['p99']}ms "
+        f"errors={result['errors']}")
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the BiDi server.")
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", 8080)))
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+        help="comma separated scenarios, out of: " + ", ".join(SCENARIOS))
+    parser.add_argument("--concurrency", default="1,4,16",
+        help="comma separated numbers of commands in flight")
+    parser.add_argument("--iterations", type=int, default=200,
+        help="measured commands per scenario and concurrency level")
+    parser.add_argument("--warmup", type=int, default=20,
+        help="unmeasured commands run before each measurement")
+    parser.add_argument("--output", help="file to write the JSON results to")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+        help="allowed regression against the baseline, as a fraction")
+    args = parser.parse_args(argv)
+
+    args.scenarios = args.scenarios.split(",")
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error(f"unknown scenario {scenario}")
+    args.concurrency = [int(c) for c in args.concurrency.split(",")]
+    if any(c < 1 for c in args.concurrency):
+        parser.error("concurrency should be positive")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    url = f"ws://localhost:{args.port}"
+    results = asyncio.get_event_loop().run_until_complete(run_benchmark(
+        url, args.scenarios, args.concurrency, args.iterations, args.warmup))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
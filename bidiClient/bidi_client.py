@@ -0,0 +1,341 @@
+import asyncio
+import itertools
+import json
+import struct
+
+# Header of the binary frames holding chunks of a command result: command id,
+# chunk index and flags. See `OutboundWriter.sendChunks` in the server.
+CHUNK_HEADER = struct.Struct('>QIB')
+LAST_CHUNK_FLAG = 1
+
+# Raised by `BiDiClient.execute` when the server answers a command with an
+# error response.
+class BiDiError(Exception):
+    def __init__(self, response):
+        super().__init__(f"{response.get('error')}: {response.get('message')}")
+        self.response = response
+        self.error = response.get('error')
+        self.message = response.get('message')
+
+# Raised by `check_budget` when a traced command cost more than allowed.
+class BudgetExceeded(AssertionError):
+    def __init__(self, method, trace, exceeded):
+        super().__init__(f"{method or 'command'} exceeded its budget: " +
+            ", ".join(f"{name} {trace[name]} > {limit}"
+                for name, limit in exceeded.items()))
+        self.method = method
+        self.trace = trace
+        self.exceeded = exceeded
+
+# Checks the `PROTO.trace` of a response against `limits`, keyed by trace
+# field, e.g. `check_budget(trace, cdpCalls=4, cdpBytesReceived=2000)`. Raises
+# `BudgetExceeded` listing every exceeded limit.
+def check_budget(trace, method=None, **limits):
+    exceeded = {name: limit for name, limit in limits.items()
+        if trace[name] > limit}
+    if exceeded:
+        raise BudgetExceeded(method, trace, exceeded)
+
+# Refers to the result of an earlier step of a batch, see `BiDiClient.batch`.
+# `ref(0, "objectId")` is the `objectId` of the first step's result.
+def ref(step, *path):
+    return {"PROTO.ref": ".".join(str(key) for key in (step, *path))}
+
+# Returns the browsing context an event relates to, or None for global events.
+def get_event_context(event):
+    params = event.get('params')
+    if not isinstance(params, dict):
+        return None
+    # TODO: replace `PROTO.context` with `realm`.
+    return params.get('context', params.get('PROTO.context'))
+
+# Events delivered to one subscriber. The queue is bounded: when the consumer
+# falls behind, the oldest queued event is dropped and counted in `dropped`.
+class EventSubscription:
+    def __init__(self, router, key, maxsize):
+        self._router = router
+        self.key = key
+        self.queue = asyncio.Queue(maxsize)
+        self.dropped = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.get()
+
+    async def get(self, timeout=None):
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+    def close(self):
+        self._router._remove(self)
+
+    def _put(self, event):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(event)
+
+# Routes events to subscribers indexed by (method, context). `None` in either
+# position of the key is a wildcard, so dispatching an event costs 4 dict
+# lookups regardless of the number of subscribers, and events nobody
+# subscribed to are dropped right away.
+class EventRouter:
+    def __init__(self):
+        self._subscriptions = {}
+
+    # Subscribes to events with the given `method` in the given `context`.
+    # Omitted `method` or `context` match any value.
+    def subscribe(self, method=None, context=None, maxsize=100):
+        key = (method, context)
+        subscription = EventSubscription(self, key, maxsize)
+        self._subscriptions.setdefault(key, set()).add(subscription)
+        return subscription
+
+    # Waits for the first event matching `method`, `context` and the optional
+    # `predicate`. Raises `asyncio.TimeoutError` after `timeout` seconds.
+    async def wait_for(self, method=None, context=None, predicate=None, timeout=None):
+        subscription = self.subscribe(method, context)
+        try:
+            return await asyncio.wait_for(
+                self._first_match(subscription, predicate), timeout)
+        finally:
+            subscription.close()
+
+    def dispatch(self, event):
+        method = event.get('method')
+        context = get_event_context(event)
+        for key in {(method, context), (method, None), (None, context), (None, None)}:
+            for subscription in self._subscriptions.get(key, ()):
+                subscription._put(event)
+
+    async def _first_match(self, subscription, predicate):
+        while True:
+            event = await subscription.get()
+            if predicate is None or predicate(event):
+                return event
+
+    def _remove(self, subscription):
+        subscriptions = self._subscriptions.get(subscription.key)
+        if subscriptions is None:
+            return
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            del self._subscriptions[subscription.key]
+
+# Frames of a screencast, started on entering the context manager and stopped
+# on exit. Iterating yields the `PROTO.browsingContext.screencastFrame` event
+# params, with the image base64-encoded in `data`. At most `maxsize` frames are
+# buffered: when the consumer falls behind, the oldest frames are dropped.
+class Screencast:
+    def __init__(self, client, context, params, maxsize):
+        self._client = client
+        self._context = context
+        self._params = params
+        self._maxsize = maxsize
+        self._subscription = None
+        # Frames sent and dropped by the server, set by `stop`.
+        self.stats = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return (await self._subscription.get())["params"]
+
+    # Frames dropped by the client.
+    @property
+    def dropped(self):
+        return self._subscription.dropped if self._subscription else 0
+
+    async def start(self):
+        self._subscription = self._client.subscribe(
+            "PROTO.browsingContext.screencastFrame", self._context, self._maxsize)
+        await self._client.execute("PROTO.browsingContext.startScreencast",
+            {**self._params, "context": self._context})
+
+    async def stop(self):
+        if self._subscription is None or self.stats is not None:
+            return self.stats
+        self._subscription.close()
+        self.stats = await self._client.execute(
+            "PROTO.browsingContext.stopScreencast", {"context": self._context})
+        return self.stats
+
+# Pipelined BiDi client. A background reader task routes every response to the
+# `asyncio.Future` registered for its id, so any number of commands can be
+# in flight on one connection at the same time. Messages without a known id
+# (events and error responses for undecodable commands) are routed through
+# `events`, see `EventRouter`.
+#
+# Binary frames hold chunks of a command result, e.g. of `DEBUG.Page.screenshot`
+# with `encoding: "binary"`. They are written to the `sink` given for the
+# command as they arrive, without base64 decoding.
+class BiDiClient:
+    def __init__(self, websocket):
+        self._websocket = websocket
+        self._ids = itertools.count(1)
+        self._pending = {}
+        # Command id -> object with a `write` method, like `io.BytesIO` or a
+        # file opened in binary mode.
+        self._sinks = {}
+        self.events = EventRouter()
+        self._reader = None
+        self.dropped_chunks = 0
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    def start(self):
+        if self._reader is None:
+            self._reader = asyncio.ensure_future(self._read_loop())
+
+    async def stop(self):
+        if self._reader is None:
+            return
+        self._reader.cancel()
+        try:
+            await self._reader
+        except asyncio.CancelledError:
+            pass
+        self._reader = None
+        self._fail_pending(ConnectionError('client stopped'))
+
+    # Sends the command and returns a future resolved with the raw response
+    # (either `{"id", "result"}` or `{"id", "error", "message"}`). Does not wait
+    # for the response, so callers can pipeline several commands and await
+    # them later, e.g. with `asyncio.gather`. Binary chunks of the result are
+    # written to `sink`.
+    async def send_command(self, method, params=None, sink=None):
+        command_id = next(self._ids)
+        future = asyncio.get_event_loop().create_future()
+        self._pending[command_id] = future
+        if sink is not None:
+            self._sinks[command_id] = sink
+        try:
+            await self._websocket.send(json.dumps({
+                "id": command_id,
+                "method": method,
+                "params": params if params is not None else {}}))
+        except Exception:
+            del self._pending[command_id]
+            self._sinks.pop(command_id, None)
+            raise
+        return future
+
+    # Sends the command and waits for its response.
+    async def send_and_wait(self, method, params=None, sink=None):
+        return await (await self.send_command(method, params, sink))
+
+    # Sends the command and returns its `result`. Raises `BiDiError` if the
+    # server answered with an error.
+    async def execute(self, method, params=None, sink=None):
+        response = await self.send_and_wait(method, params, sink)
+        if 'error' in response:
+            raise BiDiError(response)
+        return response['result']
+
+    # Runs `(method, params)` steps in order in one round trip and returns
+    # their results. Steps can use the results of earlier ones with `ref`, and
+    # get `context` by default. Raises `BiDiError` for the first failing step,
+    # after which no step runs.
+    async def batch(self, steps, context=None):
+        params = {"commands": [{"method": method, "params": step_params}
+            for method, step_params in steps]}
+        if context is not None:
+            params["context"] = context
+        return (await self.execute("PROTO.session.batch", params))["results"]
+
+    # Makes the server attach a `PROTO.trace` with the CDP cost of each
+    # command to its response.
+    async def set_tracing(self, enabled=True):
+        await self.execute("PROTO.session.setTracing", {"enabled": enabled})
+
+    # Like `execute`, but returns the result along with the trace of the
+    # command, checked against `budget` (see `check_budget`). Requires tracing
+    # to be enabled with `set_tracing`.
+    async def execute_traced(self, method, params=None, **budget):
+        response = await self.send_and_wait(method, params)
+        if 'error' in response:
+            raise BiDiError(response)
+        if 'PROTO.trace' not in response:
+            raise ValueError("tracing is disabled, see `set_tracing`")
+        trace = response['PROTO.trace']
+        check_budget(trace, method, **budget)
+        return response['result'], trace
+
+    def subscribe(self, method=None, context=None, maxsize=100):
+        return self.events.subscribe(method, context, maxsize)
+
+    async def wait_for_event(self, method=None, context=None, predicate=None, timeout=None):
+        return await self.events.wait_for(method, context, predicate, timeout)
+
+    # Returns a `Screencast` of the context. `params` are the options of
+    # `PROTO.browsingContext.startScreencast`, like `maxFps` or `quality`.
+    #
+    #     async with client.screencast(context, maxFps=5) as frames:
+    #         async for frame in frames:
+    #             ...
+    def screencast(self, context, maxsize=2, **params):
+        return Screencast(self, context, params, maxsize)
+
+    @property
+    def pending_count(self):
+        return len(self._pending)
+
+    async def _read_loop(self):
+        try:
+            async for data in self._websocket:
+                if isinstance(data, bytes):
+                    self._write_chunk(data)
+                    continue
+                message = json.loads(data)
+                # Events batched by `PROTO.session.setEventBatching` come as
+                # an array in one frame.
+                if isinstance(message, list):
+                    for event in message:
+                        self._dispatch(event)
+                else:
+                    self._dispatch(message)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._fail_pending(e)
+            return
+        self._fail_pending(ConnectionError('connection closed'))
+
+    def _write_chunk(self, frame):
+        command_id, index, flags = CHUNK_HEADER.unpack_from(frame)
+        sink = self._sinks.get(command_id)
+        if sink is None:
+            self.dropped_chunks += 1
+            return
+        sink.write(memoryview(frame)[CHUNK_HEADER.size:])
+        if flags & LAST_CHUNK_FLAG:
+            del self._sinks[command_id]
+
+    def _dispatch(self, message):
+        self._sinks.pop(message.get('id'), None)
+        future = self._pending.pop(message.get('id'), None)
+        if future is None:
+            self.events.dispatch(message)
+        elif not future.done():
+            future.set_result(message)
+
+    def _fail_pending(self, error):
+        self._sinks = {}
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
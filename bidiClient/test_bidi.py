@@ -1,15 +1,120 @@
 import asyncio
+import base64
+import contextlib
+import io
 import json
 import os
 import pytest
+import signal
+import socket
+import subprocess
+import time
+import urllib.error
+import urllib.request
 import websockets
 
+from benchmark import compare_with_baseline, open_contexts, run_scenario
+from bidi_client import BiDiClient, BiDiError, BudgetExceeded, ref
+
+# Event modules the server can emit.
+ALL_EVENTS = ["browsingContext", "log", "DEBUG.Page"]
+
+# With `REUSE_CONNECTION=1`, each worker opens one connection, and so gets one
+# browser, for all the tests. The session is reset between tests instead, see
+# `reset_session`.
+REUSE_CONNECTION = os.getenv('REUSE_CONNECTION') == '1'
+
+# With `START_SERVER=1`, each worker starts its own server instead of connecting
+# to an already running one.
+START_SERVER = os.getenv('START_SERVER') == '1'
+
+# Runs all the tests in one event loop, so a connection can outlive a test.
+@pytest.fixture(scope="session")
+def event_loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+# Port of the server used by this worker. pytest-xdist workers `gw<N>` use
+# `PORT + N`, so parallel workers don't share a server.
+@pytest.fixture(scope="session")
+def server_port():
+    worker = os.getenv('PYTEST_XDIST_WORKER', 'gw0')
+    port = int(os.getenv('PORT', 8080)) + int(worker[2:])
+    if not START_SERVER:
+        yield port
+        return
+
+    with start_server(port):
+        yield port
+
+# Runs a server on `port` with extra environment variables `env`, or a
+# cluster of servers with `script='cluster.js'`.
+@contextlib.contextmanager
+def start_server(port, script='server.js', **env):
+    server_path = os.path.join(
+        os.path.dirname(__file__), '..', 'bidiServer', script)
+    server = subprocess.Popen(['node', server_path],
+        env={**os.environ, **env, 'PORT': str(port)},
+        stdout=subprocess.DEVNULL)
+    try:
+        wait_for_port(port, timeout=30)
+        yield
+    finally:
+        server.terminate()
+        server.wait()
+
+def wait_for_port(port, timeout):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('localhost', port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+# Connection shared by the tests of a worker when `REUSE_CONNECTION` is set.
+@pytest.fixture(scope="session")
+async def shared_connection(server_port):
+    holder = {"connection": None}
+    yield holder
+    if holder["connection"] is not None:
+        await holder["connection"].close()
+
 @pytest.fixture
-async def websocket():
-    port = os.getenv('PORT', 8080)
-    url = f'ws://localhost:{port}'
-    async with websockets.connect(url) as connection:
-        yield connection
+async def unsubscribed_websocket(server_port, shared_connection):
+    url = f'ws://localhost:{server_port}'
+    if not REUSE_CONNECTION:
+        async with websockets.connect(url) as connection:
+            yield connection
+        return
+
+    connection = shared_connection["connection"]
+    if connection is None or not connection.open:
+        connection = await websockets.connect(url)
+        shared_connection["connection"] = connection
+    yield connection
+    try:
+        await asyncio.wait_for(reset_session(connection), 30)
+    except Exception:
+        # The next test gets a new connection.
+        shared_connection["connection"] = None
+        await connection.close()
+
+# Connection subscribed to all the events globally.
+@pytest.fixture
+async def websocket(unsubscribed_websocket):
+    await subscribe(unsubscribed_websocket, ALL_EVENTS)
+    yield unsubscribed_websocket
+
+# Pipelined client on top of the `websocket` fixture. Tests using it must not
+# read from `websocket` directly, as the client's reader task owns it.
+@pytest.fixture
+async def bidi_client(websocket):
+    async with BiDiClient(websocket) as client:
+        yield client
 
 # Compares 2 objects recursively ignoring values of specific attributes.
 def recursiveCompare(expected, actual, ignoreAttributes):
@@ -42,6 +147,60 @@ async def get_open_context_id(websocket):
     contextID = context['context']
     return contextID
 
+async def subscribe(websocket, events, contexts=None):
+    command = {"id": 9996, "method": "session.subscribe", "params": {
+        "events": events}}
+    if contexts is not None:
+        command["params"]["contexts"] = contexts
+    await send_JSON_command(websocket, command)
+    resp = await read_JSON_message(websocket)
+    assert resp == {"id": 9996, "result": {}}
+
+# Sends the command and returns its response, skipping any other message
+# received in the meantime.
+async def execute_ignoring_other_messages(websocket, command):
+    await send_JSON_command(websocket, command)
+    while True:
+        resp = await read_JSON_message(websocket)
+        if isinstance(resp, dict) and resp.get("id") == command["id"]:
+            return resp
+
+# Brings a reused connection back to the state of a new session: no event
+# subscriptions or batching, and a single context showing about:blank.
+# Messages left unread by the previous test are dropped.
+async def reset_session(websocket):
+    async def execute(method, params):
+        resp = await execute_ignoring_other_messages(websocket, {
+            "id": 9990, "method": method, "params": params})
+        assert "result" in resp, resp
+        return resp["result"]
+
+    contexts = [context["context"] for context in
+        (await execute("browsingContext.getTree", {}))["contexts"]]
+    await execute("session.unsubscribe", {"events": ALL_EVENTS})
+    if contexts:
+        await execute("session.unsubscribe", {
+            "events": ALL_EVENTS, "contexts": contexts})
+    await execute("PROTO.session.setEventBatching", {"window": 0})
+    await execute("PROTO.session.setTracing", {"enabled": False})
+    for context in contexts:
+        await execute("PROTO.browsingContext.stopScreencast", {"context": context})
+
+    if not contexts:
+        contexts = [(await execute("PROTO.browsingContext.createContext",
+            {"url": "about:blank"}))["context"]]
+    [main, *extra] = contexts
+    for context in extra:
+        # The context may be closing already.
+        await execute_ignoring_other_messages(websocket, {
+            "id": 9990, "method": "DEBUG.Page.close", "params": {"context": context}})
+    await execute("PROTO.browsingContext.navigate", {
+        "url": "about:blank", "context": main})
+
+    # Pages are closed asynchronously.
+    while len((await execute("browsingContext.getTree", {}))["contexts"]) > 1:
+        await asyncio.sleep(0.01)
+
 async def send_JSON_command(websocket, command):
     await websocket.send(json.dumps(command))
 
@@ -68,6 +227,292 @@ async def goto_url(websocket, contextID, url):
     assert resp["id"] == 9998
     return contextID
 
+# Tests for the pipelined client: many commands in flight on one connection.
+
+@pytest.mark.asyncio
+async def test_pipelinedCommands_responsesRoutedById(bidi_client):
+    futures = [await bidi_client.send_command("session.status")
+        for _ in range(20)]
+    assert bidi_client.pending_count <= 20
+
+    responses = await asyncio.gather(*futures)
+
+    assert len({resp["id"] for resp in responses}) == 20
+    for resp in responses:
+        assert resp["result"] == {"ready": True, "message": "ready"}
+    assert bidi_client.pending_count == 0
+
+@pytest.mark.asyncio
+async def test_pipelinedCommandsOnManyContexts_allResultsReceived(bidi_client):
+    contexts = await asyncio.gather(*[
+        bidi_client.execute("PROTO.browsingContext.createContext", {
+            "url": f"data:text/html,<h2>{i}</h2>"})
+        for i in range(5)])
+
+    results = await asyncio.gather(*[
+        bidi_client.execute("PROTO.page.evaluate", {
+            "function": "document.querySelector('h2').textContent",
+            "context": context["context"]})
+        for context in contexts])
+
+    assert results == [{"type": "string", "value": str(i)} for i in range(5)]
+
+@pytest.mark.asyncio
+async def test_pipelinedCommandsOnOneContext_runInOrder(bidi_client):
+    [context] = (await bidi_client.execute("browsingContext.getTree"))["contexts"]
+    contextID = context["context"]
+
+    futures = [await bidi_client.send_command("PROTO.page.evaluate", {
+            # Later commands must not overtake the slower earlier ones.
+            "function": f"new Promise(r => setTimeout(r, {10 - i}))"
+                f".then(() => (window.log = window.log || []).push({i}))",
+            "context": contextID})
+        for i in range(10)]
+    await asyncio.gather(*futures)
+
+    result = await bidi_client.execute("PROTO.page.evaluate", {
+        "function": "window.log.join()",
+        "context": contextID})
+    assert result == {"type": "string", "value": "0,1,2,3,4,5,6,7,8,9"}
+
+@pytest.mark.asyncio
+async def test_pipelinedCommandsOverQueueLimit_overloadedErrorReturned(bidi_client):
+    [context] = (await bidi_client.execute("browsingContext.getTree"))["contexts"]
+    contextID = context["context"]
+
+    # Keep the context busy while the rest of the commands are queued.
+    slow = await bidi_client.send_command("PROTO.page.evaluate", {
+        "function": "new Promise(r => setTimeout(r, 500))",
+        "context": contextID})
+    futures = [await bidi_client.send_command("PROTO.page.evaluate", {
+            "function": "1",
+            "context": contextID})
+        for _ in range(300)]
+    responses = await asyncio.gather(slow, *futures)
+
+    overloaded = [resp for resp in responses if "error" in resp]
+    assert len(overloaded) > 0
+    for resp in overloaded:
+        assert resp["error"] == "PROTO.overloaded"
+
+@pytest.mark.asyncio
+async def test_pipelinedCommandError_raisedAsBiDiError(bidi_client):
+    with pytest.raises(BiDiError) as error:
+        await bidi_client.execute("PROTO.browsingContext.navigate", {
+            "url": "data:text/html,<h2>test</h2>",
+            "context": "unknown_context"})
+    assert error.value.error == "unknown error"
+    assert error.value.message == "context not found"
+
+# Tests for the client's event router.
+
+@pytest.mark.asyncio
+async def test_eventRouter_consoleEventsDeliveredOnlyForSubscribedContext(bidi_client):
+    [context, other_context] = await asyncio.gather(*[
+        bidi_client.execute("PROTO.browsingContext.createContext", {
+            "url": "about:blank"})
+        for _ in range(2)])
+    subscription = bidi_client.subscribe("log.entryAdded", context["context"])
+
+    await bidi_client.execute("PROTO.page.evaluate", {
+        "function": "console.log('other context')",
+        "context": other_context["context"]})
+    await bidi_client.execute("PROTO.page.evaluate", {
+        "function": "console.log('subscribed context')",
+        "context": context["context"]})
+
+    event = await subscription.get(timeout=5)
+    assert event["params"]["text"] == "subscribed context"
+    assert subscription.queue.empty()
+    subscription.close()
+
+@pytest.mark.asyncio
+async def test_eventRouter_waitForPredicate_matchingEventReturned(bidi_client):
+    [context] = (await bidi_client.execute("browsingContext.getTree"))["contexts"]
+    contextID = context["context"]
+    wait = asyncio.ensure_future(bidi_client.wait_for_event(
+        "log.entryAdded", contextID,
+        predicate=lambda e: e["params"]["text"] == "second",
+        timeout=5))
+
+    await bidi_client.execute("PROTO.page.evaluate", {
+        "function": "console.log('first'); console.log('second')",
+        "context": contextID})
+
+    event = await wait
+    assert event["params"]["text"] == "second"
+
+@pytest.mark.asyncio
+async def test_eventRouter_waitForMissingEvent_timeoutRaised(bidi_client):
+    with pytest.raises(asyncio.TimeoutError):
+        await bidi_client.wait_for_event("DEBUG.Page.load", timeout=0.1)
+
+# Tests for the outbound message writer.
+
+@pytest.mark.asyncio
+async def test_eventBatching_eventsSentInOneFrame(websocket):
+    contextID = await get_open_context_id(websocket)
+    await send_JSON_command(websocket, {
+        "id": 1,
+        "method": "PROTO.session.setEventBatching",
+        "params": {"window": 100}})
+    resp = await read_JSON_message(websocket)
+    assert resp == {"id": 1, "result": {}}
+
+    await send_JSON_command(websocket, {
+        "id": 2,
+        "method": "PROTO.page.evaluate",
+        "params": {
+            "function": "new Promise(r => {"
+                "console.log('a'); console.log('b'); console.log('c');"
+                "setTimeout(r, 50)})",
+            "context": contextID}})
+
+    # All the events logged before the response are flushed before it.
+    resp = await read_JSON_message(websocket)
+    assert [event["params"]["text"] for event in resp] == ["a", "b", "c"]
+    resp = await read_JSON_message(websocket)
+    assert resp["id"] == 2
+
+@pytest.mark.asyncio
+async def test_eventBatching_clientUnpacksBatches(bidi_client):
+    [context] = (await bidi_client.execute("browsingContext.getTree"))["contexts"]
+    await bidi_client.execute("PROTO.session.setEventBatching", {
+        "window": 10,
+        "maxSize": 2})
+    subscription = bidi_client.subscribe("log.entryAdded")
+
+    await bidi_client.execute("PROTO.page.evaluate", {
+        "function": "for (let i = 0; i < 5; i++) console.log(i)",
+        "context": context["context"]})
+
+    texts = [(await subscription.get(timeout=5))["params"]["text"]
+        for _ in range(5)]
+    assert texts == ["0", "1", "2", "3", "4"]
+
+    stats = await bidi_client.execute("DEBUG.Session.outbound")
+    assert stats["dropped"] == 0
+    assert stats["batches"] >= 2
+
+# Tests for the benchmark harness.
+
+@pytest.mark.asyncio
+async def test_benchmark_scenarioMeasured(bidi_client):
+    contexts = await open_contexts(bidi_client, 2)
+
+    result = await run_scenario(bidi_client, "nodeSerialization", 2, 10, contexts)
+
+    assert result["iterations"] == 10
+    assert result["errors"] == 0
+    assert result["commandsPerSecond"] > 0
+    latency = result["latencyMs"]
+    assert 0 < latency["p50"] <= latency["p95"] <= latency["p99"] <= latency["max"]
+
+    # The same results don't regress against themselves, slower ones do.
+    results = {"results": [result]}
+    assert compare_with_baseline(results, results, 0.2) == []
+    faster = json.loads(json.dumps(results))
+    faster["results"][0]["latencyMs"]["p95"] /= 2
+    assert len(compare_with_baseline(results, faster, 0.2)) == 1
+
+# Tests for screenshots.
+
+@pytest.mark.asyncio
+async def test_screenshot_jpegWithClip(bidi_client):
+    [context] = (await bidi_client.execute("browsingContext.getTree"))["contexts"]
+
+    result = await bidi_client.execute("DEBUG.Page.screenshot", {
+        "context": context["context"],
+        "format": "jpeg",
+        "quality": 50,
+        "clip": {"x": 0, "y": 0, "width": 10, "height": 10}})
+
+    assert base64.b64decode(result["screenshot"])[:3] == b"\xff\xd8\xff"
+
+@pytest.mark.asyncio
+async def test_screenshot_binaryChunksWrittenToSink(bidi_client):
+    [context] = (await bidi_client.execute("browsingContext.getTree"))["contexts"]
+    sink = io.BytesIO()
+
+    result = await bidi_client.execute("DEBUG.Page.screenshot", {
+        "context": context["context"],
+        "encoding": "binary",
+        "chunkSize": 100}, sink=sink)
+
+    data = sink.getvalue()
+    assert data[:8] == b"\x89PNG\r\n\x1a\n"
+    assert result == {
+        "format": "png",
+        "size": len(data),
+        "chunks": (len(data) + 99) // 100}
+    assert result["chunks"] > 1
+
+@pytest.mark.asyncio
+async def test_screenshot_qualityForPng_invalidArgument(bidi_client):
+    [context] = (await bidi_client.execute("browsingContext.getTree"))["contexts"]
+
+    with pytest.raises(BiDiError) as error:
+        await bidi_client.execute("DEBUG.Page.screenshot", {
+            "context": context["context"],
+            "quality": 50})
+    assert error.value.error == "invalid argument"
+
+@pytest.mark.asyncio
+async def test_screencast_framesIterated(bidi_client):
+    [context] = (await bidi_client.execute("browsingContext.getTree"))["contexts"]
+    contextID = context["context"]
+    # Keep the page repainting.
+    await bidi_client.execute("PROTO.page.evaluate", {
+        "function": "(function paint(i) {"
+            "document.body.style.background = i % 2 ? 'red' : 'blue';"
+            "requestAnimationFrame(() => paint(i + 1))})(0)",
+        "context": contextID})
+
+    async with bidi_client.screencast(contextID, maxFps=20, quality=50,
+            maxWidth=100, maxHeight=100) as screencast:
+        frames = []
+        async for frame in screencast:
+            frames.append(frame)
+            if len(frames) == 3:
+                break
+
+    assert [frame["context"] for frame in frames] == [contextID] * 3
+    assert all(frame["frame"] > 0 for frame in frames)
+    assert base64.b64decode(frames[0]["data"])[:3] == b"\xff\xd8\xff"
+    assert screencast.stats["frames"] >= 3
+
+# Tests for the HTTP metrics endpoints.
+
+def http_get(port, path):
+    with urllib.request.urlopen(f"http://localhost:{port}{path}") as response:
+        return response.read().decode()
+
+# Request targets that are no valid URL paths don't take the server down.
+@pytest.mark.asyncio
+async def test_metrics_malformedRequestTargetRejected(server_port):
+    for target in ["//", "//[", "//a:b:c"]:
+        with socket.create_connection(("localhost", server_port), timeout=5) as connection:
+            connection.sendall(
+                f"GET {target} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+            status_line = connection.makefile("rb").readline()
+        assert status_line.startswith(b"HTTP/1.1 404 ")
+
+    assert "bidi_sessions " in http_get(server_port, "/metrics")
+
+@pytest.mark.asyncio
+async def test_metrics_commandsAndGaugesReported(bidi_client, server_port):
+    await bidi_client.execute("session.status")
+
+    snapshot = json.loads(http_get(server_port, "/debug"))
+    assert snapshot["commands"]["session.status"]["count"] >= 1
+    assert snapshot["sessions"] >= 1
+    assert snapshot["contexts"] >= 1
+    assert sum(snapshot["cdpCommands"].values()) > 0
+
+    metrics = http_get(server_port, "/metrics")
+    assert 'bidi_command_duration_seconds_count{method="session.status"}' in metrics
+    assert "bidi_sessions " in metrics
+
 # Tests for "handle an incoming message" error handling, when the message
 # can't be decoded as known command.
 # https://w3c.github.io/webdriver-bidi/#handle-an-incoming-message
@@ -109,6 +554,39 @@ async def test_empty_object(websocket):
         "error": "invalid argument",
         "message": "Expected unsigned integer but got undefined"}
 
+@pytest.mark.asyncio
+async def test_unknownCommand_errorWithIdReturned(websocket):
+    command = {"id": 6, "method": "unknown.command", "params": {}}
+    await send_JSON_command(websocket, command)
+    resp = await read_JSON_message(websocket)
+    assert resp == {
+        "id": 6,
+        "error": "unknown error",
+        "message": "unknown command"}
+
+@pytest.mark.asyncio
+async def test_missingParam_invalidArgumentReturned(websocket):
+    command = {"id": 7, "method": "PROTO.page.evaluate", "params": {
+        "context": "some_context"}}
+    await send_JSON_command(websocket, command)
+    resp = await read_JSON_message(websocket)
+    assert resp == {
+        "id": 7,
+        "error": "invalid argument",
+        "message": "missing params.function"}
+
+@pytest.mark.asyncio
+async def test_paramOfWrongType_invalidArgumentReturned(websocket):
+    command = {"id": 10, "method": "PROTO.browsingContext.selectElement", "params": {
+        "context": "some_context",
+        "selector": 42}}
+    await send_JSON_command(websocket, command)
+    resp = await read_JSON_message(websocket)
+    assert resp == {
+        "id": 10,
+        "error": "invalid argument",
+        "message": "params.selector should be string but got number"}
+
 @pytest.mark.asyncio
 async def test_session_status(websocket):
     command = {"id": 5, "method": "session.status", "params": {}}
@@ -133,7 +611,232 @@ async def test_getTree_contextReturned(websocket):
             "contexts": [{
                     "context": contextID,
                     "parent": None,
-                    "url": "about:blank"}]}}
+                    "url": "about:blank",
+                    "children": []}]}}
+
+@pytest.mark.asyncio
+async def test_getTree_framesReturnedAsChildren(bidi_client):
+    [context] = (await bidi_client.execute("browsingContext.getTree"))["contexts"]
+    contextID = context["context"]
+    url = "data:text/html,<iframe srcdoc='<h2>frame</h2>'></iframe>"
+    await bidi_client.execute("PROTO.browsingContext.navigate", {
+        "url": url, "context": contextID})
+
+    [context] = (await bidi_client.execute("browsingContext.getTree"))["contexts"]
+    [frame] = context["children"]
+    assert context["url"] == url
+    assert frame["parent"] == contextID
+    assert frame["url"] == "about:srcdoc"
+    assert frame["children"] == []
+
+    result = await bidi_client.execute("browsingContext.getTree", {
+        "root": contextID, "maxDepth": 0})
+    assert result == {"contexts": [{
+        "context": contextID, "parent": None, "url": url, "children": None}]}
+
+    result = await bidi_client.execute("browsingContext.getTree", {
+        "root": frame["context"]})
+    assert result == {"contexts": [frame]}
+
+    # Frames are removed along with their document.
+    await bidi_client.execute("PROTO.browsingContext.navigate", {
+        "url": "about:blank", "context": contextID})
+    [context] = (await bidi_client.execute("browsingContext.getTree"))["contexts"]
+    assert context["children"] == []
+
+# Polls `/debug` until `predicate` holds for the snapshot, and returns it.
+async def wait_for_debug_snapshot(port, predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        snapshot = json.loads(http_get(port, "/debug"))
+        if predicate(snapshot):
+            return snapshot
+        assert time.monotonic() < deadline, snapshot
+        await asyncio.sleep(0.1)
+
+# The browser of a closed session is reset and reused by the next one.
+@pytest.mark.asyncio
+async def test_reusedBrowser_stateOfPreviousSessionReset(server_port):
+    url = f'ws://localhost:{server_port}'
+    recycled = json.loads(http_get(server_port, "/debug"))["browserTotals"]["recycled"]
+    async with websockets.connect(url) as connection:
+        async with BiDiClient(connection) as client:
+            await client.execute("PROTO.browsingContext.createContext", {
+                "url": "data:text/html,<h2>previous session</h2>"})
+
+    # The reset browser is the last one put back, so it's taken next.
+    totals = (await wait_for_debug_snapshot(server_port,
+        lambda snapshot: snapshot["browserTotals"]["recycled"] > recycled)
+    )["browserTotals"]
+
+    async with websockets.connect(url) as connection:
+        async with BiDiClient(connection) as client:
+            result = await client.execute("browsingContext.getTree")
+            snapshot = json.loads(http_get(server_port, "/debug"))
+    assert snapshot["browserTotals"]["launched"] == totals["launched"]
+
+    [context] = result["contexts"]
+    assert context["url"] == "about:blank"
+    assert context["parent"] is None
+
+# Scripts of the fake backend run in the server process, a busy loop must not
+# stall it.
+@pytest.mark.asyncio
+async def test_fakeBackend_busyScriptInterrupted(server_port):
+    port = server_port + 3000
+    with start_server(port, BROWSER_BACKEND='fake',
+                      FAKE_CDP_SCRIPT_TIMEOUT='200'):
+        async with websockets.connect(f'ws://localhost:{port}') as connection:
+            async with BiDiClient(connection) as client:
+                [context] = (await client.execute(
+                    "browsingContext.getTree"))["contexts"]
+                params = {"context": context["context"]}
+
+                with pytest.raises(BiDiError) as error:
+                    await client.execute("PROTO.page.evaluate", {
+                        **params, "function": "while (true) {}"})
+                assert "Script execution timed out" in error.value.message
+
+                # A declaration calling itself loops while it is compiled.
+                with pytest.raises(BiDiError) as error:
+                    await client.execute("PROTO.page.evaluate", {
+                        **params, "function": "(() => { for (;;); })()",
+                        "args": [1]})
+                assert "Script execution timed out" in error.value.message
+
+                result = await client.execute("PROTO.page.evaluate", {
+                    **params, "function": "1 + 1"})
+                assert result == {"type": "number", "value": 2}
+
+# The cluster places sessions on the least loaded worker and merges the
+# metrics of its workers.
+@pytest.mark.asyncio
+async def test_cluster_sessionsSpreadAndMetricsMerged(server_port):
+    port = server_port + 4000
+    with start_server(port, script='cluster.js', WORKERS='2',
+                      BROWSER_BACKEND='fake'):
+        url = f'ws://localhost:{port}'
+        async with websockets.connect(url) as first, websockets.connect(url) as second:
+            async with BiDiClient(first) as client, BiDiClient(second) as other:
+                for session in [client, other]:
+                    [context] = (await session.execute(
+                        "browsingContext.getTree"))["contexts"]
+                    result = await session.execute("PROTO.page.evaluate", {
+                        "context": context["context"], "function": "1 + 1"})
+                    assert result == {"type": "number", "value": 2}
+
+                metrics = http_get(port, "/metrics")
+                snapshot = json.loads(http_get(port, "/debug"))
+
+    assert 'bidi_cluster_worker_connections{worker="0"} 1' in metrics
+    assert 'bidi_cluster_worker_connections{worker="1"} 1' in metrics
+    # One HELP and TYPE line per family, followed by the samples of all the
+    # workers.
+    assert metrics.count("# TYPE bidi_sessions gauge") == 1
+    lines = metrics.split("\n")
+    header = lines.index("# TYPE bidi_sessions gauge")
+    assert sorted(lines[header + 1:header + 3]) == [
+        'bidi_sessions{worker="0"} 1', 'bidi_sessions{worker="1"} 1']
+
+    assert snapshot["restarts"] == 0
+    assert sorted(w["worker"] for w in snapshot["workers"]) == [0, 1]
+    assert [w["sessions"] for w in snapshot["workers"]] == [1, 1]
+
+# A worker which exits is restarted under the same index.
+@pytest.mark.asyncio
+async def test_cluster_exitedWorkerRestarted(server_port):
+    port = server_port + 5000
+    with start_server(port, script='cluster.js', WORKERS='1',
+                      BROWSER_BACKEND='fake'):
+        [worker] = (await wait_for_debug_snapshot(port,
+            lambda snapshot: len(snapshot["workers"]) == 1))["workers"]
+        os.kill(worker["pid"], signal.SIGKILL)
+
+        snapshot = await wait_for_debug_snapshot(port, lambda snapshot:
+            snapshot["restarts"] == 1 and len(snapshot["workers"]) == 1)
+        [restarted] = snapshot["workers"]
+        assert restarted["worker"] == 0
+        assert restarted["pid"] != worker["pid"]
+
+        async with websockets.connect(f'ws://localhost:{port}') as connection:
+            async with BiDiClient(connection) as client:
+                await client.execute("session.status")
+
+# A failed launch lets the next session waiting for the browser try again,
+# instead of leaving it waiting.
+@pytest.mark.asyncio
+async def test_sessions_failedLaunchWakesWaitingSession(server_port, tmp_path):
+    # A "browser" failing to start after a second.
+    browser = tmp_path / "browser"
+    browser.write_text("#!/bin/sh\nsleep 1\nexit 1\n")
+    browser.chmod(0o755)
+    port = server_port + 2000
+    with start_server(port, PUPPETEER_EXECUTABLE_PATH=str(browser),
+                      BROWSER_POOL_MIN='0', BROWSER_POOL_MAX='1',
+                      SESSION_ADMISSION_TIMEOUT='20000'):
+        def connect():
+            with pytest.raises(urllib.error.HTTPError) as error:
+                urllib.request.urlopen(upgrade_request(port), timeout=15)
+            return error.value
+
+        loop = asyncio.get_event_loop()
+        errors = await asyncio.gather(
+            loop.run_in_executor(None, connect),
+            loop.run_in_executor(None, connect))
+
+    for error in errors:
+        assert error.code == 503
+        assert error.headers["X-WebSocket-Reject-Reason"] == "cannot launch browser"
+
+# Sessions don't see each other's contexts, whether they have their own
+# browser or share one (`SESSION_ISOLATION=context`).
+@pytest.mark.asyncio
+async def test_sessions_contextsIsolated(server_port):
+    url = f'ws://localhost:{server_port}'
+    async with websockets.connect(url) as first, websockets.connect(url) as second:
+        async with BiDiClient(first) as client, BiDiClient(second) as other:
+            created = await client.execute("PROTO.browsingContext.createContext", {
+                "url": "data:text/html,<h2>first session</h2>"})
+
+            contexts = (await other.execute("browsingContext.getTree"))["contexts"]
+            assert created["context"] not in [c["context"] for c in contexts]
+
+            with pytest.raises(BiDiError) as error:
+                await other.execute("PROTO.page.evaluate", {
+                    "function": "document.body.innerHTML",
+                    "context": created["context"]})
+            assert error.value.message == "context not found"
+
+# WebSocket upgrade request, sent with urllib to read the headers of a
+# rejection.
+def upgrade_request(port):
+    return urllib.request.Request(f'http://localhost:{port}/', headers={
+        "Upgrade": "websocket",
+        "Connection": "Upgrade",
+        "Sec-WebSocket-Version": "13",
+        "Sec-WebSocket-Key": base64.b64encode(os.urandom(16)).decode()})
+
+@pytest.mark.asyncio
+async def test_sessions_rejectedWithRetryAfterWhenSaturated(server_port):
+    # A server of its own, with a single browser and room for one waiting
+    # session.
+    port = server_port + 1000
+    with start_server(port, BROWSER_BACKEND='fake', BROWSER_POOL_MIN='0',
+                      BROWSER_POOL_MAX='1', MAX_PENDING_SESSIONS='1'):
+        url = f'ws://localhost:{port}'
+        async with websockets.connect(url):
+            pending = asyncio.ensure_future(websockets.connect(url))
+            await asyncio.sleep(0.5)
+            assert not pending.done()
+
+            with pytest.raises(urllib.error.HTTPError) as error:
+                urllib.request.urlopen(upgrade_request(port), timeout=5)
+            assert error.value.code == 503
+            assert int(error.value.headers["Retry-After"]) >= 1
+
+        # The waiting session gets the browser of the first one.
+        connection = await asyncio.wait_for(pending, timeout=10)
+        await connection.close()
 
 @pytest.mark.asyncio
 async def test_createContext_eventContextCreatedEmittedAndContextCreated(websocket):
@@ -153,7 +856,8 @@ async def test_createContext_eventContextCreatedEmittedAndContextCreated(websock
         "params": {
             "context":contextID,
             "parent": None,
-            "url": "data:text/html,<h2>test</h2>"}}
+            "url": "data:text/html,<h2>test</h2>",
+            "children": []}}
 
     # Assert command done.
     resp = await read_JSON_message(websocket)
@@ -162,7 +866,8 @@ async def test_createContext_eventContextCreatedEmittedAndContextCreated(websock
         "result": {
             "context": contextID,
             "parent": None,
-            "url": "data:text/html,<h2>test</h2>"}}
+            "url": "data:text/html,<h2>test</h2>",
+            "children": []}}
 
 @pytest.mark.asyncio
 async def test_PageClose_browsingContextContextDestroyedEmitted(websocket):
@@ -183,7 +888,122 @@ async def test_PageClose_browsingContextContextDestroyedEmitted(websocket):
         "params": {
             "context": contextID,
             "parent": None,
-            "url": "about:blank"}}
+            "url": "about:blank",
+            "children": []}}
+
+@pytest.mark.asyncio
+async def test_notSubscribed_noEventsEmitted(unsubscribed_websocket):
+    websocket = unsubscribed_websocket
+    contextID = await get_open_context_id(websocket)
+
+    await send_JSON_command(websocket, {
+        "id": 13,
+        "method": "PROTO.page.evaluate",
+        "params": {
+            "function": "console.log('some log message')",
+            "context": contextID}})
+
+    # No "log.entryAdded" event emitted before the response.
+    resp = await read_JSON_message(websocket)
+    assert resp == {"id": 13, "result": {"type": "undefined"}}
+
+# Puppeteer enables the Log domain of new pages, the server disables it when
+# nobody is subscribed to log entries.
+@pytest.mark.asyncio
+async def test_notSubscribed_logDomainDisabled(unsubscribed_websocket, server_port):
+    def log_disable_count():
+        snapshot = json.loads(http_get(server_port, "/debug"))
+        return snapshot["cdpCommands"].get("Log.disable", 0)
+
+    count = log_disable_count()
+    async with BiDiClient(unsubscribed_websocket) as client:
+        await client.execute("PROTO.browsingContext.createContext", {
+            "url": "about:blank"})
+    assert log_disable_count() == count + 1
+
+@pytest.mark.asyncio
+async def test_subscribeToContext_eventsOfOtherContextsNotEmitted(unsubscribed_websocket):
+    websocket = unsubscribed_websocket
+    contextID = await get_open_context_id(websocket)
+    await send_JSON_command(websocket, {
+        "id": 14,
+        "method": "PROTO.browsingContext.createContext",
+        "params": {"url": "about:blank"}})
+    resp = await read_JSON_message(websocket)
+    otherContextID = resp["result"]["context"]
+
+    await subscribe(websocket, ["log.entryAdded"], [contextID])
+
+    # No event emitted for the other context.
+    await send_JSON_command(websocket, {
+        "id": 15,
+        "method": "PROTO.page.evaluate",
+        "params": {
+            "function": "console.log('some log message')",
+            "context": otherContextID}})
+    resp = await read_JSON_message(websocket)
+    assert resp == {"id": 15, "result": {"type": "undefined"}}
+
+    # Event emitted for the subscribed context.
+    await send_JSON_command(websocket, {
+        "id": 16,
+        "method": "PROTO.page.evaluate",
+        "params": {
+            "function": "console.log('some log message')",
+            "context": contextID}})
+    resp = await read_JSON_message(websocket)
+    assert resp["method"] == "log.entryAdded"
+    assert resp["params"]["PROTO.context"] == contextID
+    resp = await read_JSON_message(websocket)
+    assert resp == {"id": 16, "result": {"type": "undefined"}}
+
+@pytest.mark.asyncio
+async def test_unsubscribe_eventsNotEmitted(websocket):
+    contextID = await get_open_context_id(websocket)
+    await send_JSON_command(websocket, {
+        "id": 16,
+        "method": "session.unsubscribe",
+        "params": {"events": ["log"]}})
+    resp = await read_JSON_message(websocket)
+    assert resp == {"id": 16, "result": {}}
+
+    await send_JSON_command(websocket, {
+        "id": 17,
+        "method": "PROTO.page.evaluate",
+        "params": {
+            "function": "console.log('some log message')",
+            "context": contextID}})
+
+    resp = await read_JSON_message(websocket)
+    assert resp == {"id": 17, "result": {"type": "undefined"}}
+
+@pytest.mark.asyncio
+async def test_subscribeToUnknownEvent_invalidArgumentReturned(websocket):
+    await send_JSON_command(websocket, {
+        "id": 18,
+        "method": "session.subscribe",
+        "params": {"events": ["unknown.event"]}})
+    resp = await read_JSON_message(websocket)
+    assert resp == {
+        "id": 18,
+        "error": "invalid argument",
+        "message": "unknown event unknown.event"}
+
+@pytest.mark.asyncio
+async def test_subscribeToContextsNotStrings_invalidArgumentReturned(websocket):
+    for contexts, message in [
+            ([1], "params.contexts[0] should be string but got number"),
+            (["some_context", None], "missing params.contexts[1]"),
+            ([""], "missing params.contexts[0]")]:
+        await send_JSON_command(websocket, {
+            "id": 19,
+            "method": "session.subscribe",
+            "params": {"events": ["log.entryAdded"], "contexts": contexts}})
+        resp = await read_JSON_message(websocket)
+        assert resp == {
+            "id": 19,
+            "error": "invalid argument",
+            "message": message}
 
 @pytest.mark.asyncio
 async def test_navigate_eventPageLoadEmittedAndNavigated(websocket):
@@ -386,6 +1206,66 @@ async def test_waitForSelectorWithMissingElement_failedWithTimeout_slow(websocke
         "error": "unknown error",
         "message": "waiting for selector `body > h3` failed: timeout 1000ms exceeded"}
 
+@pytest.mark.asyncio
+async def test_waitForSelector_multipleSelectors_firstMatch(bidi_client):
+    [context] = (await bidi_client.execute("browsingContext.getTree"))["contexts"]
+    contextID = context["context"]
+    await bidi_client.execute("PROTO.browsingContext.navigate", {
+        "url": "data:text/html,<h2>test</h2>",
+        "context": contextID})
+
+    waiting = asyncio.ensure_future(bidi_client.execute(
+        "PROTO.browsingContext.waitForSelector", {
+            "selector": ["body > h3", "body > h4"],
+            "timeout": 5000,
+            "context": contextID}))
+    await asyncio.sleep(0.1)
+    assert not waiting.done()
+
+    # Waiting doesn't block the later commands of the context.
+    await bidi_client.execute("PROTO.page.evaluate", {
+        "function": "document.body.append(document.createElement('h4'))",
+        "context": contextID})
+    result = await waiting
+    recursiveCompare(
+        result,
+        {"matches": [{
+            "selector": "body > h4",
+            "index": 1,
+            "element": {"type": "node", "objectId": "__any_value__"}}]},
+        ["objectId"])
+
+@pytest.mark.asyncio
+async def test_waitForSelector_multipleSelectors_all(bidi_client):
+    [context] = (await bidi_client.execute("browsingContext.getTree"))["contexts"]
+    contextID = context["context"]
+    await bidi_client.execute("PROTO.browsingContext.navigate", {
+        "url": "data:text/html,<h2 style='visibility: hidden'>test</h2>",
+        "context": contextID})
+
+    # The hidden h2 is returned, the missing h3 is hidden as well.
+    result = await bidi_client.execute("PROTO.browsingContext.waitForSelector", {
+        "selector": ["body > h2", "body > h3"],
+        "all": True,
+        "hidden": True,
+        "context": contextID})
+    recursiveCompare(
+        result,
+        {"matches": [
+            {"selector": "body > h2", "index": 0,
+                "element": {"type": "node", "objectId": "__any_value__"}},
+            {"selector": "body > h3", "index": 1}]},
+        ["objectId"])
+
+    with pytest.raises(BiDiError) as error:
+        await bidi_client.execute("PROTO.browsingContext.waitForSelector", {
+            "selector": ["body > h2", "body > h3"],
+            "all": True,
+            "timeout": 100,
+            "context": contextID})
+    assert error.value.message == \
+        "waiting for selectors `body > h2`, `body > h3` failed: timeout 100ms exceeded"
+
 @pytest.mark.asyncio
 async def test_clickElement_clickProcessed(websocket):
 # 1. Open page with button and click handler. Button click logs message.
@@ -431,6 +1311,81 @@ async def test_clickElement_clickProcessed(websocket):
     resp = await read_JSON_message(websocket)
     assert resp ==  {"id": 26, "result": {}}
 
+@pytest.mark.asyncio
+async def test_batch_stepsReferToEarlierResults(bidi_client):
+    [context] = (await bidi_client.execute("browsingContext.getTree"))["contexts"]
+    contextID = context["context"]
+    await bidi_client.execute("PROTO.browsingContext.navigate", {
+        "url": "data:text/html,<input onclick='window.clicked = true'>",
+        "context": contextID})
+
+    results = await bidi_client.batch([
+        ("PROTO.browsingContext.selectElement", {"selector": "input"}),
+        ("PROTO.browsingContext.click", {"objectId": ref(0, "objectId")}),
+        ("PROTO.browsingContext.type", {
+            "objectId": ref(0, "objectId"), "text": "abc"}),
+        ("PROTO.page.evaluate", {
+            "function": "(input) => window.clicked && input.value",
+            "args": [{"objectId": ref(0, "objectId")}]}),
+    ], context=contextID)
+
+    assert len(results) == 4
+    assert results[0]["type"] == "node"
+    assert results[1:] == [{}, {}, {"type": "string", "value": "abc"}]
+
+@pytest.mark.asyncio
+async def test_batch_stopsAtFailingStep(bidi_client):
+    [context] = (await bidi_client.execute("browsingContext.getTree"))["contexts"]
+    contextID = context["context"]
+
+    with pytest.raises(BiDiError) as error:
+        await bidi_client.batch([
+            ("PROTO.page.evaluate", {"function": "window.step = 0"}),
+            ("PROTO.browsingContext.click", {"objectId": "missing"}),
+            ("PROTO.page.evaluate", {"function": "window.step = 2"}),
+        ], context=contextID)
+    assert error.value.error == "unknown error"
+    assert error.value.message == \
+        "step 1 (PROTO.browsingContext.click): object not found"
+
+    result = await bidi_client.execute("PROTO.page.evaluate", {
+        "function": "window.step", "context": contextID})
+    assert result == {"type": "number", "value": 0}
+
+@pytest.mark.asyncio
+async def test_batch_stepOfOtherContextRejected(bidi_client):
+    [context] = (await bidi_client.execute("browsingContext.getTree"))["contexts"]
+    contextID = context["context"]
+    other = await bidi_client.execute("PROTO.browsingContext.createContext", {
+        "url": "about:blank"})
+
+    with pytest.raises(BiDiError) as error:
+        await bidi_client.batch([
+            ("PROTO.page.evaluate", {"function": "1"}),
+            ("PROTO.page.evaluate", {
+                "function": "2", "context": other["context"]}),
+        ], context=contextID)
+    assert error.value.error == "invalid argument"
+    assert error.value.message == "step 1 (PROTO.page.evaluate): " \
+        "params.context should be the context of the batch"
+
+# Commands are queued on their context, so they can't act on an element of
+# another one.
+@pytest.mark.asyncio
+async def test_click_elementOfOtherContextRejected(bidi_client):
+    [context] = (await bidi_client.execute("browsingContext.getTree"))["contexts"]
+    other = await bidi_client.execute("PROTO.browsingContext.createContext", {
+        "url": "data:text/html,<button>other</button>"})
+    element = await bidi_client.execute("PROTO.browsingContext.selectElement", {
+        "selector": "button", "context": other["context"]})
+
+    with pytest.raises(BiDiError) as error:
+        await bidi_client.execute("PROTO.browsingContext.click", {
+            "objectId": element["objectId"], "context": context["context"]})
+    assert error.value.error == "invalid argument"
+    assert error.value.message == \
+        "params.objectId should be an object of params.context"
+
 @pytest.mark.asyncio
 async def test_selectElement_success(websocket):
     contextID = await get_open_context_id(websocket)
@@ -662,6 +1617,191 @@ async def test_browsingContextType_textTyped(websocket):
             "type":"string",
             "value":"!!@@## test text"}}
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mode", ["pipelined", "insertText"])
+async def test_browsingContextType_fastModes_textTyped(bidi_client, mode):
+    [context] = (await bidi_client.execute("browsingContext.getTree"))["contexts"]
+    contextID = context["context"]
+    await bidi_client.execute("PROTO.browsingContext.navigate", {
+        "url": "data:text/html,<input>", "context": contextID})
+    element = await bidi_client.execute("PROTO.browsingContext.selectElement", {
+        "selector": "input", "context": contextID})
+
+    await bidi_client.set_tracing()
+    _, trace = await bidi_client.execute_traced("PROTO.browsingContext.type", {
+        "text": "!!@@## test text",
+        "objectId": element["objectId"],
+        "mode": mode,
+        "context": contextID})
+    if mode == "insertText":
+        assert trace["cdpMethods"]["Input.insertText"] == 1
+        assert "Input.dispatchKeyEvent" not in trace["cdpMethods"]
+
+    result = await bidi_client.execute("PROTO.page.evaluate", {
+        "function": "element => element.value",
+        "args": [{"objectId": element["objectId"]}],
+        "context": contextID})
+    assert result == {"type": "string", "value": "!!@@## test text"}
+
+@pytest.mark.asyncio
+async def test_browsingContextFill_fieldsFilled(bidi_client):
+    [context] = (await bidi_client.execute("browsingContext.getTree"))["contexts"]
+    contextID = context["context"]
+    await bidi_client.execute("PROTO.browsingContext.navigate", {
+        "url": "data:text/html,<input id=name value=old><textarea></textarea>"
+            "<input id=empty value=gone>",
+        "context": contextID})
+    textarea = await bidi_client.execute("PROTO.browsingContext.selectElement", {
+        "selector": "textarea", "context": contextID})
+
+    await bidi_client.execute("PROTO.browsingContext.fill", {
+        "fields": [
+            {"selector": "#name", "text": "new"},
+            {"objectId": textarea["objectId"], "text": "two\nlines"},
+            {"selector": "#empty", "text": ""}],
+        "clear": True,
+        "context": contextID})
+
+    result = await bidi_client.execute("PROTO.page.evaluate", {
+        "function": "[...document.querySelectorAll('input, textarea')]"
+            ".map(e => e.value).join('|')",
+        "context": contextID})
+    assert result == {"type": "string", "value": "new|two\nlines|"}
+
+    with pytest.raises(BiDiError) as error:
+        await bidi_client.execute("PROTO.browsingContext.fill", {
+            "fields": [{"text": "no target"}], "context": contextID})
+    assert error.value.error == "invalid argument"
+    assert error.value.message == \
+        "params.fields[0] should have either objectId or selector"
+
+@pytest.mark.asyncio
+async def test_evaluate_scriptCompiledOncePerDocument(bidi_client):
+    [context] = (await bidi_client.execute("browsingContext.getTree"))["contexts"]
+    contextID = context["context"]
+    params = {"function": "window.calls = (window.calls || 0) + 1",
+        "context": contextID}
+    await bidi_client.set_tracing()
+
+    # A one-off script runs in one round trip, it is compiled once repeated.
+    result, trace = await bidi_client.execute_traced("PROTO.page.evaluate", params)
+    assert result == {"type": "number", "value": 1}
+    assert trace["cdpMethods"] == {"Runtime.evaluate": 1}
+
+    result, trace = await bidi_client.execute_traced("PROTO.page.evaluate", params)
+    assert result == {"type": "number", "value": 2}
+    assert trace["cdpMethods"] == {"Runtime.compileScript": 1, "Runtime.runScript": 1}
+
+    result, trace = await bidi_client.execute_traced("PROTO.page.evaluate", params)
+    assert result == {"type": "number", "value": 3}
+    assert trace["cdpMethods"] == {"Runtime.runScript": 1}
+
+    # Navigation destroys the compiled script.
+    await bidi_client.execute("PROTO.browsingContext.navigate", {
+        "url": "data:text/html,<h2>test</h2>", "context": contextID})
+    result, trace = await bidi_client.execute_traced("PROTO.page.evaluate", params)
+    assert result == {"type": "number", "value": 1}
+    assert trace["cdpMethods"] == {"Runtime.evaluate": 1}
+
+@pytest.mark.asyncio
+async def test_registerFunction_calledById(bidi_client):
+    [context] = (await bidi_client.execute("browsingContext.getTree"))["contexts"]
+    contextID = context["context"]
+    registered = await bidi_client.execute("PROTO.page.registerFunction", {
+        "function": "(a, b) => a + b"})
+    functionId = registered["functionId"]
+
+    for url in ["about:blank", "data:text/html,<h2>test</h2>"]:
+        await bidi_client.execute("PROTO.browsingContext.navigate", {
+            "url": url, "context": contextID})
+        for a in range(2):
+            result = await bidi_client.execute("PROTO.page.callFunction", {
+                "functionId": functionId,
+                "args": [a, 40],
+                "context": contextID})
+            assert result == {"type": "number", "value": a + 40}
+
+    stats = await bidi_client.execute("DEBUG.Session.scripts")
+    assert stats["functions"] == 1
+    assert stats["hits"] >= 2
+
+    with pytest.raises(BiDiError) as error:
+        await bidi_client.execute("PROTO.page.callFunction", {
+            "functionId": "missing", "context": contextID})
+    assert error.value.message == "function not found"
+
+@pytest.mark.asyncio
+async def test_releaseObjects_handleReleased(bidi_client):
+    [context] = (await bidi_client.execute("browsingContext.getTree"))["contexts"]
+    contextID = context["context"]
+    await bidi_client.execute("PROTO.browsingContext.navigate", {
+        "url": "data:text/html,<h2>test</h2>",
+        "context": contextID})
+    element = await bidi_client.execute("PROTO.browsingContext.selectElement", {
+        "selector": "body > h2",
+        "context": contextID})
+
+    handles = await bidi_client.execute("DEBUG.Session.handles")
+    assert handles == {"total": 1, "contexts": {contextID: 1}}
+
+    result = await bidi_client.execute("PROTO.page.releaseObjects", {
+        "objectIds": [element["objectId"], "unknown_object_id"]})
+    assert result == {"released": 1}
+
+    handles = await bidi_client.execute("DEBUG.Session.handles")
+    assert handles == {"total": 0, "contexts": {}}
+
+    with pytest.raises(BiDiError) as error:
+        await bidi_client.execute("PROTO.browsingContext.click", {
+            "objectId": element["objectId"],
+            "context": contextID})
+    assert error.value.message == "object not found"
+
+@pytest.mark.asyncio
+async def test_navigate_handlesOfContextInvalidated(bidi_client):
+    [context] = (await bidi_client.execute("browsingContext.getTree"))["contexts"]
+    contextID = context["context"]
+    await bidi_client.execute("PROTO.browsingContext.navigate", {
+        "url": "data:text/html,<h2>test</h2>",
+        "context": contextID})
+    await bidi_client.execute("PROTO.page.evaluate", {
+        "function": "[document.body, {}]",
+        "context": contextID})
+
+    handles = await bidi_client.execute("DEBUG.Session.handles")
+    assert handles["contexts"][contextID] == 3
+
+    await bidi_client.execute("PROTO.browsingContext.navigate", {
+        "url": "data:text/html,<h3>test</h3>",
+        "context": contextID})
+
+    handles = await bidi_client.execute("DEBUG.Session.handles")
+    assert handles == {"total": 0, "contexts": {}}
+
+# Execution context ids are only unique per target, so navigating one context
+# must not invalidate the handles of another one.
+@pytest.mark.asyncio
+async def test_navigate_handlesOfOtherContextsKept(bidi_client):
+    [context] = (await bidi_client.execute("browsingContext.getTree"))["contexts"]
+    contextID = context["context"]
+    await bidi_client.execute("PROTO.browsingContext.navigate", {
+        "url": "data:text/html,<input value=kept>",
+        "context": contextID})
+    element = await bidi_client.execute("PROTO.browsingContext.selectElement", {
+        "selector": "input", "context": contextID})
+    other = await bidi_client.execute("PROTO.browsingContext.createContext", {
+        "url": "data:text/html,<h2>other</h2>"})
+
+    await bidi_client.execute("PROTO.browsingContext.navigate", {
+        "url": "data:text/html,<h3>navigated</h3>",
+        "context": other["context"]})
+
+    result = await bidi_client.execute("PROTO.page.evaluate", {
+        "function": "element => element.value",
+        "args": [{"objectId": element["objectId"]}],
+        "context": contextID})
+    assert result == {"type": "string", "value": "kept"}
+
 @pytest.mark.asyncio
 async def test_consoleInfo_logEntryWithMethodInfoEmmited(websocket):
     contextID = await get_open_context_id(websocket)
@@ -923,6 +2063,52 @@ async def test_serialisation_object(websocket):
                     "value":"quux"}]]},
         websocket)
 
+@pytest.mark.asyncio
+async def test_serialisation_nestedObjectWithMaxDepth(bidi_client):
+    [context] = (await bidi_client.execute("browsingContext.getTree"))["contexts"]
+
+    result = await bidi_client.execute("PROTO.page.evaluate", {
+        "function": "({'foo': {'bar': [1, {'baz': 'qux'}]}, 'quux': 2})",
+        "maxDepth": 3,
+        "context": context["context"]})
+
+    recursiveCompare({
+        "type":"object",
+        "objectId":"__any_value__",
+        "value":[[
+            "foo", {
+                "type":"object",
+                "objectId":"__any_value__",
+                "value":[[
+                    "bar", {
+                        "type":"array",
+                        "objectId":"__any_value__",
+                        "value":[{
+                            "type":"number",
+                            "value":1
+                        },{
+                            "type":"object",
+                            "objectId":"__any_value__"}]}]]}],[
+            "quux", {
+                "type":"number",
+                "value":2}]]},
+    result, ["objectId"])
+
+@pytest.mark.asyncio
+async def test_serialisation_largeArray(bidi_client):
+    [context] = (await bidi_client.execute("browsingContext.getTree"))["contexts"]
+
+    result = await bidi_client.execute("PROTO.page.evaluate", {
+        "function": "Array.from({length: 1000}, (_, i) => [i])",
+        "maxDepth": 2,
+        "context": context["context"]})
+
+    assert result["type"] == "array"
+    assert len(result["value"]) == 1000
+    for i, item in enumerate(result["value"]):
+        assert item["type"] == "array"
+        assert item["value"] == [{"type": "number", "value": i}]
+
 # TODO: add `NodeProperties` after serialisation MaxDepth logic specified:
 # https://github.com/w3c/webdriver-bidi/issues/86.
 @pytest.mark.asyncio
@@ -979,6 +2165,59 @@ async def test_serialisation_node(websocket):
 
 
 
+@pytest.mark.asyncio
+async def test_serialisation_nodeWithManyChildren(bidi_client):
+    [context] = (await bidi_client.execute("browsingContext.getTree"))["contexts"]
+    contextID = context["context"]
+    attributes = "".join(f" attr_{i}='value_{i}'" for i in range(10))
+    children = "".join(f"<span>{i}</span>" for i in range(50))
+    await bidi_client.execute("PROTO.browsingContext.navigate", {
+        "url": f"data:text/html,<div{attributes}>{children}</div>",
+        "context": contextID})
+
+    result = await bidi_client.execute("PROTO.page.evaluate", {
+        "function": "document.querySelector('div')",
+        "context": contextID})
+
+    value = result["value"]
+    assert value["childNodeCount"] == 50
+    assert len(value["children"]) == 50
+    for child in value["children"]:
+        assert child["type"] == "node"
+        assert isinstance(child["objectId"], str)
+    assert len({child["objectId"] for child in value["children"]}) == 50
+    assert value["attributes"] == [
+        {"name": f"attr_{i}", "value": f"value_{i}"} for i in range(10)]
+
+@pytest.mark.asyncio
+async def test_serialisation_nodeCdpBudget(bidi_client):
+    [context] = (await bidi_client.execute("browsingContext.getTree"))["contexts"]
+    contextID = context["context"]
+    children = "".join(f"<span>{i}</span>" for i in range(50))
+    await bidi_client.execute("PROTO.browsingContext.navigate", {
+        "url": f"data:text/html,<div>{children}</div>",
+        "context": contextID})
+    params = {"function": "document.querySelector('div')", "context": contextID}
+
+    # Twice, so the script is compiled before tracing.
+    for _ in range(2):
+        response = await bidi_client.send_and_wait("PROTO.page.evaluate", params)
+        assert "PROTO.trace" not in response
+
+    await bidi_client.set_tracing()
+    # Evaluating, then describing the subtree, reading it and releasing it,
+    # whatever the number of children.
+    result, trace = await bidi_client.execute_traced("PROTO.page.evaluate",
+        params, cdpCalls=4)
+    assert len(result["value"]["children"]) == 50
+    assert trace["cdpBytesSent"] > 0
+    assert trace["cdpBytesReceived"] > 0
+    assert trace["serializationTimeMs"] <= trace["totalTimeMs"]
+
+    with pytest.raises(BudgetExceeded) as error:
+        await bidi_client.execute_traced("PROTO.page.evaluate", params, cdpCalls=1)
+    assert error.value.exceeded == {"cdpCalls": 1}
+
 
 # TODO: implement proper serialisation according to
 # https://w3c.github.io/webdriver-bidi/#data-types-remote-value.
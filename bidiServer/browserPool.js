@@ -0,0 +1,235 @@
+/**
+ * Copyright 2021 Google Inc. All rights reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+'use strict';
+
+const debug = require('debug');
+
+const debugBrowserPool = debug('Server:pool');
+
+// Keeps pre-launched browsers warm, so a new session doesn't pay a browser
+// cold start. Browsers are handed out by `acquire` and given back by `release`,
+// which resets them to a single blank page instead of closing them.
+class BrowserPool {
+  // `launch` is an async function returning a new puppeteer `Browser`.
+  // `min` idle browsers are kept ready for new sessions. At most `max`
+  // browsers exist at the same time; `acquire` waits when all of them are in
+  // use. Idle browsers above `min` are closed after `idleTimeout` ms.
+  constructor(launch, { min = 1, max = 8, idleTimeout = 60000 } = {}) {
+    if (min < 0 || max < 1 || min > max)
+      throw new Error(`Invalid browser pool size: min ${min}, max ${max}`);
+
+    this._launch = launch;
+    this._min = min;
+    this._max = max;
+    this._idleTimeout = idleTimeout;
+    // Idle browsers, the most recently released last.
+    this._idle = [];
+    this._busy = new Set();
+    // Number of launches in progress.
+    this._launching = 0;
+    // Browsers launched, and browsers reset and put back for another session.
+    this._launched = 0;
+    this._recycled = 0;
+    // Resolvers of `acquire` calls waiting for a free slot.
+    this._waiters = [];
+    this._closed = false;
+    this._evictionTimer = setInterval(
+      () => this._evictIdle(),
+      Math.max(1000, Math.min(idleTimeout, 10000)));
+    this._evictionTimer.unref();
+  }
+
+  get size() {
+    return this._idle.length + this._busy.size + this._launching;
+  }
+
+  stats() {
+    return {
+      idle: this._idle.length,
+      busy: this._busy.size,
+      launching: this._launching,
+      waiting: this._waiters.length,
+    };
+  }
+
+  totals() {
+    return { launched: this._launched, recycled: this._recycled };
+  }
+
+  // Launches browsers until the pool has `min` idle ones.
+  async warmUp() {
+    const launches = [];
+    while (this._idle.length + this._launching < this._min && this.size < this._max)
+      launches.push(this._launchIdle());
+    await Promise.all(launches);
+  }
+
+  async acquire() {
+    if (this._closed)
+      throw new Error('Browser pool is closed');
+
+    while (this._idle.length) {
+      const { browser } = this._idle.pop();
+      if (browser.isConnected()) {
+        this._busy.add(browser);
+        this._replenish();
+        return browser;
+      }
+      debugBrowserPool('dropping disconnected idle browser');
+    }
+
+    if (this.size < this._max) {
+      this._launching++;
+      let browser;
+      try {
+        browser = await this._launch();
+      } catch (e) {
+        this._launching--;
+        // The slot of the failed launch is free for a waiting `acquire`.
+        this._wakeWaiter();
+        throw e;
+      }
+      this._launching--;
+      this._launched++;
+      this._busy.add(browser);
+      return browser;
+    }
+
+    debugBrowserPool('pool exhausted, waiting for a browser');
+    await new Promise(resolve => this._waiters.push(resolve));
+    return this.acquire();
+  }
+
+  // Resets the browser left by a finished session and returns it to the pool.
+  // Browsers that are disconnected or fail to reset are closed instead.
+  async release(browser) {
+    if (!this._busy.delete(browser))
+      return;
+
+    let healthy = !this._closed && browser.isConnected();
+    if (healthy) {
+      try {
+        await resetBrowser(browser);
+      } catch (e) {
+        debugBrowserPool('cannot reset browser', e);
+        healthy = false;
+      }
+    }
+    // Re-check, as the browser could crash or the pool could close while
+    // resetting.
+    if (healthy && !this._closed && browser.isConnected()) {
+      this._recycled++;
+      this._idle.push({ browser, idleSince: Date.now() });
+    } else {
+      closeBrowser(browser);
+      this._replenish();
+    }
+    this._wakeWaiter();
+  }
+
+  async close() {
+    this._closed = true;
+    clearInterval(this._evictionTimer);
+    const browsers = [...this._idle.map(entry => entry.browser), ...this._busy];
+    this._idle = [];
+    this._busy.clear();
+    await Promise.all(browsers.map(closeBrowser));
+  }
+
+  async _launchIdle() {
+    this._launching++;
+    let browser;
+    try {
+      browser = await this._launch();
+    } catch (e) {
+      debugBrowserPool('cannot launch browser', e);
+      this._launching--;
+      this._wakeWaiter();
+      return;
+    }
+    this._launching--;
+    this._launched++;
+    if (this._closed) {
+      closeBrowser(browser);
+      return;
+    }
+    this._idle.push({ browser, idleSince: Date.now() });
+    this._wakeWaiter();
+  }
+
+  // Launches browsers in the background to get back to `min` idle ones.
+  _replenish() {
+    if (this._closed)
+      return;
+    while (this._idle.length + this._launching < this._min && this.size < this._max)
+      this._launchIdle();
+  }
+
+  _wakeWaiter() {
+    const resolve = this._waiters.shift();
+    if (resolve)
+      resolve();
+  }
+
+  // Closes browsers idle for longer than `idleTimeout` while keeping `min`
+  // idle browsers, and drops idle browsers which got disconnected.
+  _evictIdle() {
+    const now = Date.now();
+    const kept = [];
+    let idleCount = this._idle.length;
+    // Oldest idle browsers are evicted first.
+    for (const entry of this._idle) {
+      if (!entry.browser.isConnected()) {
+        debugBrowserPool('dropping disconnected idle browser');
+        idleCount--;
+        continue;
+      }
+      if (idleCount > this._min && now - entry.idleSince > this._idleTimeout) {
+        idleCount--;
+        debugBrowserPool('evicting idle browser');
+        closeBrowser(entry.browser);
+        continue;
+      }
+      kept.push(entry);
+    }
+    this._idle = kept;
+    this._replenish();
+  }
+}
+
+// Brings the browser back to the state of a freshly launched one: a single
+// `about:blank` page, no incognito contexts and no listeners of the previous
+// session.
+async function resetBrowser(browser) {
+  browser.removeAllListeners();
+  browser.defaultBrowserContext().removeAllListeners();
+  await Promise.all(browser.browserContexts()
+    .filter(context => context.isIncognito())
+    .map(context => context.close()));
+
+  const pages = await browser.pages();
+  await browser.newPage();
+  await Promise.all(pages.map(page => page.close()));
+}
+
+function closeBrowser(browser) {
+  return browser.close().catch(e => {
+    debugBrowserPool('cannot close browser', e);
+  });
+}
+
+module.exports = { BrowserPool };
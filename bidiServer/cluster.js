@@ -0,0 +1,271 @@
+/**
+ * Copyright 2021 Google Inc. All rights reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+'use strict';
+
+// Runs `server.js` in `WORKERS` worker processes (one per core by default),
+// so sessions are spread over several event loops:
+//
+//   WORKERS=4 node bidiServer/cluster.js
+//
+// This primary process accepts the connections. It reads the HTTP request
+// head, then hands the socket over to the least loaded worker, which keeps the
+// connection, and so the session, for its whole lifetime. `/metrics` and
+// `/debug` are served here, merged from all the workers. Workers which exit
+// are restarted, after a delay doubling with each crash in a row. A worker
+// crashing `MAX_WORKER_RESTARTS` times in a row is given up.
+
+const cluster = require('cluster');
+const debug = require('debug');
+const net = require('net');
+const os = require('os');
+const path = require('path');
+
+const debugCluster = debug('Server:cluster');
+
+const port = process.env.PORT || 8080;
+const workerCount = Number(process.env.WORKERS || os.cpus().length);
+// Requests with a longer head are handed over without being routed.
+const maxHeadSize = 16 * 1024;
+// How long to wait for the metrics of a worker, in ms.
+const metricsTimeout = 1000;
+// Delay before restarting a worker which exited, in ms. It doubles with each
+// crash in a row, up to `maxRestartDelay`.
+const restartDelay = 1000;
+const maxRestartDelay = 30 * 1000;
+const maxRestarts = Number(process.env.MAX_WORKER_RESTARTS || 5);
+// A worker which ran that long, in ms, before exiting didn't crash in a row.
+const stableUptime = 60 * 1000;
+
+// Live worker -> { index, connections, startedAt }. `index` is stable across
+// restarts, to label the metrics of the worker.
+const workers = new Map();
+// Worker index -> number of crashes in a row.
+const crashes = new Map();
+// Indexes of the workers given up.
+const givenUp = new Set();
+let restarts = 0;
+
+// Metrics request id -> callback of the worker reply.
+const metricsRequests = new Map();
+let lastMetricsRequestId = 0;
+
+cluster.setupMaster({ exec: path.join(__dirname, 'server.js') });
+
+function forkWorker(index) {
+  const worker = cluster.fork({
+    BIDI_CLUSTER_WORKER: '1',
+    BIDI_WORKER_INDEX: String(index),
+  });
+  workers.set(worker, { index, connections: 0, startedAt: Date.now() });
+  worker.on('message', message => onWorkerMessage(worker, message));
+}
+
+cluster.on('exit', (worker, code, signal) => {
+  const { index, startedAt } = workers.get(worker);
+  workers.delete(worker);
+  const inRow = Date.now() - startedAt < stableUptime ?
+    (crashes.get(index) || 0) + 1 :
+    1;
+  crashes.set(index, inRow);
+  if (inRow > maxRestarts) {
+    console.log(`${new Date()} Worker ${index} exited (${signal || code}) ${inRow} times in a row, giving up.`);
+    givenUp.add(index);
+    if (givenUp.size === workerCount)
+      process.exit(1);
+    return;
+  }
+
+  restarts++;
+  const delay = Math.min(restartDelay * 2 ** (inRow - 1), maxRestartDelay);
+  console.log(`${new Date()} Worker ${index} exited (${signal || code}), restarting in ${delay} ms.`);
+  setTimeout(() => forkWorker(index), delay);
+});
+
+function onWorkerMessage(worker, message) {
+  const state = workers.get(worker);
+  if (message.type === 'bidi:connectionClosed') {
+    if (state)
+      state.connections--;
+  } else if (message.type === 'bidi:metrics') {
+    const callback = metricsRequests.get(message.requestId);
+    if (callback)
+      callback(message);
+  }
+}
+
+function leastLoadedWorker() {
+  let best;
+  for (const [worker, state] of workers) {
+    if (!worker.isConnected())
+      continue;
+    if (!best || state.connections < workers.get(best).connections)
+      best = worker;
+  }
+  return best;
+}
+
+const server = net.createServer({ pauseOnConnect: true }, readHead);
+
+// Reads the socket until the end of the HTTP request head.
+function readHead(socket) {
+  let head = Buffer.alloc(0);
+  const onError = e => debugCluster('connection error', e);
+  const onData = chunk => {
+    head = Buffer.concat([head, chunk]);
+    if (head.includes('\r\n\r\n') || head.length > maxHeadSize) {
+      socket.pause();
+      socket.off('data', onData);
+      socket.off('error', onError);
+      route(socket, head);
+    }
+  };
+  socket.on('data', onData);
+  socket.on('error', onError);
+  socket.resume();
+}
+
+function route(socket, head) {
+  const requestLine = head.toString('latin1', 0, head.indexOf('\r\n'));
+  const [method, target = ''] = requestLine.split(' ');
+  const pathname = target.split('?')[0];
+  if (method === 'GET' && (pathname === '/metrics' || pathname === '/debug')) {
+    serveMetrics(socket, pathname).catch(e => {
+      debugCluster('cannot serve metrics', e);
+      socket.destroy();
+    });
+    return;
+  }
+
+  const worker = leastLoadedWorker();
+  if (!worker) {
+    socket.end(httpResponse('503 Service Unavailable', 'text/plain', 'no worker available\n'));
+    return;
+  }
+  const state = workers.get(worker);
+  state.connections++;
+  worker.send({ type: 'bidi:connection', head: head.toString('base64') }, socket, e => {
+    if (!e)
+      return;
+    debugCluster('cannot hand the connection over', e);
+    state.connections--;
+    socket.destroy();
+  });
+}
+
+async function serveMetrics(socket, pathname) {
+  const replies = (await Promise.all([...workers.keys()].map(requestMetrics)))
+    .filter(reply => reply);
+  if (pathname === '/metrics') {
+    socket.end(httpResponse('200 OK', 'text/plain; version=0.0.4',
+      mergePrometheus(replies)));
+  } else {
+    socket.end(httpResponse('200 OK', 'application/json', JSON.stringify({
+      restarts,
+      workers: replies.map(reply => ({
+        worker: reply.index,
+        pid: reply.pid,
+        connections: reply.connections,
+        ...reply.snapshot,
+      })),
+    }, null, 2)));
+  }
+}
+
+// Returns the metrics of the worker, or null if it doesn't answer in time.
+function requestMetrics(worker) {
+  const { index, connections } = workers.get(worker);
+  if (!worker.isConnected())
+    return Promise.resolve(null);
+  return new Promise(resolve => {
+    const requestId = ++lastMetricsRequestId;
+    const timer = setTimeout(() => finish(null), metricsTimeout);
+    function finish(reply) {
+      clearTimeout(timer);
+      metricsRequests.delete(requestId);
+      resolve(reply);
+    }
+    metricsRequests.set(requestId, message => finish({
+      index, connections, pid: worker.process.pid, ...message }));
+    worker.send({ type: 'bidi:metrics', requestId });
+  });
+}
+
+// Merges the Prometheus texts of the workers, adding a `worker` label to
+// their samples. The samples of a metric family must follow its HELP and TYPE
+// lines, so they are grouped by family across the workers.
+function mergePrometheus(replies) {
+  // Family name -> { headers, samples }.
+  const families = new Map();
+  const family = name => {
+    if (!families.has(name))
+      families.set(name, { headers: [], samples: [] });
+    return families.get(name);
+  };
+
+  for (const { index, prometheus } of replies) {
+    let current;
+    for (const line of prometheus.split('\n')) {
+      const header = /^# (?:HELP|TYPE) (\S+)/.exec(line);
+      if (header) {
+        current = family(header[1]);
+        if (!current.headers.includes(line))
+          current.headers.push(line);
+      } else if (line && current) {
+        current.samples.push(addLabel(line, `worker="${index}"`));
+      }
+    }
+  }
+
+  const connections = family('bidi_cluster_worker_connections');
+  connections.headers.push(
+    '# HELP bidi_cluster_worker_connections Connections handed over to the worker.',
+    '# TYPE bidi_cluster_worker_connections gauge');
+  for (const state of workers.values())
+    connections.samples.push(`bidi_cluster_worker_connections{worker="${state.index}"} ${state.connections}`);
+  const restartsFamily = family('bidi_cluster_worker_restarts_total');
+  restartsFamily.headers.push(
+    '# HELP bidi_cluster_worker_restarts_total Workers restarted after exiting.',
+    '# TYPE bidi_cluster_worker_restarts_total counter');
+  restartsFamily.samples.push(`bidi_cluster_worker_restarts_total ${restarts}`);
+
+  const lines = [];
+  for (const { headers, samples } of families.values())
+    lines.push(...headers, ...samples);
+  return lines.join('\n') + '\n';
+}
+
+function addLabel(sample, label) {
+  const brace = sample.indexOf('{');
+  const space = sample.indexOf(' ');
+  if (brace !== -1 && brace < space)
+    return `${sample.slice(0, brace + 1)}${label},${sample.slice(brace + 1)}`;
+  return `${sample.slice(0, space)}{${label}}${sample.slice(space)}`;
+}
+
+function httpResponse(status, contentType, body) {
+  return `HTTP/1.1 ${status}\r\n` +
+    `Content-Type: ${contentType}\r\n` +
+    `Content-Length: ${Buffer.byteLength(body)}\r\n` +
+    'Connection: close\r\n\r\n' + body;
+}
+
+for (let index = 0; index < workerCount; index++)
+  forkWorker(index);
+
+server.listen(port, () => {
+  console.log(`${new Date()} Cluster of ${workerCount} workers is listening on port ${port}`);
+});
@@ -0,0 +1,148 @@
+/**
+ * Copyright 2021 Google Inc. All rights reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+'use strict';
+
+// Thrown when incoming data doesn't match the remote end definition.
+// `commandId` is the id of the command if it could be extracted.
+class InvalidArgumentError extends Error {
+  constructor(message, commandId) {
+    super(message);
+    this.name = 'InvalidArgumentError';
+    this.commandId = commandId;
+  }
+}
+
+function jsonType(value) {
+  if (value === null) {
+    return 'null';
+  }
+  if (Array.isArray(value)) {
+    return 'array';
+  }
+  return typeof value;
+}
+
+// Parses the data once and matches it against the remote end definition.
+// https://w3c.github.io/webdriver-bidi/#handle-an-incoming-message
+function decodeCommand(data) {
+  let parsed;
+  try {
+    parsed = JSON.parse(data);
+  } catch {
+    throw new InvalidArgumentError('Cannot parse data as JSON');
+  }
+
+  const parsedType = jsonType(parsed);
+  if (parsedType !== 'object') {
+    throw new InvalidArgumentError(`Expected JSON object but got ${parsedType}`);
+  }
+
+  // Extract amd validate id, method and params.
+  const { id, method, params } = parsed;
+  // TODO: this is bizarre per spec. The id is reported in the error response
+  // regardless of what kind of value it was.
+  const commandId = 'id' in parsed ? id : undefined;
+
+  const idType = jsonType(id);
+  if (idType !== 'number' || !Number.isInteger(id) || id < 0) {
+    // TODO: should uint64_t be the upper limit?
+    // https://tools.ietf.org/html/rfc7049#section-2.1
+    throw new InvalidArgumentError(`Expected unsigned integer but got ${idType}`, commandId);
+  }
+
+  const methodType = jsonType(method);
+  if (methodType !== 'string') {
+    throw new InvalidArgumentError(`Expected string method but got ${methodType}`, commandId);
+  }
+
+  const paramsType = jsonType(params);
+  if (paramsType !== 'object') {
+    throw new InvalidArgumentError(`Expected object params but got ${paramsType}`, commandId);
+  }
+
+  return { id, method, params };
+}
+
+// Compiles the params schema of a method into a validator function, which
+// throws `InvalidArgumentError` for invalid params. The schema maps the param
+// name to its description:
+//   type: JSON type name (see `jsonType`) or `integer`, or an array of them.
+//     Any type is accepted if omitted.
+//   required: whether the param must be present and not empty.
+//   minimum, maximum: bounds of a number.
+//   enum: array of the allowed values.
+//   items: description of the items of an array. Items are required.
+// Params not in the schema are ignored.
+function compileParamsValidator(schema) {
+  const checks = Object.entries(schema)
+    .map(([name, description]) => compileParamCheck(name, description));
+
+  return function validateParams(params, commandId) {
+    for (const check of checks) {
+      const message = check(params);
+      if (message !== undefined)
+        throw new InvalidArgumentError(message, commandId);
+    }
+  };
+}
+
+function compileParamCheck(name, description) {
+  const checkValue = compileValueCheck(description);
+  return params => checkValue(params[name], `params.${name}`);
+}
+
+// Returns a function checking a value against the description, which returns
+// the error message for the value at `path`, or undefined if it is valid.
+function compileValueCheck({ type, required = false, minimum, maximum, enum: values, items }) {
+  const types = type === undefined ? undefined : [].concat(type);
+  const expected = types && types.join(' or ');
+  const checkItem = items && compileValueCheck({ ...items, required: true });
+
+  return function checkValue(value, path) {
+    if (value === undefined || value === null || value === '') {
+      return required ? `missing ${path}` : undefined;
+    }
+    if (types) {
+      const valueType = jsonType(value);
+      const matches = types.some(t => t === valueType ||
+        (t === 'integer' && Number.isInteger(value)));
+      if (!matches)
+        return `${path} should be ${expected} but got ${valueType}`;
+    }
+    if (minimum !== undefined && !(value >= minimum))
+      return `${path} should not be less than ${minimum}`;
+    if (maximum !== undefined && !(value <= maximum))
+      return `${path} should not be greater than ${maximum}`;
+    if (values !== undefined && !values.includes(value))
+      return `${path} should be one of ${values.join(', ')} but got ${value}`;
+    if (checkItem && Array.isArray(value)) {
+      for (const [index, item] of value.entries()) {
+        const message = checkItem(item, `${path}[${index}]`);
+        if (message !== undefined)
+          return message;
+      }
+    }
+    return undefined;
+  };
+}
+
+module.exports = {
+  InvalidArgumentError,
+  compileParamsValidator,
+  decodeCommand,
+  jsonType,
+};
@@ -0,0 +1,137 @@
+/**
+ * Copyright 2021 Google Inc. All rights reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+'use strict';
+
+// Thrown when a command cannot be queued because the queues are full.
+class OverloadedError extends Error {
+  constructor(message) {
+    super(message);
+    this.name = 'OverloadedError';
+  }
+}
+
+// Runs the commands of a session. Commands of one context are queued and
+// started in FIFO order, at most `maxInFlightPerContext` at a time, while
+// commands of different contexts run in parallel, at most `maxInFlight` at a
+// time for the whole session. Commands exceeding `maxQueuedPerContext` or
+// `maxQueued` waiting commands are rejected with `OverloadedError` right away,
+// instead of piling up.
+//
+// Tasks scheduled with `holdsContext: false`, e.g. waiting for a selector,
+// start in order after the earlier commands of their context, but don't hold
+// a slot of the context while running, so they don't block later commands of
+// the context. They still count towards `maxInFlight`.
+class CommandScheduler {
+  constructor({
+    maxInFlightPerContext = 1,
+    maxInFlight = 16,
+    maxQueuedPerContext = 256,
+    maxQueued = 1024,
+  } = {}) {
+    this._maxInFlightPerContext = maxInFlightPerContext;
+    this._maxInFlight = maxInFlight;
+    this._maxQueuedPerContext = maxQueuedPerContext;
+    this._maxQueued = maxQueued;
+    // Key -> { waiting: [], running }. Contexts which started a command most
+    // recently are last, so free slots are shared fairly between contexts.
+    this._queues = new Map();
+    this._running = 0;
+    this._queued = 0;
+    this._closed = false;
+  }
+
+  // Schedules async `task` on the queue of `key`, which is usually the BiDi
+  // context of the command. Returns a promise settled with the task result.
+  schedule(key, task, { holdsContext = true } = {}) {
+    if (this._closed)
+      return Promise.reject(new Error('session closed'));
+
+    if (this._queued >= this._maxQueued)
+      return Promise.reject(new OverloadedError('too many pending commands'));
+
+    let queue = this._queues.get(key);
+    if (!queue) {
+      queue = { waiting: [], running: 0 };
+      this._queues.set(key, queue);
+    }
+    if (queue.waiting.length >= this._maxQueuedPerContext) {
+      return Promise.reject(new OverloadedError(
+        `too many pending commands for context ${key}`));
+    }
+
+    const promise = new Promise((resolve, reject) => {
+      queue.waiting.push({ task, resolve, reject, holdsContext });
+    });
+    this._queued++;
+    this._pump();
+    return promise;
+  }
+
+  // Rejects all waiting commands. Running commands are not interrupted.
+  close() {
+    this._closed = true;
+    for (const queue of this._queues.values()) {
+      for (const { reject } of queue.waiting)
+        reject(new Error('session closed'));
+      queue.waiting = [];
+    }
+    this._queued = 0;
+  }
+
+  stats() {
+    return { running: this._running, queued: this._queued };
+  }
+
+  _pump() {
+    for (const [key, queue] of this._queues) {
+      if (this._running >= this._maxInFlight)
+        return;
+      if (queue.waiting.length && queue.running < this._maxInFlightPerContext) {
+        this._start(key, queue, queue.waiting.shift());
+        // Start at most one command per context in a round, and give other
+        // contexts priority for the next free slot.
+        this._queues.delete(key);
+        this._queues.set(key, queue);
+        this._pump();
+        return;
+      }
+    }
+  }
+
+  _start(key, queue, { task, resolve, reject, holdsContext }) {
+    this._queued--;
+    this._running++;
+    if (holdsContext)
+      queue.running++;
+
+    const done = () => {
+      this._running--;
+      if (holdsContext)
+        queue.running--;
+      if (!queue.running && !queue.waiting.length && this._queues.get(key) === queue)
+        this._queues.delete(key);
+      this._pump();
+    };
+
+    Promise.resolve()
+      .then(task)
+      .then(resolve, reject)
+      .then(done);
+  }
+}
+
+module.exports = { CommandScheduler, OverloadedError };
@@ -0,0 +1,168 @@
+/**
+ * Copyright 2021 Google Inc. All rights reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+'use strict';
+
+const { AsyncLocalStorage } = require('async_hooks');
+
+// Trace of the command being processed in the current async context.
+const traceStorage = new AsyncLocalStorage();
+
+// Matches the id of a CDP response without parsing the whole message. Both
+// Chromium and the fake CDP transport put the id first.
+const responseIdRegex = /^\{"id":(\d+)[,}]/;
+
+// Pending CDP calls of finished traces are swept once this many calls are
+// pending, see `instrumentConnection`.
+const minSweepSize = 1024;
+
+function now() {
+  return Number(process.hrtime.bigint()) / 1e6;
+}
+
+// CDP cost of one BiDi command: calls, bytes and the time spent waiting for
+// CDP, i.e. while at least one of its calls was pending.
+class CommandTrace {
+  constructor() {
+    this._start = now();
+    this._cdpCalls = 0;
+    this._cdpBytesSent = 0;
+    this._cdpBytesReceived = 0;
+    this._cdpMethods = {};
+    this._cdpPending = 0;
+    this._cdpBusySince = 0;
+    this._cdpTime = 0;
+    this._serializationTime = 0;
+    this._finished = false;
+  }
+
+  // Runs async `fn` with this trace as the current one. The trace is finished
+  // when `fn` settles.
+  async run(fn) {
+    try {
+      return await traceStorage.run(this, fn);
+    } finally {
+      this._finished = true;
+    }
+  }
+
+  // Runs async `fn` and counts its duration as serialization time.
+  async measureSerialization(fn) {
+    const start = now();
+    try {
+      return await fn();
+    } finally {
+      this._serializationTime += now() - start;
+    }
+  }
+
+  toJSON() {
+    return {
+      cdpCalls: this._cdpCalls,
+      cdpBytesSent: this._cdpBytesSent,
+      cdpBytesReceived: this._cdpBytesReceived,
+      cdpMethods: this._cdpMethods,
+      cdpTimeMs: round(this._cdpTime),
+      serializationTimeMs: round(this._serializationTime),
+      totalTimeMs: round(now() - this._start),
+    };
+  }
+
+  _onCdpSent(method, bytes) {
+    this._cdpCalls++;
+    this._cdpBytesSent += bytes;
+    this._cdpMethods[method] = (this._cdpMethods[method] || 0) + 1;
+    if (!this._cdpPending++)
+      this._cdpBusySince = now();
+  }
+
+  _onCdpReceived(bytes) {
+    this._cdpBytesReceived += bytes;
+    if (!--this._cdpPending)
+      this._cdpTime += now() - this._cdpBusySince;
+  }
+}
+
+function round(ms) {
+  return Math.round(ms * 1000) / 1000;
+}
+
+// Returns the trace of the command being processed, if it is traced.
+function currentTrace() {
+  return traceStorage.getStore();
+}
+
+// Runs async `fn` and counts its duration as serialization time of the
+// current trace, if any.
+function measureSerialization(fn) {
+  const trace = currentTrace();
+  return trace ? trace.measureSerialization(fn) : fn();
+}
+
+// Attributes the CDP messages of the puppeteer `connection` to the trace of
+// the command that sent them. Costs nothing for untraced commands.
+function instrumentConnection(connection) {
+  // CDP message id -> trace waiting for the response. Calls may never be
+  // answered, e.g. when their session is detached, so the calls of finished
+  // traces are swept when the map grew, and all of them when the connection
+  // closes.
+  const pending = new Map();
+  let sweepSize = minSweepSize;
+
+  const rawSend = connection._rawSend.bind(connection);
+  connection._rawSend = message => {
+    const trace = currentTrace();
+    const id = rawSend(message);
+    if (trace) {
+      trace._onCdpSent(message.method, Buffer.byteLength(JSON.stringify(message)));
+      pending.set(id, trace);
+      if (pending.size >= sweepSize) {
+        for (const [pendingId, pendingTrace] of pending) {
+          if (pendingTrace._finished)
+            pending.delete(pendingId);
+        }
+        sweepSize = Math.max(minSweepSize, 2 * pending.size);
+      }
+    }
+    return id;
+  };
+
+  const transport = connection._transport;
+  const onmessage = transport.onmessage;
+  transport.onmessage = message => {
+    if (pending.size) {
+      const match = responseIdRegex.exec(message);
+      const trace = match && pending.get(Number(match[1]));
+      if (trace) {
+        pending.delete(Number(match[1]));
+        trace._onCdpReceived(Buffer.byteLength(message));
+      }
+    }
+    return onmessage(message);
+  };
+  const onclose = transport.onclose;
+  transport.onclose = () => {
+    pending.clear();
+    return onclose();
+  };
+}
+
+module.exports = {
+  CommandTrace,
+  currentTrace,
+  instrumentConnection,
+  measureSerialization,
+};
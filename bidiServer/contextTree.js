@@ -0,0 +1,116 @@
+/**
+ * Copyright 2021 Google Inc. All rights reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+'use strict';
+
+// Index of the browsing contexts of a session: top-level contexts and their
+// frames. It is kept up to date from target and frame events, so
+// `browsingContext.getTree` is answered from memory in time proportional to
+// the size of the returned tree.
+class ContextTree {
+  constructor() {
+    // Context id -> { context, parent, url, children }, where `children` is
+    // the set of child context ids in attach order.
+    this._nodes = new Map();
+    // Ids of the top-level contexts in creation order.
+    this._topLevel = new Set();
+  }
+
+  get size() {
+    return this._nodes.size;
+  }
+
+  get topLevelSize() {
+    return this._topLevel.size;
+  }
+
+  has(context) {
+    return this._nodes.has(context);
+  }
+
+  // Adds a top-level context. `parent` is only reported, e.g. the opener of
+  // a popup, the context is not placed under it.
+  addTopLevel(context, parent, url) {
+    if (this._nodes.has(context)) {
+      this.setUrl(context, url);
+      return;
+    }
+    this._nodes.set(context, { context, parent, url, children: new Set() });
+    this._topLevel.add(context);
+  }
+
+  // Adds a child context, e.g. a frame, under `parent`. Ignored if the parent
+  // is unknown.
+  addChild(context, parent, url) {
+    const parentNode = this._nodes.get(parent);
+    if (!parentNode)
+      return;
+    const node = this._nodes.get(context);
+    if (node) {
+      node.url = url;
+      return;
+    }
+    this._nodes.set(context, { context, parent, url, children: new Set() });
+    parentNode.children.add(context);
+  }
+
+  setUrl(context, url) {
+    const node = this._nodes.get(context);
+    if (node)
+      node.url = url;
+  }
+
+  // Removes the context and its descendants.
+  remove(context) {
+    const node = this._nodes.get(context);
+    if (!node)
+      return;
+    for (const child of [...node.children])
+      this.remove(child);
+    this._nodes.delete(context);
+    if (this._topLevel.delete(context))
+      return;
+    const parentNode = this._nodes.get(node.parent);
+    if (parentNode)
+      parentNode.children.delete(context);
+  }
+
+  // Returns the info of `root`, or of all the top-level contexts, with their
+  // descendants down to `maxDepth` levels. Beyond it `children` is null, as
+  // in https://w3c.github.io/webdriver-bidi/#type-browsingContext-Info.
+  // Throws for an unknown `root`.
+  getTree(root = undefined, maxDepth = Infinity) {
+    if (root === undefined)
+      return [...this._topLevel].map(context => this._info(context, maxDepth));
+    if (!this._nodes.has(root))
+      throw new Error('context not found');
+    return [this._info(root, maxDepth)];
+  }
+
+  _info(context, depth) {
+    const { parent, url, children } = this._nodes.get(context);
+    return {
+      context,
+      parent,
+      url,
+      children: depth > 0 ?
+        [...children].map(child => this._info(child, depth - 1)) :
+        null,
+    };
+  }
+}
+
+module.exports = { ContextTree };
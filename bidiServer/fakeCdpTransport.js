@@ -0,0 +1,874 @@
+/**
+ * Copyright 2021 Google Inc. All rights reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+'use strict';
+
+const vm = require('vm');
+const debug = require('debug');
+
+const debugFakeCdp = debug('Server:fakeCdp');
+
+// 1x1 transparent PNG returned by `Page.captureScreenshot`.
+const blankPng = 'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII=';
+
+const defaultBrowserContextId = 'FAKE_DEFAULT_CONTEXT';
+
+// Methods acknowledged with an empty result, besides enabling and disabling
+// domains and `set*` methods.
+const noopMethods = new Set([
+  'Browser.grantPermissions',
+  'Browser.resetPermissions',
+  'Input.dispatchKeyEvent',
+  'Input.dispatchMouseEvent',
+  'Input.dispatchTouchEvent',
+  'Input.insertText',
+  'Page.bringToFront',
+  'Page.stopLoading',
+  'Runtime.addBinding',
+  'Runtime.runIfWaitingForDebugger',
+  'Target.activateTarget',
+]);
+const noopMethodRegex = /\.(enable|disable|set[A-Z]\w*)$/;
+
+// Console method -> `Runtime.consoleAPICalled` type.
+const consoleTypes = {
+  log: 'log',
+  info: 'info',
+  warn: 'warning',
+  error: 'error',
+  debug: 'debug',
+  trace: 'trace',
+  dir: 'dir',
+  dirxml: 'dirxml',
+  table: 'table',
+  clear: 'clear',
+  count: 'count',
+  timeEnd: 'timeEnd',
+};
+
+// `Object.prototype.toString` tag -> `RemoteObject.subtype`.
+const objectSubtypes = {
+  Array: 'array',
+  Null: 'null',
+  RegExp: 'regexp',
+  Date: 'date',
+  Map: 'map',
+  Set: 'set',
+  WeakMap: 'weakmap',
+  WeakSet: 'weakset',
+  Error: 'error',
+  Promise: 'promise',
+  ArrayBuffer: 'arraybuffer',
+  DataView: 'dataview',
+  Generator: 'generator',
+  Int8Array: 'typedarray',
+  Uint8Array: 'typedarray',
+  Uint8ClampedArray: 'typedarray',
+  Int16Array: 'typedarray',
+  Uint16Array: 'typedarray',
+  Int32Array: 'typedarray',
+  Uint32Array: 'typedarray',
+  Float32Array: 'typedarray',
+  Float64Array: 'typedarray',
+  BigInt64Array: 'typedarray',
+  BigUint64Array: 'typedarray',
+};
+
+// Answered to the client as a CDP error response.
+class ProtocolError extends Error {
+  constructor(message, code = -32000) {
+    super(message);
+    this.name = 'ProtocolError';
+    this.code = code;
+  }
+}
+
+// Calls the function set by `FakeRealm._apply`, so it runs under the `vm`
+// timeout.
+const applyScript = new vm.Script('__fakeCdpApply()');
+
+// JavaScript realm of a fake execution context. Scripts run in a Node `vm`
+// context, created on first use, with `window`, `console` and timers but no
+// DOM. Objects sent to the client are kept in `_objects` until released.
+//
+// `vm` is no security boundary: scripts can reach the server process. A
+// synchronous run longer than `scriptTimeout` ms is interrupted, so a busy
+// loop can't stall the other sessions.
+class FakeRealm {
+  constructor(id, target, name, isDefault, emitConsole, scriptTimeout) {
+    this.id = id;
+    this.target = target;
+    this.name = name;
+    this.isDefault = isDefault;
+    this._emitConsole = emitConsole;
+    this._scriptTimeout = scriptTimeout;
+    this._context = null;
+    this._objects = new Map();
+    this._lastObjectId = 0;
+    // Script id -> `vm.Script` compiled with `Runtime.compileScript`.
+    this._scripts = new Map();
+  }
+
+  description() {
+    return {
+      id: this.id,
+      origin: '',
+      name: this.name,
+      auxData: {
+        frameId: this.target.frameId,
+        isDefault: this.isDefault,
+        type: this.isDefault ? 'default' : 'isolated',
+      },
+    };
+  }
+
+  evaluate(expression) {
+    return vm.runInContext(expression, this._getContext(),
+      { timeout: this._scriptTimeout });
+  }
+
+  // Returns the id of the compiled script.
+  compileScript(expression) {
+    const scriptId = `${this.id}.${this._scripts.size + 1}`;
+    this._scripts.set(scriptId, new vm.Script(expression));
+    return scriptId;
+  }
+
+  runScript(scriptId) {
+    const script = this._scripts.get(scriptId);
+    if (!script)
+      throw new ProtocolError('No script with given id');
+    return script.runInContext(this._getContext(), { timeout: this._scriptTimeout });
+  }
+
+  callFunction(functionDeclaration, thisObjectId, callArguments = []) {
+    const fn = vm.runInContext(`(${functionDeclaration})`, this._getContext(),
+      { timeout: this._scriptTimeout });
+    if (typeof fn !== 'function')
+      throw new ProtocolError('Given expression does not evaluate to a function');
+    const thisValue = thisObjectId === undefined ?
+      undefined : this.getObject(thisObjectId);
+    const args = callArguments.map(arg => this._fromCallArgument(arg));
+    return this._apply(() => fn.apply(thisValue, args));
+  }
+
+  // Runs `fn` from inside the `vm` context, under the script timeout.
+  _apply(fn) {
+    const context = this._getContext();
+    context.__fakeCdpApply = fn;
+    try {
+      return applyScript.runInContext(context, { timeout: this._scriptTimeout });
+    } finally {
+      delete context.__fakeCdpApply;
+    }
+  }
+
+  getObject(objectId) {
+    if (!this._objects.has(objectId))
+      throw new ProtocolError('Could not find object with given id');
+    return this._objects.get(objectId);
+  }
+
+  release(objectId) {
+    this._objects.delete(objectId);
+  }
+
+  getProperties(objectId, accessorPropertiesOnly = false) {
+    const object = this.getObject(objectId);
+    const properties = [];
+    if (object === null || (typeof object !== 'object' && typeof object !== 'function'))
+      return properties;
+
+    for (const name of Object.getOwnPropertyNames(object)) {
+      const descriptor = Object.getOwnPropertyDescriptor(object, name);
+      const isAccessor = !('value' in descriptor);
+      if (accessorPropertiesOnly && !isAccessor)
+        continue;
+      const property = {
+        name,
+        configurable: descriptor.configurable,
+        enumerable: descriptor.enumerable,
+        isOwn: true,
+      };
+      if (isAccessor) {
+        if (descriptor.get)
+          property.get = this.toRemoteObject(descriptor.get);
+        if (descriptor.set)
+          property.set = this.toRemoteObject(descriptor.set);
+      } else {
+        property.value = this.toRemoteObject(descriptor.value);
+        property.writable = descriptor.writable;
+      }
+      properties.push(property);
+    }
+    return properties;
+  }
+
+  toRemoteObject(value, returnByValue = false) {
+    switch (typeof value) {
+      case 'undefined':
+        return { type: 'undefined' };
+      case 'boolean':
+      case 'string':
+        return { type: typeof value, value };
+      case 'number':
+        if (Number.isNaN(value) || !Number.isFinite(value) || Object.is(value, -0)) {
+          const unserializableValue = Object.is(value, -0) ? '-0' : String(value);
+          return { type: 'number', unserializableValue, description: unserializableValue };
+        }
+        return { type: 'number', value, description: String(value) };
+      case 'bigint':
+        return {
+          type: 'bigint',
+          unserializableValue: `${value}n`,
+          description: `${value}n`,
+        };
+    }
+
+    if (value === null)
+      return { type: 'object', subtype: 'null', value: null };
+
+    if (returnByValue) {
+      let json;
+      try {
+        json = JSON.stringify(value);
+      } catch (e) {
+        throw new ProtocolError('Object couldn\'t be returned by value');
+      }
+      return { type: typeof value, value: json === undefined ? undefined : JSON.parse(json) };
+    }
+
+    const objectId = `${this.id}.${++this._lastObjectId}`;
+    this._objects.set(objectId, value);
+
+    if (typeof value === 'symbol')
+      return { type: 'symbol', objectId, description: value.toString() };
+    if (typeof value === 'function') {
+      return {
+        type: 'function',
+        className: 'Function',
+        objectId,
+        description: Function.prototype.toString.call(value),
+      };
+    }
+
+    const tag = Object.prototype.toString.call(value).slice(8, -1);
+    const subtype = objectSubtypes[tag];
+    const className = (value.constructor && value.constructor.name) || 'Object';
+    const remoteObject = { type: 'object', className, objectId };
+    if (subtype)
+      remoteObject.subtype = subtype;
+    remoteObject.description = describeObject(value, subtype, className);
+    return remoteObject;
+  }
+
+  _fromCallArgument(arg) {
+    if ('objectId' in arg)
+      return this.getObject(arg.objectId);
+    if ('unserializableValue' in arg) {
+      const value = arg.unserializableValue;
+      if (value.endsWith('n'))
+        return BigInt(value.slice(0, -1));
+      return value === '-0' ? -0 : Number(value);
+    }
+    return arg.value;
+  }
+
+  _getContext() {
+    if (this._context)
+      return this._context;
+
+    const console = {};
+    for (const [method, type] of Object.entries(consoleTypes))
+      console[method] = (...args) => this._emitConsole(this, type, args);
+    console.assert = (condition, ...args) => {
+      if (!condition)
+        this._emitConsole(this, 'assert', args);
+    };
+
+    this._context = vm.createContext({
+      console,
+      setTimeout,
+      clearTimeout,
+      setInterval,
+      clearInterval,
+      queueMicrotask,
+      location: { href: this.target.url },
+    });
+    vm.runInContext('globalThis.window = globalThis.self = globalThis;', this._context);
+    return this._context;
+  }
+}
+
+function describeObject(value, subtype, className) {
+  switch (subtype) {
+    case 'array':
+    case 'typedarray':
+      return `${className}(${value.length})`;
+    case 'error':
+      return value.stack || String(value);
+    case 'regexp':
+    case 'date':
+      return String(value);
+    case 'map':
+    case 'set':
+      return `${className}(${value.size})`;
+    default:
+      return className;
+  }
+}
+
+// In-process stand-in for a browser's CDP endpoint, to be passed to
+// `puppeteer.connect({ transport })`. Answers the commands puppeteer and the
+// server need for targets, pages, navigation and JavaScript evaluation:
+// `Target.*`, `Page.*`, `Runtime.evaluate`, `Runtime.compileScript`,
+// `Runtime.runScript`, `Runtime.callFunctionOn`, `Runtime.getProperties` and
+// `DOM.*`. Pages have no DOM: scripts run in a
+// Node `vm` context per execution context, and `DOM.*` answers are scripted.
+// Navigation completes right away.
+//
+// Options:
+//   latency: delay in ms before each command is answered, either a number or
+//     a map from method to delay with an optional `default`.
+//   scriptTimeout: ms after which a synchronous script run is interrupted.
+//   handlers: map from method to `(params, target, transport)` returning the
+//     result (or a promise of it), overriding or extending the built-in
+//     handlers. `target` is undefined for browser-level commands.
+class FakeCdpTransport {
+  constructor({ latency = 0, scriptTimeout = 1000, handlers = {} } = {}) {
+    this.onmessage = null;
+    this.onclose = null;
+    this._scriptTimeout = scriptTimeout;
+
+    this._latency = typeof latency === 'number' ? { default: latency } : latency;
+    this._handlers = { ...builtinHandlers, ...handlers };
+    // Target id -> target.
+    this._targets = new Map();
+    // Session id -> target.
+    this._sessions = new Map();
+    // Execution context id -> `FakeRealm`.
+    this._realms = new Map();
+    this._browserContexts = new Set();
+    this._lastId = 0;
+    this._discoverTargets = false;
+    this._closed = false;
+    this._commandCount = 0;
+
+    this._createTarget('about:blank', defaultBrowserContextId);
+  }
+
+  send(message) {
+    if (this._closed)
+      return;
+    const { id, method, params = {}, sessionId } = JSON.parse(message);
+    this._commandCount++;
+
+    const delay = method in this._latency ? this._latency[method] : (this._latency.default || 0);
+    // Answers must be asynchronous: puppeteer registers the response
+    // callback after `send` returns.
+    const answer = () => this._answer(id, method, params, sessionId);
+    if (delay > 0)
+      setTimeout(answer, delay);
+    else
+      setImmediate(answer);
+  }
+
+  close() {
+    if (this._closed)
+      return;
+    this._closed = true;
+    for (const target of [...this._targets.values()])
+      this._closeTarget(target);
+    // Puppeteer expects the close notification asynchronously.
+    setImmediate(() => {
+      if (this.onclose)
+        this.onclose();
+    });
+  }
+
+  stats() {
+    return {
+      commands: this._commandCount,
+      targets: this._targets.size,
+      realms: this._realms.size,
+    };
+  }
+
+  async _answer(id, method, params, sessionId) {
+    if (this._closed)
+      return;
+
+    let target;
+    if (sessionId !== undefined) {
+      target = this._sessions.get(sessionId);
+      if (!target) {
+        this._post({ id, sessionId, error: { code: -32001, message: 'Session with given id not found.' } });
+        return;
+      }
+    }
+
+    const handler = this._handlers[method];
+    try {
+      let result;
+      if (handler) {
+        result = await handler(params, target, this);
+      } else if (noopMethods.has(method) || noopMethodRegex.test(method)) {
+        result = {};
+      } else {
+        throw new ProtocolError(`'${method}' wasn't found`, -32601);
+      }
+      this._post({ id, sessionId, result: result || {} });
+    } catch (e) {
+      if (!(e instanceof ProtocolError))
+        debugFakeCdp(`${method} failed`, e);
+      this._post({ id, sessionId, error: { code: e.code || -32000, message: e.message } });
+    }
+  }
+
+  _post(message) {
+    if (!this._closed && this.onmessage)
+      this.onmessage(JSON.stringify(message));
+  }
+
+  _emit(method, params, target = undefined) {
+    const message = { method, params };
+    if (target) {
+      // Events of unattached targets are not reported.
+      if (!target.sessionId)
+        return;
+      message.sessionId = target.sessionId;
+    }
+    this._post(message);
+  }
+
+  _nextId(prefix) {
+    return `${prefix}_${++this._lastId}`;
+  }
+
+  _createTarget(url, browserContextId) {
+    const target = {
+      targetId: this._nextId('FAKE_TARGET'),
+      browserContextId,
+      url,
+      frameId: undefined,
+      loaderId: this._nextId('FAKE_LOADER'),
+      sessionId: undefined,
+      runtimeEnabled: false,
+      lifecycleEventsEnabled: false,
+      // Number of the last screencast frame, undefined when not screencasting.
+      screencastFrame: undefined,
+      // Isolated worlds created on every new document.
+      worldNames: new Set(),
+      realms: [],
+    };
+    target.frameId = target.targetId;
+    this._targets.set(target.targetId, target);
+    this._emitTargetEvent('Target.targetCreated', { targetInfo: this._targetInfo(target) });
+    return target;
+  }
+
+  _targetInfo(target) {
+    return {
+      targetId: target.targetId,
+      type: 'page',
+      title: target.url,
+      url: target.url,
+      attached: !!target.sessionId,
+      browserContextId: target.browserContextId,
+    };
+  }
+
+  _frame(target) {
+    return {
+      id: target.frameId,
+      loaderId: target.loaderId,
+      url: target.url,
+      securityOrigin: '',
+      mimeType: 'text/html',
+    };
+  }
+
+  _closeTarget(target) {
+    if (!this._targets.has(target.targetId))
+      return;
+    this._clearRealms(target);
+    this._targets.delete(target.targetId);
+    if (target.sessionId) {
+      this._emit('Target.detachedFromTarget', {
+        sessionId: target.sessionId,
+        targetId: target.targetId,
+      });
+      this._sessions.delete(target.sessionId);
+      target.sessionId = undefined;
+    }
+    this._emitTargetEvent('Target.targetDestroyed', { targetId: target.targetId });
+  }
+
+  // Target events are reported after `Target.setDiscoverTargets`.
+  _emitTargetEvent(method, params) {
+    if (this._discoverTargets)
+      this._emit(method, params);
+  }
+
+  _getTarget(targetId) {
+    const target = this._targets.get(targetId);
+    if (!target)
+      throw new ProtocolError('No target with given id found');
+    return target;
+  }
+
+  _createRealm(target, name, isDefault) {
+    const realm = new FakeRealm(++this._lastId, target, name, isDefault,
+      (...args) => this._emitConsole(...args), this._scriptTimeout);
+    this._realms.set(realm.id, realm);
+    target.realms.push(realm);
+    if (target.runtimeEnabled)
+      this._emit('Runtime.executionContextCreated', { context: realm.description() }, target);
+    return realm;
+  }
+
+  // Creates the realms of a new document: the main world and the isolated
+  // worlds registered with `Page.addScriptToEvaluateOnNewDocument`.
+  _createDocumentRealms(target) {
+    this._createRealm(target, '', true);
+    for (const worldName of target.worldNames)
+      this._createRealm(target, worldName, false);
+  }
+
+  _clearRealms(target) {
+    for (const realm of target.realms)
+      this._realms.delete(realm.id);
+    target.realms = [];
+  }
+
+  _getRealm(executionContextId, target) {
+    if (executionContextId === undefined) {
+      const realm = target && target.realms.find(r => r.isDefault);
+      if (realm)
+        return realm;
+    }
+    const realm = this._realms.get(executionContextId);
+    if (!realm)
+      throw new ProtocolError('Cannot find context with specified id');
+    return realm;
+  }
+
+  _getRealmOfObject(objectId) {
+    const realm = this._realms.get(Number(String(objectId).split('.')[0]));
+    if (!realm)
+      throw new ProtocolError('Could not find object with given id');
+    return realm;
+  }
+
+  _emitLifecycleEvents(target, names) {
+    if (!target.lifecycleEventsEnabled)
+      return;
+    for (const name of names) {
+      this._emit('Page.lifecycleEvent', {
+        frameId: target.frameId,
+        loaderId: target.loaderId,
+        name,
+        timestamp: Date.now() / 1000,
+      }, target);
+    }
+  }
+
+  _navigate(target, url) {
+    target.url = url;
+    target.loaderId = this._nextId('FAKE_LOADER');
+
+    this._emit('Page.frameStartedLoading', { frameId: target.frameId }, target);
+    this._emitLifecycleEvents(target, ['init']);
+    this._clearRealms(target);
+    if (target.runtimeEnabled)
+      this._emit('Runtime.executionContextsCleared', {}, target);
+    this._emit('Page.frameNavigated', { frame: this._frame(target) }, target);
+    this._createDocumentRealms(target);
+    this._emitTargetEvent('Target.targetInfoChanged', { targetInfo: this._targetInfo(target) });
+
+    this._emitLifecycleEvents(target, ['DOMContentLoaded']);
+    this._emit('Page.domContentEventFired', { timestamp: Date.now() / 1000 }, target);
+    this._emitLifecycleEvents(target, ['load']);
+    this._emit('Page.loadEventFired', { timestamp: Date.now() / 1000 }, target);
+    this._emit('Page.frameStoppedLoading', { frameId: target.frameId }, target);
+  }
+
+  _emitScreencastFrame(target) {
+    if (target.screencastFrame === undefined || !this._targets.has(target.targetId))
+      return;
+    this._emit('Page.screencastFrame', {
+      data: blankPng,
+      metadata: {
+        offsetTop: 0,
+        pageScaleFactor: 1,
+        deviceWidth: 800,
+        deviceHeight: 600,
+        scrollOffsetX: 0,
+        scrollOffsetY: 0,
+        timestamp: Date.now() / 1000,
+      },
+      sessionId: ++target.screencastFrame,
+    }, target);
+  }
+
+  _emitConsole(realm, type, args) {
+    if (!realm.target.runtimeEnabled || !this._realms.has(realm.id))
+      return;
+    this._emit('Runtime.consoleAPICalled', {
+      type,
+      args: args.map(arg => realm.toRemoteObject(arg)),
+      executionContextId: realm.id,
+      timestamp: Date.now(),
+      stackTrace: { callFrames: [] },
+    }, realm.target);
+  }
+
+  // Runs `run` in `realm` and builds the `Runtime.evaluate` or
+  // `Runtime.callFunctionOn` result.
+  async _evaluate(realm, run, { returnByValue = false, awaitPromise = false }) {
+    try {
+      let value = run();
+      if (awaitPromise && value && typeof value.then === 'function')
+        value = await value;
+      return { result: realm.toRemoteObject(value, returnByValue) };
+    } catch (e) {
+      if (e instanceof ProtocolError)
+        throw e;
+      const exception = realm.toRemoteObject(e);
+      return {
+        result: exception,
+        exceptionDetails: {
+          exceptionId: ++this._lastId,
+          text: 'Uncaught',
+          lineNumber: 0,
+          columnNumber: 0,
+          exception,
+        },
+      };
+    }
+  }
+}
+
+// Fixed description of the document, for the scripted `DOM.*` answers.
+function documentNode(target) {
+  return {
+    nodeId: 1,
+    backendNodeId: 1,
+    nodeType: 9,
+    nodeName: '#document',
+    localName: '',
+    nodeValue: '',
+    childNodeCount: 0,
+    documentURL: target.url,
+    baseURL: target.url,
+  };
+}
+
+// Method -> `(params, target, transport)` returning the result.
+const builtinHandlers = {
+  // Browser-level commands.
+  'Browser.getVersion': () => ({
+    protocolVersion: '1.3',
+    product: 'FakeChrome/1.0',
+    revision: '',
+    userAgent: 'FakeChrome/1.0',
+    jsVersion: process.versions.v8,
+  }),
+  'Browser.close': (params, target, transport) => {
+    setImmediate(() => transport.close());
+    return {};
+  },
+  'Target.getBrowserContexts': (params, target, transport) => ({
+    browserContextIds: [...transport._browserContexts],
+  }),
+  'Target.createBrowserContext': (params, target, transport) => {
+    const browserContextId = transport._nextId('FAKE_CONTEXT');
+    transport._browserContexts.add(browserContextId);
+    return { browserContextId };
+  },
+  'Target.disposeBrowserContext': (params, target, transport) => {
+    if (!transport._browserContexts.delete(params.browserContextId))
+      throw new ProtocolError('Failed to find context with id ' + params.browserContextId);
+    for (const t of [...transport._targets.values()]) {
+      if (t.browserContextId === params.browserContextId)
+        transport._closeTarget(t);
+    }
+    return {};
+  },
+  'Target.setDiscoverTargets': (params, target, transport) => {
+    const discover = !!params.discover;
+    if (discover && !transport._discoverTargets) {
+      // Existing targets are reported when discovery is enabled.
+      for (const t of transport._targets.values())
+        transport._emit('Target.targetCreated', { targetInfo: transport._targetInfo(t) });
+    }
+    transport._discoverTargets = discover;
+    return {};
+  },
+  'Target.createTarget': (params, target, transport) => {
+    const browserContextId = params.browserContextId || defaultBrowserContextId;
+    if (browserContextId !== defaultBrowserContextId &&
+      !transport._browserContexts.has(browserContextId)) {
+      throw new ProtocolError('Failed to find browser context with id ' + browserContextId);
+    }
+    const created = transport._createTarget(params.url || 'about:blank', browserContextId);
+    return { targetId: created.targetId };
+  },
+  'Target.attachToTarget': (params, target, transport) => {
+    const attached = transport._getTarget(params.targetId);
+    if (!attached.sessionId) {
+      attached.sessionId = transport._nextId('FAKE_SESSION');
+      transport._sessions.set(attached.sessionId, attached);
+      transport._createDocumentRealms(attached);
+    }
+    // The session is announced before the response, as puppeteer looks it
+    // up when the response arrives.
+    transport._emit('Target.attachedToTarget', {
+      sessionId: attached.sessionId,
+      targetInfo: transport._targetInfo(attached),
+      waitingForDebugger: false,
+    });
+    return { sessionId: attached.sessionId };
+  },
+  'Target.detachFromTarget': (params, target, transport) => {
+    const detached = transport._sessions.get(params.sessionId);
+    if (detached) {
+      transport._emit('Target.detachedFromTarget', {
+        sessionId: detached.sessionId,
+        targetId: detached.targetId,
+      });
+      transport._sessions.delete(detached.sessionId);
+      detached.sessionId = undefined;
+      detached.runtimeEnabled = false;
+    }
+    return {};
+  },
+  'Target.closeTarget': (params, target, transport) => {
+    transport._closeTarget(transport._getTarget(params.targetId));
+    return { success: true };
+  },
+
+  // Page commands.
+  'Page.getFrameTree': (params, target, transport) => ({
+    frameTree: { frame: transport._frame(target), childFrames: [] },
+  }),
+  'Page.setLifecycleEventsEnabled': (params, target, transport) => {
+    target.lifecycleEventsEnabled = !!params.enabled;
+    // The current document is loaded already.
+    transport._emitLifecycleEvents(target, ['init', 'DOMContentLoaded', 'load']);
+    return {};
+  },
+  'Page.addScriptToEvaluateOnNewDocument': (params, target, transport) => {
+    if (params.worldName)
+      target.worldNames.add(params.worldName);
+    return { identifier: transport._nextId('FAKE_SCRIPT') };
+  },
+  'Page.createIsolatedWorld': (params, target, transport) => {
+    const realm = transport._createRealm(target, params.worldName || '', false);
+    return { executionContextId: realm.id };
+  },
+  'Page.navigate': (params, target, transport) => {
+    transport._navigate(target, params.url);
+    return { frameId: target.frameId, loaderId: target.loaderId };
+  },
+  'Page.reload': (params, target, transport) => {
+    transport._navigate(target, target.url);
+    return {};
+  },
+  'Page.getNavigationHistory': (params, target) => ({
+    currentIndex: 0,
+    entries: [{ id: 0, url: target.url, userTypedURL: target.url, title: '', transitionType: 'typed' }],
+  }),
+  'Page.getLayoutMetrics': () => ({
+    layoutViewport: { pageX: 0, pageY: 0, clientWidth: 800, clientHeight: 600 },
+    visualViewport: {
+      offsetX: 0, offsetY: 0, pageX: 0, pageY: 0,
+      clientWidth: 800, clientHeight: 600, scale: 1, zoom: 1,
+    },
+    contentSize: { x: 0, y: 0, width: 800, height: 600 },
+  }),
+  'Page.captureScreenshot': () => ({ data: blankPng }),
+  // A new frame is produced as soon as the previous one is acknowledged.
+  'Page.startScreencast': (params, target, transport) => {
+    target.screencastFrame = 0;
+    setImmediate(() => transport._emitScreencastFrame(target));
+    return {};
+  },
+  'Page.screencastFrameAck': (params, target, transport) => {
+    if (target.screencastFrame === params.sessionId)
+      setImmediate(() => transport._emitScreencastFrame(target));
+    return {};
+  },
+  'Page.stopScreencast': (params, target) => {
+    target.screencastFrame = undefined;
+    return {};
+  },
+  'Page.close': (params, target, transport) => {
+    transport._closeTarget(target);
+    return {};
+  },
+  'Performance.getMetrics': () => ({ metrics: [] }),
+
+  // Runtime commands.
+  'Runtime.enable': (params, target, transport) => {
+    if (!target.runtimeEnabled) {
+      target.runtimeEnabled = true;
+      for (const realm of target.realms)
+        transport._emit('Runtime.executionContextCreated', { context: realm.description() }, target);
+    }
+    return {};
+  },
+  'Runtime.evaluate': (params, target, transport) => {
+    const realm = transport._getRealm(params.contextId, target);
+    return transport._evaluate(realm, () => realm.evaluate(params.expression), params);
+  },
+  'Runtime.compileScript': async (params, target, transport) => {
+    const realm = transport._getRealm(params.executionContextId, target);
+    const { result, exceptionDetails } = await transport._evaluate(
+      realm, () => realm.compileScript(params.expression), {});
+    return exceptionDetails ? { exceptionDetails } : { scriptId: result.value };
+  },
+  'Runtime.runScript': (params, target, transport) => {
+    const realm = transport._getRealm(params.executionContextId, target);
+    return transport._evaluate(realm, () => realm.runScript(params.scriptId), params);
+  },
+  'Runtime.callFunctionOn': (params, target, transport) => {
+    const realm = params.objectId !== undefined ?
+      transport._getRealmOfObject(params.objectId) :
+      transport._getRealm(params.executionContextId, target);
+    return transport._evaluate(realm, () => realm.callFunction(
+      params.functionDeclaration, params.objectId, params.arguments), params);
+  },
+  'Runtime.getProperties': (params, target, transport) => {
+    const realm = transport._getRealmOfObject(params.objectId);
+    return { result: realm.getProperties(params.objectId, params.accessorPropertiesOnly) };
+  },
+  'Runtime.releaseObject': (params, target, transport) => {
+    const realm = transport._realms.get(Number(String(params.objectId).split('.')[0]));
+    if (realm)
+      realm.release(params.objectId);
+    return {};
+  },
+  'Runtime.releaseObjectGroup': () => ({}),
+
+  // DOM commands. Pages have no DOM, so the answers are scripted.
+  'DOM.getDocument': (params, target) => ({ root: documentNode(target) }),
+  'DOM.describeNode': (params, target) => ({ node: documentNode(target) }),
+  'DOM.querySelector': () => ({ nodeId: 0 }),
+  'DOM.querySelectorAll': () => ({ nodeIds: [] }),
+};
+
+module.exports = { FakeCdpTransport, ProtocolError };
@@ -0,0 +1,169 @@
+/**
+ * Copyright 2021 Google Inc. All rights reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+'use strict';
+
+const debug = require('debug');
+
+const debugHandles = debug('Server:handles');
+
+// Keeps the puppeteer handles whose object ids were sent to the client, so
+// they can be used in later commands. Handles are released with
+// `Runtime.releaseObject` when the client asks for it or when the session or
+// context limit is exceeded, least recently used first. Handles of destroyed
+// execution contexts and closed browsing contexts are forgotten without any
+// CDP call, as the remote objects are already gone.
+class HandleManager {
+  constructor({ maxHandles = 20000, maxHandlesPerContext = 5000 } = {}) {
+    this._maxHandles = maxHandles;
+    this._maxHandlesPerContext = maxHandlesPerContext;
+    // All entries by object id, least recently used first.
+    this._entries = new Map();
+    // BiDi context -> entries of the context, least recently used first.
+    this._contexts = new Map();
+    // Execution context key, see `_executionContextKey` -> object ids.
+    this._executionContexts = new Map();
+  }
+
+  get size() {
+    return this._entries.size;
+  }
+
+  // Keeps the handle alive for the client. Returns its object id, or
+  // undefined for primitive values which have no object id.
+  add(context, handle) {
+    const objectId = handle._remoteObject.objectId;
+    if (!objectId)
+      return undefined;
+
+    const existing = this._entries.get(objectId);
+    if (existing) {
+      this._touch(existing);
+      return objectId;
+    }
+
+    const executionContextKey =
+      this._executionContextKey(context, handle._context._contextId);
+    const entry = { objectId, context, executionContextKey, handle };
+    this._entries.set(objectId, entry);
+    if (!this._contexts.has(context))
+      this._contexts.set(context, new Map());
+    this._contexts.get(context).set(objectId, entry);
+    if (!this._executionContexts.has(executionContextKey))
+      this._executionContexts.set(executionContextKey, new Set());
+    this._executionContexts.get(executionContextKey).add(objectId);
+
+    this._enforceLimits(context);
+    return objectId;
+  }
+
+  get(objectId) {
+    const entry = this._entries.get(objectId);
+    if (!entry)
+      return undefined;
+    this._touch(entry);
+    return entry.handle;
+  }
+
+  // Browsing context of the object, or undefined if the object id is unknown.
+  contextOf(objectId) {
+    const entry = this._entries.get(objectId);
+    return entry && entry.context;
+  }
+
+  // Releases the remote object. Returns false if the object id is unknown.
+  release(objectId) {
+    const entry = this._entries.get(objectId);
+    if (!entry)
+      return false;
+    this._forget(entry);
+    entry.handle.dispose().catch(e => {
+      debugHandles('cannot release object', objectId, e);
+    });
+    return true;
+  }
+
+  // Forgets handles of the destroyed CDP execution context of the browsing
+  // context.
+  invalidateExecutionContext(context, executionContextId) {
+    const objectIds = this._executionContexts.get(
+      this._executionContextKey(context, executionContextId));
+    if (!objectIds)
+      return;
+    for (const objectId of [...objectIds])
+      this._forget(this._entries.get(objectId));
+  }
+
+  // Forgets handles of the browsing context, e.g. after it was navigated or
+  // closed.
+  invalidateContext(context) {
+    const entries = this._contexts.get(context);
+    if (!entries)
+      return;
+    for (const entry of [...entries.values()])
+      this._forget(entry);
+  }
+
+  // Live handle counters, in total and per browsing context.
+  stats() {
+    const contexts = {};
+    for (const [context, entries] of this._contexts)
+      contexts[context] = entries.size;
+    return { total: this._entries.size, contexts };
+  }
+
+  // CDP execution context ids are only unique within a target, so they are
+  // scoped by the browsing context holding the target.
+  _executionContextKey(context, executionContextId) {
+    return `${context} ${executionContextId}`;
+  }
+
+  _touch(entry) {
+    this._entries.delete(entry.objectId);
+    this._entries.set(entry.objectId, entry);
+    const contextEntries = this._contexts.get(entry.context);
+    contextEntries.delete(entry.objectId);
+    contextEntries.set(entry.objectId, entry);
+  }
+
+  _forget(entry) {
+    this._entries.delete(entry.objectId);
+
+    const contextEntries = this._contexts.get(entry.context);
+    contextEntries.delete(entry.objectId);
+    if (!contextEntries.size)
+      this._contexts.delete(entry.context);
+
+    const objectIds = this._executionContexts.get(entry.executionContextKey);
+    objectIds.delete(entry.objectId);
+    if (!objectIds.size)
+      this._executionContexts.delete(entry.executionContextKey);
+  }
+
+  _enforceLimits(context) {
+    const contextEntries = this._contexts.get(context);
+    while (contextEntries.size > this._maxHandlesPerContext) {
+      debugHandles('context handle limit exceeded', context);
+      this.release(contextEntries.keys().next().value);
+    }
+    while (this._entries.size > this._maxHandles) {
+      debugHandles('session handle limit exceeded');
+      this.release(this._entries.keys().next().value);
+    }
+  }
+}
+
+module.exports = { HandleManager };
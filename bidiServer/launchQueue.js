@@ -0,0 +1,95 @@
+/**
+ * Copyright 2021 Google Inc. All rights reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+'use strict';
+
+// Weight of the last launch in the average launch duration.
+const durationSmoothing = 0.2;
+
+// Runs browser launches at most `maxConcurrent` at a time, in FIFO order, so
+// a burst of new sessions doesn't start all of their browsers at once. The
+// queue itself is not bounded: the browser pool never launches more than its
+// `max` browsers.
+class LaunchQueue {
+  // `onStart` is called with the seconds each launch waited in the queue.
+  constructor({ maxConcurrent = 2, onStart = () => {} } = {}) {
+    if (maxConcurrent < 1)
+      throw new Error(`Invalid launch concurrency: ${maxConcurrent}`);
+
+    this._maxConcurrent = maxConcurrent;
+    this._onStart = onStart;
+    // Launches waiting for a slot: { launch, resolve, reject, queuedAt }.
+    this._waiting = [];
+    this._running = 0;
+    // Moving average of the launch duration in ms, guessed until the first
+    // launch finished.
+    this._averageDuration = 1000;
+  }
+
+  // Runs async `launch` once a slot is free. Returns a promise settled with
+  // its result.
+  run(launch) {
+    const promise = new Promise((resolve, reject) => {
+      this._waiting.push({ launch, resolve, reject, queuedAt: process.hrtime.bigint() });
+    });
+    this._pump();
+    return promise;
+  }
+
+  // Estimated ms until a launch queued now would finish.
+  expectedWait() {
+    const rounds = Math.ceil((this._waiting.length + 1) / this._maxConcurrent);
+    return rounds * this._averageDuration;
+  }
+
+  stats() {
+    return { running: this._running, queued: this._waiting.length };
+  }
+
+  _pump() {
+    while (this._running < this._maxConcurrent && this._waiting.length)
+      this._start(this._waiting.shift());
+  }
+
+  _start({ launch, resolve, reject, queuedAt }) {
+    this._running++;
+    const startedAt = process.hrtime.bigint();
+    this._onStart(Number(startedAt - queuedAt) / 1e9);
+
+    const done = succeeded => {
+      this._running--;
+      // Failed launches often fail fast, they would skew the estimate.
+      if (succeeded) {
+        const duration = Number(process.hrtime.bigint() - startedAt) / 1e6;
+        this._averageDuration +=
+          durationSmoothing * (duration - this._averageDuration);
+      }
+      this._pump();
+    };
+
+    Promise.resolve()
+      .then(launch)
+      .then(result => {
+        done(true);
+        resolve(result);
+      }, e => {
+        done(false);
+        reject(e);
+      });
+  }
+}
+
+module.exports = { LaunchQueue };
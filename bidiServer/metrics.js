@@ -0,0 +1,297 @@
+/**
+ * Copyright 2021 Google Inc. All rights reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+'use strict';
+
+// Upper bounds of the latency histogram buckets, in seconds.
+const latencyBuckets = [
+  0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+];
+
+// Window of the event rates reported in the JSON snapshot, in seconds.
+const rateWindow = 60;
+
+class Histogram {
+  constructor(buckets = latencyBuckets) {
+    this.buckets = buckets;
+    this.counts = new Array(buckets.length).fill(0);
+    this.count = 0;
+    this.sum = 0;
+  }
+
+  observe(value) {
+    this.count++;
+    this.sum += value;
+    const index = this.buckets.findIndex(bound => value <= bound);
+    if (index !== -1)
+      this.counts[index]++;
+  }
+
+  // Cumulative counts per bucket upper bound, as Prometheus expects.
+  cumulativeCounts() {
+    let total = 0;
+    return this.counts.map(count => total += count);
+  }
+
+  // Upper bound of the bucket holding the `q` quantile.
+  quantile(q) {
+    if (!this.count)
+      return undefined;
+    const rank = q * this.count;
+    const cumulative = this.cumulativeCounts();
+    const index = cumulative.findIndex(count => count >= rank);
+    return index === -1 ? Infinity : this.buckets[index];
+  }
+}
+
+// Counts occurrences per second over the last `rateWindow` seconds.
+class RateCounter {
+  constructor() {
+    this.total = 0;
+    this._slots = new Array(rateWindow).fill(0);
+    this._slotTime = 0;
+  }
+
+  add(now = Date.now()) {
+    this._advance(now);
+    this._slots[this._slotTime % rateWindow]++;
+    this.total++;
+  }
+
+  perSecond(now = Date.now()) {
+    this._advance(now);
+    return this._slots.reduce((sum, count) => sum + count, 0) / rateWindow;
+  }
+
+  _advance(now) {
+    const time = Math.floor(now / 1000);
+    for (let t = Math.max(this._slotTime + 1, time - rateWindow + 1); t <= time; t++)
+      this._slots[t % rateWindow] = 0;
+    this._slotTime = Math.max(this._slotTime, time);
+  }
+}
+
+// Server metrics, exposed in the Prometheus text format and as a JSON
+// snapshot. Counters and histograms are updated as things happen, while gauges
+// are read from `collectGauges` when rendering, so they cost nothing between
+// scrapes.
+class Metrics {
+  // `collectGauges` returns the current gauge values, see `snapshot`.
+  constructor(collectGauges) {
+    this._collectGauges = collectGauges;
+    // BiDi method -> `Histogram` of the command latency in seconds.
+    this._commandLatency = new Map();
+    // BiDi method -> error code -> count of error responses.
+    this._commandErrors = new Map();
+    // CDP method -> count of commands sent to the browsers.
+    this._cdpCommands = new Map();
+    // Event method -> `RateCounter`.
+    this._events = new Map();
+    // Seconds browser launches waited for a launch slot.
+    this._launchWait = new Histogram();
+    // Seconds from a session request to its browser being ready.
+    this._sessionAdmission = new Histogram();
+    // Reason -> count of session requests rejected.
+    this._rejectedSessions = new Map();
+  }
+
+  observeCommand(method, seconds, error = undefined) {
+    if (!this._commandLatency.has(method))
+      this._commandLatency.set(method, new Histogram());
+    this._commandLatency.get(method).observe(seconds);
+    if (error !== undefined) {
+      if (!this._commandErrors.has(method))
+        this._commandErrors.set(method, new Map());
+      increment(this._commandErrors.get(method), error);
+    }
+  }
+
+  countCdpCommand(method) {
+    increment(this._cdpCommands, method);
+  }
+
+  countEvent(method) {
+    if (!this._events.has(method))
+      this._events.set(method, new RateCounter());
+    this._events.get(method).add();
+  }
+
+  observeLaunchWait(seconds) {
+    this._launchWait.observe(seconds);
+  }
+
+  observeSessionAdmission(seconds) {
+    this._sessionAdmission.observe(seconds);
+  }
+
+  countRejectedSession(reason) {
+    increment(this._rejectedSessions, reason);
+  }
+
+  // Counts every CDP command sent through the puppeteer `connection`, either
+  // directly or through one of its sessions.
+  instrumentConnection(connection) {
+    const rawSend = connection._rawSend.bind(connection);
+    connection._rawSend = message => {
+      this.countCdpCommand(message.method);
+      return rawSend(message);
+    };
+  }
+
+  snapshot() {
+    const commands = {};
+    for (const [method, histogram] of this._commandLatency)
+      commands[method] = summary(histogram);
+    const errors = {};
+    for (const [method, counts] of this._commandErrors)
+      errors[method] = Object.fromEntries(counts);
+    const events = {};
+    for (const [method, rate] of this._events)
+      events[method] = { total: rate.total, perSecond: rate.perSecond() };
+
+    return {
+      commands,
+      errors,
+      cdpCommands: Object.fromEntries(this._cdpCommands),
+      events,
+      launchWait: summary(this._launchWait),
+      sessionAdmission: summary(this._sessionAdmission),
+      rejectedSessions: Object.fromEntries(this._rejectedSessions),
+      ...this._collectGauges(),
+    };
+  }
+
+  // Renders the metrics in the Prometheus text exposition format.
+  prometheus() {
+    const lines = [];
+    const gauges = this._collectGauges();
+
+    lines.push('# HELP bidi_command_duration_seconds Time from receiving a BiDi command to sending its response.');
+    lines.push('# TYPE bidi_command_duration_seconds histogram');
+    for (const [method, histogram] of this._commandLatency)
+      pushHistogram(lines, 'bidi_command_duration_seconds', `method=${label(method)}`, histogram);
+
+    lines.push('# HELP bidi_command_errors_total BiDi commands answered with an error.');
+    lines.push('# TYPE bidi_command_errors_total counter');
+    for (const [method, counts] of this._commandErrors) {
+      for (const [error, count] of counts)
+        lines.push(`bidi_command_errors_total{method=${label(method)},error=${label(error)}} ${count}`);
+    }
+
+    lines.push('# HELP bidi_cdp_commands_total CDP commands sent to the browsers.');
+    lines.push('# TYPE bidi_cdp_commands_total counter');
+    for (const [method, count] of this._cdpCommands)
+      lines.push(`bidi_cdp_commands_total{method=${label(method)}} ${count}`);
+
+    lines.push('# HELP bidi_events_total Events sent to the clients.');
+    lines.push('# TYPE bidi_events_total counter');
+    for (const [method, rate] of this._events)
+      lines.push(`bidi_events_total{method=${label(method)}} ${rate.total}`);
+
+    const gaugeHelp = {
+      sessions: 'Connected sessions.',
+      contexts: 'Browsing contexts known to the sessions.',
+      handles: 'Remote object handles kept alive for the clients.',
+      commandsInFlight: 'BiDi commands being processed.',
+      commandsQueued: 'BiDi commands waiting to be processed.',
+      outboundQueued: 'Messages waiting for the client sockets to drain.',
+      pendingSessions: 'Session requests waiting for a browser.',
+    };
+    for (const [name, help] of Object.entries(gaugeHelp)) {
+      const metric = `bidi_${snakeCase(name)}`;
+      lines.push(`# HELP ${metric} ${help}`);
+      lines.push(`# TYPE ${metric} gauge`);
+      lines.push(`${metric} ${gauges[name]}`);
+    }
+
+    lines.push('# HELP bidi_outbound_dropped_events_total Events dropped because a client fell behind.');
+    lines.push('# TYPE bidi_outbound_dropped_events_total counter');
+    lines.push(`bidi_outbound_dropped_events_total ${gauges.outboundDropped}`);
+
+    lines.push('# HELP bidi_browsers Browsers of the pool by state.');
+    lines.push('# TYPE bidi_browsers gauge');
+    for (const [state, count] of Object.entries(gauges.browsers))
+      lines.push(`bidi_browsers{state=${label(state)}} ${count}`);
+
+    lines.push('# HELP bidi_browser_events_total Browsers launched, and browsers recycled for another session.');
+    lines.push('# TYPE bidi_browser_events_total counter');
+    for (const [event, count] of Object.entries(gauges.browserTotals))
+      lines.push(`bidi_browser_events_total{event=${label(event)}} ${count}`);
+
+    lines.push('# HELP bidi_browser_launches Browser launches by state.');
+    lines.push('# TYPE bidi_browser_launches gauge');
+    for (const [state, count] of Object.entries(gauges.launches))
+      lines.push(`bidi_browser_launches{state=${label(state)}} ${count}`);
+
+    lines.push('# HELP bidi_browser_launch_wait_seconds Time browser launches waited for a launch slot.');
+    lines.push('# TYPE bidi_browser_launch_wait_seconds histogram');
+    pushHistogram(lines, 'bidi_browser_launch_wait_seconds', '', this._launchWait);
+
+    lines.push('# HELP bidi_session_admission_seconds Time from a session request to its browser being ready.');
+    lines.push('# TYPE bidi_session_admission_seconds histogram');
+    pushHistogram(lines, 'bidi_session_admission_seconds', '', this._sessionAdmission);
+
+    lines.push('# HELP bidi_sessions_rejected_total Session requests rejected.');
+    lines.push('# TYPE bidi_sessions_rejected_total counter');
+    for (const [reason, count] of this._rejectedSessions)
+      lines.push(`bidi_sessions_rejected_total{reason=${label(reason)}} ${count}`);
+
+    return lines.join('\n') + '\n';
+  }
+}
+
+function summary(histogram) {
+  return {
+    count: histogram.count,
+    sumSeconds: histogram.sum,
+    p50Seconds: histogram.quantile(0.5),
+    p95Seconds: histogram.quantile(0.95),
+    p99Seconds: histogram.quantile(0.99),
+  };
+}
+
+// Renders the samples of `histogram`. `labels` are added to each sample, e.g.
+// `method="x"`.
+function pushHistogram(lines, metric, labels, histogram) {
+  const prefix = labels ? labels + ',' : '';
+  const suffix = labels ? `{${labels}}` : '';
+  const cumulative = histogram.cumulativeCounts();
+  histogram.buckets.forEach((bound, i) => {
+    lines.push(`${metric}_bucket{${prefix}le="${bound}"} ${cumulative[i]}`);
+  });
+  lines.push(`${metric}_bucket{${prefix}le="+Inf"} ${histogram.count}`);
+  lines.push(`${metric}_sum${suffix} ${histogram.sum}`);
+  lines.push(`${metric}_count${suffix} ${histogram.count}`);
+}
+
+function increment(map, key) {
+  map.set(key, (map.get(key) || 0) + 1);
+}
+
+// Quotes a label value, escaping as the Prometheus text format specifies.
+function label(value) {
+  const escaped = String(value)
+    .replace(/\\/g, '\\\\')
+    .replace(/"/g, '\\"')
+    .replace(/\n/g, '\\n');
+  return `"${escaped}"`;
+}
+
+function snakeCase(name) {
+  return name.replace(/[A-Z]/g, c => '_' + c.toLowerCase());
+}
+
+module.exports = { Metrics };
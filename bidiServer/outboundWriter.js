@@ -0,0 +1,205 @@
+/**
+ * Copyright 2021 Google Inc. All rights reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+'use strict';
+
+const debug = require('debug');
+
+const debugBiDiSend = debug('BiDi:SEND ►');
+
+// Writes messages to the client connection. Messages are queued while the
+// socket buffer is full and written once it drains, so a slow client doesn't
+// make the server buffer without limit: when `maxQueued` messages are waiting,
+// new events are dropped and counted. Responses are never dropped.
+//
+// In batching mode, events sent within `window` ms are packed into one frame
+// holding a JSON array of the event messages. A response flushes the pending
+// batch first, so the client sees messages in the order they were sent.
+//
+// Large command results can be sent as binary frames with `sendChunks`. Each
+// frame starts with a 13 bytes header: the command id (uint64 big endian),
+// the chunk index (uint32 big endian) and flags (uint8, `lastChunkFlag` set on
+// the last chunk), followed by the chunk data.
+const chunkHeaderSize = 13;
+const lastChunkFlag = 1;
+
+class OutboundWriter {
+  constructor(connection, { maxQueued = 10000 } = {}) {
+    this._connection = connection;
+    this._maxQueued = maxQueued;
+    // Messages or batches waiting for the socket to drain.
+    this._queue = [];
+    this._batch = [];
+    this._batchWindow = 0;
+    this._maxBatchSize = 0;
+    this._batchTimer = null;
+    this._sent = 0;
+    this._dropped = 0;
+    this._batches = 0;
+    // Callbacks of `drained` promises.
+    this._drainWaiters = [];
+
+    connection.on('drain', () => this._flush());
+    connection.on('close', () => this._clear());
+  }
+
+  // Enables batching of events when `window` is positive, disables it
+  // otherwise. A batch is written when `window` ms passed since its first
+  // event or when it has `maxSize` events.
+  setBatching(window, maxSize = 100) {
+    this._flushBatch();
+    this._batchWindow = window > 0 ? window : 0;
+    this._maxBatchSize = maxSize;
+  }
+
+  send(message) {
+    if (!this._connection.connected)
+      return;
+
+    // Events have `method`, responses have `id`.
+    const isEvent = message.method !== undefined;
+    if (!isEvent) {
+      this._flushBatch();
+      this._enqueue(message, 1, false);
+      return;
+    }
+
+    if (!this._batchWindow) {
+      this._enqueue(message, 1, true);
+      return;
+    }
+
+    this._batch.push(message);
+    if (this._batch.length >= this._maxBatchSize) {
+      this._flushBatch();
+    } else if (!this._batchTimer) {
+      this._batchTimer = setTimeout(() => this._flushBatch(), this._batchWindow);
+    }
+  }
+
+  // Sends `data` (a Buffer) in binary frames of at most `chunkSize` bytes,
+  // tied to `commandId`. Waits for each frame to be written before sending the
+  // next one, so other messages are not blocked behind the whole data. Returns
+  // the number of frames sent.
+  async sendChunks(commandId, data, chunkSize) {
+    const count = Math.max(1, Math.ceil(data.length / chunkSize));
+    for (let index = 0; index < count; index++) {
+      if (!this._connection.connected)
+        break;
+      const chunk = data.subarray(index * chunkSize, (index + 1) * chunkSize);
+      const frame = Buffer.allocUnsafe(chunkHeaderSize + chunk.length);
+      // 64-bit command id as 2 words, as ids are not bigger than 2^53.
+      frame.writeUInt32BE(Math.floor(commandId / 0x100000000), 0);
+      frame.writeUInt32BE(commandId % 0x100000000, 4);
+      frame.writeUInt32BE(index, 8);
+      frame.writeUInt8(index === count - 1 ? lastChunkFlag : 0, 12);
+      chunk.copy(frame, chunkHeaderSize);
+
+      this._flushBatch();
+      this._enqueue(frame, 1, false);
+      await this.drained();
+    }
+    return count;
+  }
+
+  // Resolves once all the queued frames are written to the socket and its
+  // buffer is not full, or the connection is closed.
+  drained() {
+    if (this._isDrained())
+      return Promise.resolve();
+    return new Promise(resolve => this._drainWaiters.push(resolve));
+  }
+
+  stats() {
+    return {
+      queued: this._queue.length + this._batch.length,
+      sent: this._sent,
+      dropped: this._dropped,
+      batches: this._batches,
+      paused: !!this._connection.outputBufferFull,
+    };
+  }
+
+  _flushBatch() {
+    if (this._batchTimer) {
+      clearTimeout(this._batchTimer);
+      this._batchTimer = null;
+    }
+    if (!this._batch.length)
+      return;
+
+    const batch = this._batch;
+    this._batch = [];
+    if (batch.length === 1) {
+      this._enqueue(batch[0], 1, true);
+    } else {
+      this._batches++;
+      this._enqueue(batch, batch.length, true);
+    }
+  }
+
+  // `frame` is a message or an array of events holding `count` messages.
+  _enqueue(frame, count, droppable) {
+    if (droppable && this._queue.length >= this._maxQueued) {
+      this._dropped += count;
+      return;
+    }
+    this._queue.push({ frame, count });
+    this._flush();
+  }
+
+  // Writes queued frames until the socket buffer is full. Resumed by the
+  // connection `drain` event.
+  _flush() {
+    while (this._queue.length && this._connection.connected &&
+      !this._connection.outputBufferFull) {
+      const { frame, count } = this._queue.shift();
+      if (Buffer.isBuffer(frame)) {
+        debugBiDiSend(`<binary frame of ${frame.length} bytes>`);
+        this._connection.sendBytes(frame);
+      } else {
+        const messageStr = JSON.stringify(frame);
+        debugBiDiSend(messageStr);
+        this._connection.sendUTF(messageStr);
+      }
+      this._sent += count;
+    }
+    if (this._isDrained())
+      this._resolveDrainWaiters();
+  }
+
+  _isDrained() {
+    return !this._connection.connected ||
+      (!this._queue.length && !this._connection.outputBufferFull);
+  }
+
+  _resolveDrainWaiters() {
+    const waiters = this._drainWaiters;
+    this._drainWaiters = [];
+    waiters.forEach(resolve => resolve());
+  }
+
+  _clear() {
+    if (this._batchTimer)
+      clearTimeout(this._batchTimer);
+    this._batchTimer = null;
+    this._batch = [];
+    this._queue = [];
+    this._resolveDrainWaiters();
+  }
+}
+
+module.exports = { OutboundWriter };
@@ -0,0 +1,119 @@
+/**
+ * Copyright 2021 Google Inc. All rights reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+'use strict';
+
+const debug = require('debug');
+
+const debugScreencast = debug('Server:screencast');
+
+// Streams the frames of a page from CDP `Page.startScreencast` to `sendFrame`.
+//
+// The browser produces the next frame only after the previous one is
+// acknowledged, so acknowledgements are delayed to produce at most `maxFps`
+// frames per second (0 means no limit). Frames are handed to `sendFrame` only
+// once `writer` drained: when the client falls behind, a newer frame replaces
+// the one waiting and the stale one is dropped, instead of being queued.
+class Screencast {
+  constructor(client, writer, sendFrame, {
+    format = 'jpeg',
+    quality,
+    maxWidth,
+    maxHeight,
+    maxFps = 10,
+  } = {}) {
+    this._client = client;
+    this._writer = writer;
+    this._sendFrame = sendFrame;
+    this._startParams = { format, quality, maxWidth, maxHeight };
+    this._frameInterval = maxFps > 0 ? 1000 / maxFps : 0;
+    this._nextAckTime = 0;
+    this._ackTimers = new Set();
+    this._pending = null;
+    this._delivering = false;
+    this._stopped = false;
+    this._frames = 0;
+    this._dropped = 0;
+    this._onFrame = this._onFrame.bind(this);
+  }
+
+  async start() {
+    this._client.on('Page.screencastFrame', this._onFrame);
+    await this._client.send('Page.startScreencast', this._startParams);
+  }
+
+  // Stops the screencast. Returns the numbers of sent and dropped frames.
+  async stop() {
+    if (!this._stopped) {
+      this._stopped = true;
+      this._client.off('Page.screencastFrame', this._onFrame);
+      for (const timer of this._ackTimers)
+        clearTimeout(timer);
+      this._ackTimers.clear();
+      this._pending = null;
+      await this._client.send('Page.stopScreencast').catch(e => {
+        debugScreencast("cannot stop screencast", e);
+      });
+    }
+    return this.stats();
+  }
+
+  stats() {
+    return { frames: this._frames, dropped: this._dropped };
+  }
+
+  _onFrame(frame) {
+    if (this._stopped)
+      return;
+    if (this._pending)
+      this._dropped++;
+    this._pending = frame;
+    this._scheduleAck(frame.sessionId);
+    this._deliver();
+  }
+
+  _scheduleAck(sessionId) {
+    const now = Date.now();
+    const delay = Math.max(0, this._nextAckTime - now);
+    this._nextAckTime = now + delay + this._frameInterval;
+    const timer = setTimeout(() => {
+      this._ackTimers.delete(timer);
+      this._client.send('Page.screencastFrameAck', { sessionId }).catch(e => {
+        debugScreencast("cannot acknowledge frame", e);
+      });
+    }, delay);
+    this._ackTimers.add(timer);
+  }
+
+  async _deliver() {
+    if (this._delivering)
+      return;
+    this._delivering = true;
+    while (this._pending && !this._stopped) {
+      await this._writer.drained();
+      // The latest frame, which may have replaced the one waiting.
+      const frame = this._pending;
+      this._pending = null;
+      if (!frame || this._stopped)
+        break;
+      this._frames++;
+      this._sendFrame(frame, this._frames);
+    }
+    this._delivering = false;
+  }
+}
+
+module.exports = { Screencast };
@@ -0,0 +1,273 @@
+/**
+ * Copyright 2021 Google Inc. All rights reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+'use strict';
+
+const crypto = require('crypto');
+const debug = require('debug');
+const { createJSHandle } = require('../lib/cjs/puppeteer/common/JSHandle.js');
+const { helper } = require('../lib/cjs/puppeteer/common/helper.js');
+
+const debugScripts = debug('Server:scripts');
+
+// Hides the cached scripts from stack traces, as puppeteer does.
+const sourceUrl = '__puppeteer_evaluation_script__';
+
+function hashSource(source) {
+  return crypto.createHash('sha1').update(source).digest('hex');
+}
+
+// Runs in the page. Calls the cached function with the `this` of an uncached
+// `Runtime.callFunctionOn`.
+function callCachedFunction(fn, ...args) {
+  return fn.apply(this, args);
+}
+
+// Returns the function source as a valid expression, accepting method
+// shorthands like puppeteer does.
+function toFunctionExpression(source) {
+  for (const candidate of [source, prefixFunctionKeyword(source)]) {
+    try {
+      new Function('(' + candidate + ')');
+      return candidate;
+    } catch {
+      // Try the next candidate.
+    }
+  }
+  throw new Error('Passed function is not well-serializable!');
+}
+
+function prefixFunctionKeyword(source) {
+  return source.startsWith('async ') ?
+    'async function ' + source.substring('async '.length) :
+    'function ' + source;
+}
+
+// Compiles the scripts evaluated repeatedly in the session once per CDP
+// execution context, instead of sending and parsing their source on every
+// evaluation. The first evaluation of a script in an execution context runs it
+// like puppeteer does, in one round trip with a user gesture. From the second
+// one, expressions are compiled with `Runtime.compileScript` and run by script
+// id, and functions are evaluated into a function object, which later calls
+// target with `Runtime.callFunctionOn`. `Runtime.runScript` has no user
+// gesture.
+//
+// Entries of destroyed execution contexts are forgotten, as the compiled
+// scripts and function objects are gone with them. At most `maxEntries` are
+// kept, least recently used first out. Compiled scripts can't be released
+// before their execution context is destroyed, so at most
+// `maxScriptsPerExecutionContext` are compiled in each; other expressions are
+// then evaluated without caching.
+//
+// Functions can also be registered once by the client and called later by
+// their id, which stays valid across navigations.
+class ScriptCache {
+  constructor({ maxEntries = 256, maxScriptsPerExecutionContext = 64 } = {}) {
+    this._maxEntries = maxEntries;
+    this._maxScriptsPerExecutionContext = maxScriptsPerExecutionContext;
+    // Key (see `_key`) -> entry, least recently used first. Entries hold a
+    // promise, so concurrent evaluations compile the script once.
+    this._entries = new Map();
+    // Key -> { context, executionContextId } of the scripts evaluated once
+    // without caching, least recently used first.
+    this._seen = new Map();
+    // Execution context key -> number of scripts compiled in it.
+    this._compiledScripts = new Map();
+    // Function id -> source of a registered function.
+    this._functions = new Map();
+    this._hits = 0;
+    this._misses = 0;
+  }
+
+  // Registers the function source. Returns its id for `getFunction`.
+  registerFunction(source) {
+    const functionId = hashSource(source);
+    this._functions.set(functionId, toFunctionExpression(source));
+    return functionId;
+  }
+
+  // Returns the source of a registered function, or undefined.
+  getFunction(functionId) {
+    return this._functions.get(functionId);
+  }
+
+  // Evaluates the `expression` in the puppeteer execution context, like
+  // `ExecutionContext.evaluateHandle` with a string.
+  async evaluate(context, executionContext, expression) {
+    const client = executionContext._client;
+    const executionContextId = executionContext._contextId;
+    const key = this._key(context, executionContextId, 'script', expression);
+    if (!this._entries.has(key) && !this._shouldCompile(key, context, executionContextId)) {
+      this._misses++;
+      return await executionContext.evaluateHandle(expression);
+    }
+
+    const scriptId = await this._getOrCreate(
+      key,
+      { context, executionContextId },
+      async () => {
+        const { scriptId, exceptionDetails } = await client.send('Runtime.compileScript', {
+          expression,
+          sourceURL: sourceUrl,
+          persistScript: true,
+          executionContextId,
+        }).catch(rewriteError);
+        if (exceptionDetails)
+          throw new Error('Evaluation failed: ' + helper.getExceptionMessage(exceptionDetails));
+        return scriptId;
+      });
+
+    const { result, exceptionDetails } = await client.send('Runtime.runScript', {
+      scriptId,
+      executionContextId,
+      awaitPromise: true,
+    }).catch(rewriteError);
+    if (exceptionDetails)
+      throw new Error('Evaluation failed: ' + helper.getExceptionMessage(exceptionDetails));
+    return createJSHandle(executionContext, result);
+  }
+
+  // Calls the function `source` with `args` in the puppeteer execution
+  // context, like `ExecutionContext.evaluateHandle` with a function.
+  async callFunction(context, executionContext, source, args) {
+    const executionContextId = executionContext._contextId;
+    const key = this._key(context, executionContextId, 'function', source);
+    // Puppeteer takes a string without arguments for an expression, so calls
+    // without arguments always go through the function object.
+    if (args.length && !this._entries.has(key) &&
+        !this._isRepeated(key, context, executionContextId)) {
+      this._misses++;
+      return await executionContext.evaluateHandle(toFunctionExpression(source), ...args);
+    }
+
+    const functionHandle = await this._getOrCreate(
+      key,
+      { context, executionContextId },
+      () => executionContext.evaluateHandle(`(${toFunctionExpression(source)})`),
+      handle => handle.dispose());
+    return await executionContext.evaluateHandle(callCachedFunction, functionHandle, ...args);
+  }
+
+  // Forgets entries of the destroyed CDP execution context.
+  invalidateExecutionContext(context, executionContextId) {
+    this._forgetWhere(entry =>
+      entry.context === context && entry.executionContextId === executionContextId);
+    this._compiledScripts.delete(this._executionContextKey(context, executionContextId));
+  }
+
+  // Forgets entries of the browsing context, e.g. after it was navigated or
+  // closed.
+  invalidateContext(context) {
+    this._forgetWhere(entry => entry.context === context);
+    for (const key of this._compiledScripts.keys()) {
+      if (key.startsWith(`${context} `))
+        this._compiledScripts.delete(key);
+    }
+  }
+
+  stats() {
+    return {
+      entries: this._entries.size,
+      functions: this._functions.size,
+      hits: this._hits,
+      misses: this._misses,
+    };
+  }
+
+  _key(context, executionContextId, kind, source) {
+    return `${this._executionContextKey(context, executionContextId)} ${kind} ${hashSource(source)}`;
+  }
+
+  _executionContextKey(context, executionContextId) {
+    return `${context} ${executionContextId}`;
+  }
+
+  // Returns whether the script of `key` was evaluated before in the execution
+  // context, and remembers it otherwise.
+  _isRepeated(key, context, executionContextId) {
+    if (this._seen.delete(key))
+      return true;
+    this._seen.set(key, { context, executionContextId });
+    while (this._seen.size > this._maxEntries)
+      this._seen.delete(this._seen.keys().next().value);
+    return false;
+  }
+
+  // Returns whether to compile the expression of `key`: once it is repeated,
+  // and while the execution context has room for another compiled script.
+  _shouldCompile(key, context, executionContextId) {
+    if (!this._isRepeated(key, context, executionContextId))
+      return false;
+    const executionContextKey = this._executionContextKey(context, executionContextId);
+    const compiled = this._compiledScripts.get(executionContextKey) || 0;
+    if (compiled >= this._maxScriptsPerExecutionContext)
+      return false;
+    this._compiledScripts.set(executionContextKey, compiled + 1);
+    return true;
+  }
+
+  async _getOrCreate(key, { context, executionContextId }, create, release = undefined) {
+    const existing = this._entries.get(key);
+    if (existing) {
+      this._hits++;
+      this._entries.delete(key);
+      this._entries.set(key, existing);
+      return await existing.value;
+    }
+
+    this._misses++;
+    const entry = { context, executionContextId, value: create(), release };
+    this._entries.set(key, entry);
+    entry.value.catch(() => {
+      if (this._entries.get(key) === entry)
+        this._entries.delete(key);
+    });
+    while (this._entries.size > this._maxEntries)
+      this._evict(this._entries.keys().next().value);
+    return await entry.value;
+  }
+
+  _evict(key) {
+    const entry = this._entries.get(key);
+    this._entries.delete(key);
+    if (!entry.release)
+      return;
+    entry.value.then(entry.release).catch(e => {
+      debugScripts('cannot release cached script', e);
+    });
+  }
+
+  _forgetWhere(predicate) {
+    for (const [key, entry] of this._entries) {
+      if (predicate(entry))
+        this._entries.delete(key);
+    }
+    for (const [key, entry] of this._seen) {
+      if (predicate(entry))
+        this._seen.delete(key);
+    }
+  }
+}
+
+// Reports the context destruction like puppeteer does.
+function rewriteError(error) {
+  if (error.message.endsWith('Cannot find context with specified id') ||
+      error.message.endsWith('Inspected target navigated or closed'))
+    throw new Error('Execution context was destroyed, most likely because of a navigation.');
+  throw error;
+}
+
+module.exports = { ScriptCache };
@@ -18,25 +18,202 @@
 
 const puppeteer = require('..');
 const WebSocketServer = require('websocket').server;
+const { BrowserPool } = require('./browserPool.js');
+const commandTrace = require('./commandTrace.js');
+const { FakeCdpTransport } = require('./fakeCdpTransport.js');
+const { HandleManager } = require('./handleManager.js');
+const { LaunchQueue } = require('./launchQueue.js');
+const { Metrics } = require('./metrics.js');
+const { CommandScheduler, OverloadedError } = require('./commandScheduler.js');
+const { ContextTree } = require('./contextTree.js');
+const { OutboundWriter } = require('./outboundWriter.js');
+const { Screencast } = require('./screencast.js');
+const { ScriptCache } = require('./scriptCache.js');
+const { SharedBrowsers } = require('./sharedBrowsers.js');
+const { SubscriptionManager } = require('./subscriptionManager.js');
+const {
+  InvalidArgumentError,
+  compileParamsValidator,
+  decodeCommand,
+  jsonType,
+} = require('./commandDecoder.js');
 
 const http = require('http');
 const debug = require('debug');
 
 const debugBiDiServer = debug('Server:console ◀');
-const debugBiDiSend = debug('BiDi:SEND ►');
 const debugBiDiReceive = debug('BiDi:RECV ◀');
 
 const port = process.env.PORT || 8080;
 const headless = process.env.HEADLESS !== 'false';
 
+const metrics = new Metrics(collectGauges);
+
+// `chromium` launches real browsers. `fake` connects puppeteer to an
+// in-process fake CDP endpoint instead, to measure the server's own overhead
+// and run load tests without Chromium.
+const browserBackend = process.env.BROWSER_BACKEND || 'chromium';
+const fakeCdpLatency = Number(process.env.FAKE_CDP_LATENCY || 0);
+const fakeCdpScriptTimeout = Number(process.env.FAKE_CDP_SCRIPT_TIMEOUT || 1000);
+
+async function launchBrowser() {
+  const browser = browserBackend === 'fake' ?
+    await puppeteer.connect({
+      transport: new FakeCdpTransport({
+        latency: fakeCdpLatency,
+        scriptTimeout: fakeCdpScriptTimeout,
+      }),
+    }) :
+    await puppeteer.launch({ headless });
+  metrics.instrumentConnection(browser._connection);
+  commandTrace.instrumentConnection(browser._connection);
+  return browser;
+}
+
+// Browsers are launched a few at a time, however many sessions are waiting.
+const launchQueue = new LaunchQueue({
+  maxConcurrent: Number(process.env.MAX_CONCURRENT_LAUNCHES || 2),
+  onStart: seconds => metrics.observeLaunchWait(seconds),
+});
+
+// Pre-launched browsers handed to new sessions.
+const browserPool = new BrowserPool(
+  () => launchQueue.run(launchBrowser),
+  {
+    min: Number(process.env.BROWSER_POOL_MIN || 1),
+    max: Number(process.env.BROWSER_POOL_MAX || 8),
+    idleTimeout: Number(process.env.BROWSER_POOL_IDLE_TIMEOUT || 60000),
+  });
+browserPool.warmUp();
+
+// `browser` gives each session a whole browser of the pool. `context` shares
+// browsers between sessions instead, so one browser serves many sessions.
+// Either way, the targets of a session live in its own incognito browser
+// context.
+const sessionIsolation = process.env.SESSION_ISOLATION || 'browser';
+const sharedBrowsers = new SharedBrowsers(browserPool, {
+  maxSessionsPerBrowser: Number(process.env.MAX_SESSIONS_PER_BROWSER || 32),
+});
+
+// Session requests waiting for a browser beyond `maxPending` are rejected
+// right away, and the ones waiting longer than `timeout` ms are rejected then.
+const admissionLimits = {
+  maxPending: Number(process.env.MAX_PENDING_SESSIONS || 16),
+  timeout: Number(process.env.SESSION_ADMISSION_TIMEOUT || 60000),
+};
+
+const sessionLimits = {
+  maxContexts: Number(process.env.MAX_CONTEXTS_PER_SESSION || 100),
+};
+
+const handleLimits = {
+  maxHandles: Number(process.env.MAX_HANDLES_PER_SESSION || 20000),
+  maxHandlesPerContext: Number(process.env.MAX_HANDLES_PER_CONTEXT || 5000),
+};
+
+const scriptCacheLimits = {
+  maxEntries: Number(process.env.SCRIPT_CACHE_MAX_ENTRIES || 256),
+  maxScriptsPerExecutionContext:
+    Number(process.env.SCRIPT_CACHE_MAX_SCRIPTS_PER_DOCUMENT || 64),
+};
+
+const schedulerLimits = {
+  maxInFlightPerContext: Number(process.env.MAX_COMMANDS_IN_FLIGHT_PER_CONTEXT || 1),
+  maxInFlight: Number(process.env.MAX_COMMANDS_IN_FLIGHT || 16),
+  maxQueuedPerContext: Number(process.env.MAX_QUEUED_COMMANDS_PER_CONTEXT || 256),
+  maxQueued: Number(process.env.MAX_QUEUED_COMMANDS || 1024),
+};
+
+const outboundLimits = {
+  maxQueued: Number(process.env.MAX_QUEUED_OUTBOUND_MESSAGES || 10000),
+};
+
+// Connection -> `OutboundWriter`.
+const outboundWriters = new WeakMap();
+
+// Connected sessions.
+const sessions = new Set();
+// Session requests waiting for a browser.
+let pendingSessions = 0;
+// Events dropped by the writers of closed sessions.
+let closedSessionsDroppedEvents = 0;
+
+function collectGauges() {
+  const gauges = {
+    sessions: sessions.size,
+    contexts: 0,
+    handles: 0,
+    commandsInFlight: 0,
+    commandsQueued: 0,
+    outboundQueued: 0,
+    outboundDropped: closedSessionsDroppedEvents,
+    pendingSessions,
+    browsers: browserPool.stats(),
+    browserTotals: browserPool.totals(),
+    launches: launchQueue.stats(),
+    // Browsers hosting sessions in incognito contexts, see `sessionIsolation`.
+    sharedBrowsers: sharedBrowsers.stats(),
+  };
+  for (const session of sessions) {
+    const scheduler = session.scheduler.stats();
+    const writer = session.writer.stats();
+    gauges.contexts += session.contexts.size;
+    gauges.handles += session.handles.stats().total;
+    gauges.commandsInFlight += scheduler.running;
+    gauges.commandsQueued += scheduler.queued;
+    gauges.outboundQueued += writer.queued;
+    gauges.outboundDropped += writer.dropped;
+  }
+  return gauges;
+}
+
 const server = http.createServer(function (request, response) {
   console.log((new Date()) + ' Received request for ' + request.url);
+  // Not parsed as a URL, which throws for targets such as `//`.
+  const pathname = request.url.split('?')[0];
+  if (request.method === 'GET' && pathname === '/metrics') {
+    response.writeHead(200, { 'Content-Type': 'text/plain; version=0.0.4' });
+    response.end(metrics.prometheus());
+    return;
+  }
+  if (request.method === 'GET' && pathname === '/debug') {
+    response.writeHead(200, { 'Content-Type': 'application/json' });
+    response.end(JSON.stringify(metrics.snapshot(), null, 2));
+    return;
+  }
   response.writeHead(404);
   response.end();
 });
-server.listen(port, function () {
-  console.log(`${new Date()} Server is listening on port ${port}`);
-});
+// In cluster mode the primary process accepts the connections and hands them
+// over to the workers, see `cluster.js`.
+if (process.env.BIDI_CLUSTER_WORKER === '1') {
+  process.on('message', handleClusterMessage);
+  // Don't outlive the primary.
+  process.on('disconnect', () => process.exit(0));
+  console.log(`${new Date()} Worker ${process.env.BIDI_WORKER_INDEX} is ready`);
+} else {
+  server.listen(port, function () {
+    console.log(`${new Date()} Server is listening on port ${port}`);
+  });
+}
+
+function handleClusterMessage(message, socket) {
+  if (message.type === 'bidi:connection') {
+    // Lets the primary place new sessions on the least loaded worker.
+    socket.once('close', () => process.send({ type: 'bidi:connectionClosed' }));
+    server.emit('connection', socket);
+    // The primary already read the request head.
+    socket.emit('data', Buffer.from(message.head, 'base64'));
+    socket.resume();
+  } else if (message.type === 'bidi:metrics') {
+    process.send({
+      type: 'bidi:metrics',
+      requestId: message.requestId,
+      prometheus: metrics.prometheus(),
+      snapshot: metrics.snapshot(),
+    });
+  }
+}
 
 const wsServer = new WebSocketServer({
   httpServer: server,
@@ -50,166 +227,214 @@ const wsServer = new WebSocketServer({
 
 const ignoredTargetTypes = ['browser', 'iframe', 'service_worker'];
 
+// Scripts of the fake backend run in the server process, which `vm` doesn't
+// protect, so it is only meant for local tests and only serves local clients.
+function isLocalAddress(address) {
+  return /^(127\.|::1$|::ffff:127\.)/.test(address || '');
+}
+
 function originIsAllowed(origin) {
   debugBiDiServer("origin: ", origin);
   return true;
 }
 
-function jsonType(value) {
-  if (value === null) {
-    return 'null';
-  }
-  if (Array.isArray(value)) {
-    return 'array';
-  }
-  return typeof value;
+function getErrorResponse(commandId, errorCode, errorMessage) {
+  return {
+    id: commandId,
+    error: errorCode,
+    message: errorMessage,
+    // TODO: optional stacktrace field.
+  };
 }
 
-function matchData(data) {
-  let parsed;
-  try {
-    parsed = JSON.parse(data);
-  } catch {
-    throw new Error('Cannot parse data as JSON');
-  }
-
-  const parsedType = jsonType(parsed);
-  if (parsedType !== 'object') {
-    throw new Error(`Expected JSON object but got ${parsedType}`);
-  }
-
-  // Extract amd validate id, method and params.
-  const { id, method, params } = parsed;
-
-  const idType = jsonType(id);
-  if (idType !== 'number' || !Number.isInteger(id) || id < 0) {
-    // TODO: should uint64_t be the upper limit?
-    // https://tools.ietf.org/html/rfc7049#section-2.1
-    throw new Error(`Expected unsigned integer but got ${idType}`);
-  }
+function sendClientMessage(message, connection) {
+  if (message.method !== undefined)
+    metrics.countEvent(message.method);
+  outboundWriters.get(connection).send(message);
+}
 
-  const methodType = jsonType(method);
-  if (methodType !== 'string') {
-    throw new Error(`Expected string method but got ${methodType}`);
+// Size of the binary frames of screenshots sent with `encoding: "binary"`.
+const screenshotChunkSize = 64 * 1024;
+
+// Maximum number of nested values serialized concurrently for one object.
+const serializationConcurrency = 16;
+
+// Maps `items` with the async `fn`, running at most `limit` calls at once.
+// Results keep the order of `items`.
+async function mapConcurrently(items, limit, fn) {
+  const results = new Array(items.length);
+  let next = 0;
+  async function worker() {
+    while (next < items.length) {
+      const index = next++;
+      results[index] = await fn(items[index], index);
+    }
   }
+  const workers = [];
+  for (let i = 0; i < Math.min(limit, items.length); i++)
+    workers.push(worker());
+  await Promise.all(workers);
+  return results;
+}
 
-  const paramsType = jsonType(params);
-  if (paramsType !== 'object') {
-    throw new Error(`Expected object params but got ${paramsType}`);
+// Runs in the page. Walks the arrays and plain objects reachable from `root`
+// up to `maxDepth` in one pass. Returns an array whose first item is the
+// JSON-encoded map from the index of each walked container to its
+// `[key, valueIndex]` pairs, followed by all the values the map references
+// (`root` itself has index 1). The remote objects of all those values are
+// then fetched with a single `Runtime.getProperties` call.
+function describeObjectGraph(root, maxDepth) {
+  const values = [];
+  const containers = {};
+
+  function isContainer(value) {
+    if (Array.isArray(value))
+      return true;
+    if (value === null || typeof value !== 'object')
+      return false;
+    const prototype = Object.getPrototypeOf(value);
+    return prototype === Object.prototype || prototype === null;
   }
 
-  return { id, method, params };
-}
-
-function getErrorResponse(plainCommandData, errorCode, errorMessage) {
-  // TODO: this is bizarre per spec. We reparse the payload and
-  // extract the ID, regardless of what kind of value it was.
-  let commandId = undefined;
-  try {
-    const commandData = JSON.parse(plainCommandData);
-    if (jsonType(commandData) === 'object' && 'id' in commandData) {
-      commandId = commandData.id;
+  function visit(value, depth) {
+    const index = values.push(value);
+    if (depth > 0 && isContainer(value)) {
+      const properties = [];
+      // Same properties as `Runtime.getProperties` reports: own enumerable
+      // data properties. Getters are not invoked.
+      for (const key of Object.keys(value)) {
+        const descriptor = Object.getOwnPropertyDescriptor(value, key);
+        if ('value' in descriptor)
+          properties.push([key, visit(descriptor.value, depth - 1)]);
+      }
+      containers[index] = properties;
     }
-  } catch { }
+    return index;
+  }
 
-  return {
-    id: commandId,
-    error: errorCode,
-    message: errorMessage,
-    // TODO: optional stacktrace field.
-  };
+  visit(root, maxDepth);
+  return [JSON.stringify(containers), ...values];
 }
 
-function sendClientMessage(message, connection) {
-  const messageStr = JSON.stringify(message);
-  debugBiDiSend(messageStr);
-  connection.sendUTF(messageStr);
+// Prefetches the properties of the containers reachable from `objectHandle` up
+// to `depth` with a constant number of CDP round trips. Returns a map from the
+// container handle to its `[key, valueHandle]` pairs.
+async function prefetchObjectGraph(objectHandle, depth) {
+  const graphHandle = await objectHandle.evaluateHandle(describeObjectGraph, depth);
+  const items = await graphHandle.getProperties();
+  graphHandle.dispose();
+
+  const containers = JSON.parse(items.get('0')._remoteObject.value);
+  // `root` is already referenced by `objectHandle`.
+  items.get('1').dispose();
+  const graph = new Map();
+  for (const [index, properties] of Object.entries(containers)) {
+    const handle = index === '1' ? objectHandle : items.get(index);
+    graph.set(handle, properties.map(
+      ([key, valueIndex]) => [key, items.get(String(valueIndex))]));
+  }
+  return graph;
 }
 
-async function collectProperties(obj, page, depth, mapKeyValueToProperties) {
+async function collectProperties(obj, realm, depth, mapKeyValueToProperties, graph) {
   debugBiDiServer("collectProperties, depth", depth);
 
   if (depth <= 0)
     return undefined;
-  // `Runtime.getProperties` under the hood.
-  const properties = await obj.getProperties();
 
-  const result = [];
-  for (const [key, value] of properties.entries()) {
-    // Get keys as remote values.
-    const serialisedNestedValue = await serializeForBiDi(value, page, depth - 1);
-    result.push(mapKeyValueToProperties(key, serialisedNestedValue));
+  let properties = graph ? graph.get(obj) : undefined;
+  // A single `Runtime.getProperties` is enough when nested values are not
+  // serialized deeper. Otherwise the whole graph is collected in one pass.
+  if (!properties && depth > 1) {
+    graph = await prefetchObjectGraph(obj, depth);
+    properties = graph.get(obj);
   }
-  return result;
+  if (!properties) {
+    // `Runtime.getProperties` under the hood.
+    properties = [...(await obj.getProperties()).entries()];
+  }
+
+  return await mapConcurrently(properties, serializationConcurrency,
+    async ([key, value]) => mapKeyValueToProperties(
+      key, await serializeForBiDi(value, realm, depth - 1, graph)));
 }
 
-async function getNodeValue(nodeHandle, page, depth) {
-  if (depth <= 0)
-    return undefined;
+// Runs in the page. Describes the subtree of `root` up to `maxDepth` in one
+// pass, so the result is a consistent snapshot of the DOM. Returns an array
+// whose first item is the JSON-encoded description, followed by the nodes the
+// description references by index. Object ids of all those nodes are then
+// fetched with a single `Runtime.getProperties` call.
+function describeNodeSubtree(root, maxDepth) {
+  const nodes = [];
 
-  const nodeAggregatedInfo = await page.evaluate(function (node) {
+  function describe(node, depth) {
     return {
       nodeType: node.nodeType,
       nodeValue: node.nodeValue,
       localName: node.localName,
       namespaceURI: node.namespaceURI,
       childNodeCount: node.childElementCount,
-      attributesCount: node.attributes.length,
-      hasShadowRoot: !!node.shadowRoot,
+      children: Array.from(node.children || [],
+        child => reference(child, depth - 1)),
+      attributes: Array.from(node.attributes || [],
+        attribute => ({ name: attribute.name, value: attribute.value })),
+      shadowRoot: node.shadowRoot ?
+        reference(node.shadowRoot, depth - 1) : undefined,
     };
-  }, nodeHandle);
-
-  // TODO: replace with using `DOM.describeNode`:
-  // https://chromedevtools.github.io/devtools-protocol/tot/DOM/#method-describeNode
-  // Race condition is possible.
-  const children = [];
-  for (let i = 0; i < nodeAggregatedInfo.childNodeCount; i++) {
-    const childInfo = await page.evaluateHandle(
-      (node, i) => node.children[i],
-      nodeHandle, i);
-    // TODO: consider adding `description`.
-    children.push(await serializeForBiDi(childInfo, page, depth - 1));
-  }
-
-  // TODO: replace with using `DOM.getAttributes`:
-  // https://chromedevtools.github.io/devtools-protocol/tot/DOM/#method-getAttributes
-  // Race condition is possible.
-  const attributes = [];
-  for (let i = 0; i < nodeAggregatedInfo.attributesCount; i++) {
-    const attributeInfo = await page.evaluate(
-      (node, i) => ({
-        name: node.attributes[i].name,
-        value: node.attributes[i].value
-      }),
-      nodeHandle, i);
-    attributes.push(attributeInfo);
   }
 
-  // Race condition is possible.
-  let shadowRoot = undefined;
-  if (nodeAggregatedInfo.hasShadowRoot) {
-    const shadowRootHandle = await page.evaluateHandle(node => node.shadowRoot, nodeHandle);
-    shadowRoot = await serializeForBiDi(shadowRootHandle, page, depth - 1);
+  function reference(node, depth) {
+    return {
+      // Index in the returned array.
+      index: nodes.push(node),
+      value: depth > 0 ? describe(node, depth) : undefined,
+    };
   }
 
-  return {
-    nodeType: nodeAggregatedInfo.nodeType,
-    nodeValue: nodeAggregatedInfo.nodeValue,
-    localName: nodeAggregatedInfo.localName,
-    namespaceURI: nodeAggregatedInfo.namespaceURI,
-    childNodeCount: nodeAggregatedInfo.childNodeCount,
-    children,
-    attributes,
-    shadowRoot
-  };
+  return [JSON.stringify(describe(root, maxDepth)), ...nodes];
 }
 
-async function serializeForBiDi(objectHandle, page, depth = 1) {
+// Serializes the node subtree with a constant number of CDP round trips:
+// `Runtime.callFunctionOn` for the in-page walk, `Runtime.getProperties` for
+// the referenced nodes and `Runtime.releaseObject` for the walk result.
+async function getNodeValue(nodeHandle, realm, depth) {
+  if (depth <= 0)
+    return undefined;
+
+  const subtreeHandle = await nodeHandle.evaluateHandle(describeNodeSubtree, depth);
+  const items = await subtreeHandle.getProperties();
+  subtreeHandle.dispose();
+
+  function toNodeValue(description) {
+    const children = description.children.map(toRemoteValue);
+    const shadowRoot = description.shadowRoot ?
+      toRemoteValue(description.shadowRoot) : undefined;
+    return { ...description, children, shadowRoot };
+  }
+
+  function toRemoteValue(reference) {
+    // TODO: consider adding `description`.
+    return {
+      type: "node",
+      objectId: realm.handles.add(realm.context, items.get(String(reference.index))),
+      value: reference.value ? toNodeValue(reference.value) : undefined
+    };
+  }
+
+  return toNodeValue(JSON.parse(items.get('0')._remoteObject.value));
+}
+
+// `realm` is the value returned by `getRealm`. `graph` optionally holds
+// container properties already prefetched by `prefetchObjectGraph`.
+async function serializeForBiDi(objectHandle, realm, depth = 1, graph = undefined) {
   // TODO: implement proper serialisation according to
   // https://w3c.github.io/webdriver-bidi/#data-types-remote-value.
 
   debugBiDiServer("serializeForBiDi", objectHandle, "depth", depth);
 
+  // Keep the handle alive while the client can refer to its `objectId`.
+  realm.handles.add(realm.context, objectHandle);
+
   if (objectHandle._remoteObject) {
     if (objectHandle._remoteObject.type === 'undefined') {
       return { type: "undefined" };
@@ -300,7 +525,7 @@ async function serializeForBiDi(objectHandle, page, depth = 1) {
         };
       }
       if (objectHandle._remoteObject.subtype === "node") {
-        const value = await getNodeValue(objectHandle, page, depth);
+        const value = await getNodeValue(objectHandle, realm, depth);
         return {
           type: "node",
           objectId: objectHandle._remoteObject.objectId,
@@ -314,7 +539,7 @@ async function serializeForBiDi(objectHandle, page, depth = 1) {
         };
       }
       if (objectHandle._remoteObject.className === "Array") {
-        const value = await collectProperties(objectHandle, page, depth, (key, value) => value);
+        const value = await collectProperties(objectHandle, realm, depth, (key, value) => value, graph);
         return {
           type: "array",
           objectId: objectHandle._remoteObject.objectId,
@@ -322,7 +547,7 @@ async function serializeForBiDi(objectHandle, page, depth = 1) {
         };
       }
       if (objectHandle._remoteObject.className === "Object") {
-        const value = await collectProperties(objectHandle, page, depth, (key, value) => [key, value]);
+        const value = await collectProperties(objectHandle, realm, depth, (key, value) => [key, value], graph);
         return {
           type: "object",
           objectId: objectHandle._remoteObject.objectId,
@@ -340,14 +565,32 @@ async function serializeForBiDi(objectHandle, page, depth = 1) {
 }
 
 // https://w3c.github.io/webdriver-bidi/#respond-with-an-error
-function respondWithError(connection, plainCommandData, errorCode, errorMessage) {
-  const errorResponse = getErrorResponse(plainCommandData, errorCode, errorMessage);
+function respondWithError(connection, commandId, errorCode, errorMessage) {
+  const errorResponse = getErrorResponse(commandId, errorCode, errorMessage);
   sendClientMessage(errorResponse, connection);
 }
 
 wsServer.on('request', async function (request) {
   // A session per connection.
-  const session = { pages: {}, elements: {} };
+  const session = {
+    pages: {},
+    // Index of the contexts for `browsingContext.getTree`.
+    contexts: new ContextTree(),
+    // Page ID -> promise of exposing the page of a new target, see
+    // `trackTarget`.
+    pageRegistrations: new Map(),
+    handles: new HandleManager(handleLimits),
+    scripts: new ScriptCache(scriptCacheLimits),
+    scheduler: new CommandScheduler(schedulerLimits),
+    subscriptions: new SubscriptionManager(),
+    // Page ID -> listeners of the page toggled by subscriptions.
+    pageListeners: {},
+    browserListeners: {},
+    // Page ID -> running `Screencast`.
+    screencasts: new Map(),
+    // Whether responses carry the CDP cost of their command.
+    tracing: false,
+  };
 
   if (!originIsAllowed(request.origin)) {
     // Make sure we only accept requests from an allowed origin.
@@ -356,34 +599,64 @@ wsServer.on('request', async function (request) {
     return;
   }
 
-  // Launch browser for the newly created session.
+  if (browserBackend === 'fake' && !isLocalAddress(request.remoteAddress)) {
+    request.reject(403, 'the fake backend only accepts local connections');
+    console.log((new Date()) + ' Connection from ' + request.remoteAddress + ' rejected.');
+    return;
+  }
+
+  if (pendingSessions >= admissionLimits.maxPending) {
+    rejectSession(request, 'saturated', 'too many pending sessions');
+    return;
+  }
+
+  // Take a warm browser for the newly created session.
+  const requestedAt = process.hrtime.bigint();
+  pendingSessions++;
   try {
-    session.browser = await puppeteer.launch({ headless });
+    await admitSession(session);
   } catch (e) {
-    console.log((new Date()) + ' Cannot launch browser.', e);
+    console.log((new Date()) + ' Cannot get a browser for the session.', e);
+    if (e instanceof OverloadedError)
+      rejectSession(request, 'timeout', e.message);
+    else
+      rejectSession(request, 'error', 'cannot launch browser');
     return;
+  } finally {
+    pendingSessions--;
   }
+  metrics.observeSessionAdmission(
+    Number(process.hrtime.bigint() - requestedAt) / 1e9);
 
   try {
     session.connection = request.accept();
+    session.writer = new OutboundWriter(session.connection, outboundLimits);
+    outboundWriters.set(session.connection, session.writer);
+    sessions.add(session);
   } catch (e) {
     console.log((new Date()) + ' Cannot accept connection from origin', request.origin, e);
-    session.browser.close();
+    releaseBrowser(session);
     return;
   }
 
   session.connection.on('close', function () {
     console.log((new Date()) + ' Peer ' + session.connection.remoteAddress + ' disconnected.');
-    session.browser.close();
+    sessions.delete(session);
+    closedSessionsDroppedEvents += session.writer.stats().dropped;
+    session.scheduler.close();
+    for (const screencast of session.screencasts.values())
+      screencast.stop();
+    session.screencasts.clear();
+    releaseBrowser(session);
   });
 
-  addBrowserEventHandlers(session.browser, session.connection);
+  addBrowserEventHandlers(session);
 
   // https://w3c.github.io/webdriver-bidi/#handle-an-incoming-message
   session.connection.on('message', function (message) {
     // 1. If |type| is not text, return.
     if (message.type !== 'utf8') {
-      respondWithError(session.connection, {}, "invalid argument", `not supported type (${message.type})`, `type (${message.type}) is not supported`);
+      respondWithError(session.connection, undefined, "invalid argument", `not supported type (${message.type})`);
       return;
     }
 
@@ -397,22 +670,70 @@ wsServer.on('request', async function (request) {
 
     // 3. Match |data| against the remote end definition.
     let commandData;
+    let command;
     try {
-      commandData = matchData(plainCommandData);
+      commandData = decodeCommand(plainCommandData);
+      command = commands.get(commandData.method);
+      if (command)
+        command.validateParams(commandData.params, commandData.id);
     } catch (e) {
-      respondWithError(session.connection, plainCommandData, "invalid argument", e.message);
+      if (!(e instanceof InvalidArgumentError))
+        throw e;
+      respondWithError(session.connection, e.commandId, "invalid argument", e.message);
+      return;
+    }
+
+    if (!command) {
+      respondWithError(session.connection, commandData.id, "unknown error", 'unknown command');
       return;
     }
 
-    processCommand(commandData, session).then(response => {
+    // Commands of one context run in order, commands of different contexts
+    // run in parallel.
+    const receivedAt = process.hrtime.bigint();
+    const observe = error => metrics.observeCommand(commandData.method,
+      Number(process.hrtime.bigint() - receivedAt) / 1e9, error);
+    let trace = null;
+    session.scheduler.schedule(
+      getCommandContext(commandData),
+      () => {
+        if (!session.tracing)
+          return processCommand(command, commandData, session);
+        trace = new commandTrace.CommandTrace();
+        return trace.run(() => processCommand(command, commandData, session));
+      },
+      { holdsContext: command.holdsContext }
+    ).then(response => {
+      observe();
+      if (trace)
+        response["PROTO.trace"] = trace.toJSON();
       sendClientMessage(response, session.connection)
     }).catch(e => {
       debugBiDiServer("exception", e);
-      respondWithError(session.connection, plainCommandData, "unknown error", e.message);
+      const errorCode = getErrorCode(e);
+      observe(errorCode);
+      respondWithError(session.connection, commandData.id, errorCode, e.message);
     });
   });
 });
 
+function getErrorCode(error) {
+  if (error instanceof BatchStepError)
+    return error.errorCode;
+  if (error instanceof OverloadedError)
+    return "PROTO.overloaded";
+  if (error instanceof InvalidArgumentError)
+    return "invalid argument";
+  return "unknown error";
+}
+
+// Returns the context the command is scheduled on. Commands without a context
+// share a session-wide queue.
+function getCommandContext(commandData) {
+  const context = commandData.params.context;
+  return typeof context === 'string' ? context : null;
+}
+
 function getPage(commandData, session) {
   // Puppeteer `page` corresponds to BiDi `context`.
   const pageID = commandData.context;
@@ -423,98 +744,504 @@ function getPage(commandData, session) {
   return session.pages[pageID];
 }
 
-function getElement(commandData, session) {
-  // Puppeteer `element` corresponds to BiDi `object`.
-  const elementID = commandData.objectId;
-
-  if (!(elementID in session.elements)) {
-    throw new Error('context not found');
+// `name` is the objectId param in errors.
+function getElement(commandData, session, context = commandData.context,
+                    name = 'params.objectId') {
+  const objectContext = session.handles.contextOf(commandData.objectId);
+  if (objectContext === undefined) {
+    throw new Error('object not found');
+  }
+  // The command is queued on its context only, it must not act on another
+  // page.
+  if (objectContext !== context) {
+    throw new InvalidArgumentError(`${name} should be an object of params.context`);
   }
 
-  return session.elements[elementID];
+  // Puppeteer `element` corresponds to BiDi `object`.
+  return session.handles.get(commandData.objectId);
 }
 
 function getElementID(element) {
   return element._remoteObject.objectId;
 }
 
-async function processCommand(commandData, session) {
+// Remote values of the context are kept alive in the session.
+function getRealm(pageID, session) {
+  return { context: pageID, handles: session.handles };
+}
+
+// Params schemas of the commands, see `compileParamsValidator`.
+// How text is sent to an element:
+// * `keys`: keyDown, keypress, input and keyUp events for each character,
+//   each awaited before the next one, like a user typing. Honors
+//   `options.delay`.
+// * `pipelined`: the same events, sent without awaiting each of them. They
+//   keep their order, but all of them are sent before the page handles the
+//   first one, so a key handler can't, e.g., move the focus before the later
+//   keys are sent. `options.delay` is not supported.
+// * `insertText`: the whole text with a single `Input.insertText`, like an IME
+//   commit. The page only gets `beforeinput` and `input` events, with no
+//   keyboard events, and `\n` or `\t` don't submit forms or move the focus.
+const typeModes = ['keys', 'pipelined', 'insertText'];
+
+const contextParam = { type: 'string', required: true };
+const objectIdParam = { type: 'string', required: true };
+
+const commandDefinitions = {
+  // Commands specified in https://w3c.github.io/webdriver-bidi.
+  "session.status": {
+    process: process_session_status,
+    params: {},
+  },
+  "session.subscribe": {
+    process: process_session_subscribe,
+    params: {
+      events: { type: 'array', required: true },
+      contexts: { type: 'array', items: { type: 'string' } },
+    },
+  },
+  "session.unsubscribe": {
+    process: process_session_unsubscribe,
+    params: {
+      events: { type: 'array', required: true },
+      contexts: { type: 'array', items: { type: 'string' } },
+    },
+  },
+  "browsingContext.getTree": {
+    process: process_browsingContext_getTree,
+    params: {
+      // Context whose subtree is returned instead of all the top-level ones.
+      root: { type: 'string' },
+      // Levels of `children` returned. Unlimited if omitted.
+      maxDepth: { type: 'integer', minimum: 0 },
+    },
+  },
+
+  // Prototype commands not specified in https://w3c.github.io/webdriver-bidi.
+  "PROTO.browsingContext.createContext": {
+    process: process_PROTO_browsingContext_createContext,
+    params: {
+      url: { type: 'string' },
+    },
+  },
+  "PROTO.browsingContext.navigate": {
+    process: process_PROTO_browsingContext_navigate,
+    params: {
+      context: contextParam,
+      url: { type: 'string', required: true },
+      waitUntil: { type: ['string', 'array'] },
+      referer: { type: 'string' },
+      // Numeric strings are accepted as well.
+      timeout: { type: ['number', 'string'] },
+    },
+  },
+  "PROTO.browsingContext.selectElement": {
+    process: process_PROTO_browsingContext_selectElement,
+    params: {
+      context: contextParam,
+      selector: { type: 'string', required: true },
+    },
+  },
+  "PROTO.browsingContext.waitForSelector": {
+    process: process_PROTO_browsingContext_waitForSelector,
+    // Later commands of the context, e.g. the ones making the selector
+    // match, don't wait for the selector.
+    holdsContext: false,
+    params: {
+      context: contextParam,
+      // A selector, or an array of selectors waited for at once.
+      selector: { type: ['string', 'array'], required: true },
+      // With an array of selectors, whether to wait for all of them instead
+      // of the first one.
+      all: { type: 'boolean' },
+      visible: { type: 'boolean' },
+      hidden: { type: 'boolean' },
+      timeout: { type: 'number', minimum: 0 },
+    },
+  },
+  "PROTO.browsingContext.click": {
+    process: process_PROTO_browsingContext_click,
+    params: {
+      context: contextParam,
+      objectId: objectIdParam,
+    },
+  },
+  "PROTO.browsingContext.type": {
+    process: process_PROTO_browsingContext_type,
+    params: {
+      context: contextParam,
+      objectId: objectIdParam,
+      text: { type: 'string', required: true },
+      options: { type: 'object' },
+      // See `typeModes`, `keys` by default.
+      mode: { type: 'string', enum: typeModes },
+    },
+  },
+  "PROTO.browsingContext.fill": {
+    process: process_PROTO_browsingContext_fill,
+    params: {
+      context: contextParam,
+      // `{ objectId, text }` or `{ selector, text }` items, filled in order.
+      fields: { type: 'array', required: true },
+      // See `typeModes`, `insertText` by default.
+      mode: { type: 'string', enum: typeModes },
+      // Whether the text replaces the current value of the fields.
+      clear: { type: 'boolean' },
+    },
+  },
+  "PROTO.page.evaluate": {
+    process: process_PROTO_page_evaluate,
+    params: {
+      context: contextParam,
+      function: { type: 'string', required: true },
+      args: { type: 'array' },
+      // TODO: replace with serialisation MaxDepth logic after it's specified:
+      // https://github.com/w3c/webdriver-bidi/issues/86
+      maxDepth: { type: 'integer', minimum: 0 },
+    },
+  },
+  "PROTO.session.setEventBatching": {
+    process: process_PROTO_session_setEventBatching,
+    params: {
+      // Milliseconds. Batching is disabled if 0.
+      window: { type: 'number', required: true, minimum: 0 },
+      maxSize: { type: 'integer', minimum: 1 },
+    },
+  },
+  "PROTO.page.registerFunction": {
+    process: process_PROTO_page_registerFunction,
+    params: {
+      function: { type: 'string', required: true },
+    },
+  },
+  "PROTO.page.callFunction": {
+    process: process_PROTO_page_callFunction,
+    params: {
+      context: contextParam,
+      // Returned by `PROTO.page.registerFunction`.
+      functionId: { type: 'string', required: true },
+      args: { type: 'array' },
+      maxDepth: { type: 'integer', minimum: 0 },
+    },
+  },
+  "PROTO.session.batch": {
+    process: process_PROTO_session_batch,
+    params: {
+      // Steps run in order: `{method, params}` objects.
+      commands: { type: 'array', required: true },
+      // Context the batch is scheduled on, and the default `context` of the
+      // steps.
+      context: { type: 'string' },
+    },
+  },
+  "PROTO.session.setTracing": {
+    process: process_PROTO_session_setTracing,
+    params: {
+      enabled: { type: 'boolean', required: true },
+    },
+  },
+  "PROTO.page.releaseObjects": {
+    process: process_PROTO_page_releaseObjects,
+    params: {
+      objectIds: { type: 'array', required: true },
+    },
+  },
+
+  // Debug commands not specified in https://w3c.github.io/webdriver-bidi.
+  "PROTO.browsingContext.startScreencast": {
+    process: process_PROTO_browsingContext_startScreencast,
+    params: {
+      context: contextParam,
+      format: { type: 'string', enum: ['jpeg', 'png'] },
+      quality: { type: 'integer', minimum: 0, maximum: 100 },
+      maxWidth: { type: 'integer', minimum: 1 },
+      maxHeight: { type: 'integer', minimum: 1 },
+      maxFps: { type: 'number', minimum: 0 },
+    },
+  },
+  "PROTO.browsingContext.stopScreencast": {
+    process: process_PROTO_browsingContext_stopScreencast,
+    params: {
+      context: contextParam,
+    },
+  },
+  "DEBUG.Page.close": {
+    process: process_DEBUG_Page_close,
+    params: {
+      context: contextParam,
+    },
+  },
+  "DEBUG.Page.screenshot": {
+    process: process_DEBUG_Page_screenshot,
+    params: {
+      context: contextParam,
+      format: { type: 'string', enum: ['png', 'jpeg'] },
+      quality: { type: 'integer', minimum: 0, maximum: 100 },
+      clip: { type: 'object' },
+      fullPage: { type: 'boolean' },
+      encoding: { type: 'string', enum: ['base64', 'binary'] },
+      chunkSize: { type: 'integer', minimum: 1 },
+    },
+  },
+  "DEBUG.Session.handles": {
+    process: process_DEBUG_Session_handles,
+    params: {},
+  },
+  "DEBUG.Session.scripts": {
+    process: process_DEBUG_Session_scripts,
+    params: {},
+  },
+  "DEBUG.Session.outbound": {
+    process: process_DEBUG_Session_outbound,
+    params: {},
+  },
+};
+
+// Method -> { process, validateParams }, with params validators compiled once.
+const commands = new Map(Object.entries(commandDefinitions).map(
+  ([method, { process, params, holdsContext = true }]) =>
+    [method, { process, holdsContext, validateParams: compileParamsValidator(params) }]));
+
+async function processCommand(command, commandData, session) {
   const response = {};
   response.id = commandData.id;
 
-  switch (commandData.method) {
-    // Commands specified in https://w3c.github.io/webdriver-bidi.
-    case "session.status":
-      return await process_session_status(commandData.params, session, response);
-    case "browsingContext.getTree":
-      return await process_browsingContext_getTree(commandData.params, session, response);
-
-    // Prototype commands not specified in https://w3c.github.io/webdriver-bidi.
-    case "PROTO.browsingContext.createContext":
-      return await process_PROTO_browsingContext_createContext(commandData.params, session, response);
-    case "PROTO.browsingContext.navigate":
-      return await process_PROTO_browsingContext_navigate(commandData.params, session, response);
-    case "PROTO.browsingContext.selectElement":
-      return await process_PROTO_browsingContext_selectElement(commandData.params, session, response);
-    case "PROTO.browsingContext.waitForSelector":
-      return await process_PROTO_browsingContext_waitForSelector(commandData.params, session, response);
-    case "PROTO.browsingContext.click":
-      return await process_PROTO_browsingContext_click(commandData.params, session, response);
-    case "PROTO.browsingContext.type":
-      return await process_PROTO_browsingContext_type(commandData.params, session, response);
-    case "PROTO.page.evaluate":
-      return await process_PROTO_page_evaluate(commandData.params, session, response);
-
-    // Debug commands not specified in https://w3c.github.io/webdriver-bidi.
-    case "DEBUG.Page.close":
-      return await process_DEBUG_Page_close(commandData.params, session, response);
-    case "DEBUG.Page.screenshot":
-      return await process_DEBUG_Page_screenshot(commandData.params, session, response);
-    default:
-      throw new Error('unknown command');
-  }
-}
-
-function addPageEventHandlers(pageID, page, connection) {
-  // Events specified in https://w3c.github.io/webdriver-bidi should be here.
+  return await command.process(commandData.params, session, response);
+}
 
-  // Debug events not specified in https://w3c.github.io/webdriver-bidi.
-  page.on('load', () => {
-    handle_pageLoad_event(pageID, connection)
+// Adds the target to the context tree and exposes its page to the client.
+function trackTarget(target, session) {
+  if (ignoredTargetTypes.includes(target._targetInfo.type))
+    return;
+  const info = getBrowsingContextInfo(target);
+  session.contexts.addTopLevel(info.context, info.parent, info.url);
+
+  const pageID = target._targetId;
+  if (pageID in session.pages || session.pageRegistrations.has(pageID))
+    return;
+  const registration = target.page().then(page => {
+    if (page && session.contexts.has(pageID))
+      registerPage(pageID, page, session);
+  }).catch(e => {
+    debugBiDiServer("cannot get page", pageID, e);
+  }).then(() => {
+    session.pageRegistrations.delete(pageID);
   });
+  session.pageRegistrations.set(pageID, registration);
+}
+
+function registerPage(pageID, page, session) {
+  if (pageID in session.pages)
+    return;
+  // For now pages need to be stored in the map.
+  // Can be replaced with getting page object by ID on demand.
+  session.pages[pageID] = page;
+  // After the page exposed to the BiDi client,
+  // it's events has to be processed.
+  addPageEventHandlers(pageID, page, session);
+}
 
-  page.on('console', async msg => {
-    handle_pageConsole_event(msg, pageID, page, connection);
+function addPageEventHandlers(pageID, page, session) {
+  // Puppeteer enables the `Log` domain of every page, see `logDomainEnabled`
+  // in `updatePageEventHandlers`.
+  session.pageListeners[pageID] = { page, logDomainEnabled: true };
+  updatePageEventHandlers(pageID, session);
+
+  // Frames are the children of the page context. The main frame has the id
+  // of the page.
+  const { contexts } = session;
+  for (const frame of page.frames()) {
+    if (frame.parentFrame())
+      contexts.addChild(frame._id, frame.parentFrame()._id, frame.url());
+  }
+  page.on('frameattached', frame => {
+    contexts.addChild(frame._id, frame.parentFrame()._id, frame.url());
+  });
+  page.on('framedetached', frame => contexts.remove(frame._id));
+  page.on('framenavigated', frame => contexts.setUrl(frame._id, frame.url()));
+
+  // Remote objects don't outlive their execution context.
+  page._client.on('Runtime.executionContextDestroyed', event => {
+    session.handles.invalidateExecutionContext(pageID, event.executionContextId);
+    session.scripts.invalidateExecutionContext(pageID, event.executionContextId);
+  });
+  page._client.on('Runtime.executionContextsCleared', () => {
+    session.handles.invalidateContext(pageID);
+    session.scripts.invalidateContext(pageID);
+  });
+  page.on('close', () => {
+    stopScreencast(pageID, session);
+    session.handles.invalidateContext(pageID);
+    session.scripts.invalidateContext(pageID);
+    session.subscriptions.removeContext(pageID);
+    delete session.pageListeners[pageID];
   });
 }
 
-function addBrowserEventHandlers(browser, connection) {
+// Listens to the page events only while the client is subscribed to them, so
+// unsubscribed events cost nothing. Puppeteer doesn't even create console
+// messages without a `console` listener.
+function updatePageEventHandlers(pageID, session) {
+  const listeners = session.pageListeners[pageID];
+  const { page } = listeners;
+  const subscriptions = session.subscriptions;
+
   // Events specified in https://w3c.github.io/webdriver-bidi.
-  browser.on('targetcreated', (target) => {
-    handle_browserTargetcreated_event(target, connection);
-  });
+  const logEnabled = subscriptions.isSubscribed('log.entryAdded', pageID);
+  toggleListener(page, listeners, 'console', logEnabled,
+    () => msg => handle_pageConsole_event(msg, pageID, session));
+  // Browser-side log entries are not needed either. The domain state is
+  // tracked apart from the listener, as a new page starts with the domain
+  // enabled but no listener.
+  if (logEnabled !== listeners.logDomainEnabled) {
+    listeners.logDomainEnabled = logEnabled;
+    page._client.send(logEnabled ? 'Log.enable' : 'Log.disable').catch(e => {
+      debugBiDiServer("cannot toggle Log domain", e);
+    });
+  }
+
+  // Debug events not specified in https://w3c.github.io/webdriver-bidi.
+  toggleListener(page, listeners, 'load',
+    subscriptions.isSubscribed('DEBUG.Page.load', pageID),
+    () => () => handle_pageLoad_event(pageID, session.connection));
+}
 
-  browser.on('targetdestroyed', (target) => {
-    handle_browserTargetdestroyed_event(target, connection);
+// Answers the WebSocket upgrade with 503 and a `Retry-After` hint, in
+// seconds, from the expected launch time.
+function rejectSession(request, reason, message) {
+  metrics.countRejectedSession(reason);
+  const retryAfter = Math.min(60, Math.max(1,
+    Math.ceil(launchQueue.expectedWait() / 1000)));
+  try {
+    request.reject(503, message, { 'Retry-After': retryAfter });
+  } catch (e) {
+    debugBiDiServer('cannot reject session request', e);
+  }
+}
+
+// Acquires the browser of the session, failing with `OverloadedError` after
+// `admissionLimits.timeout` ms. A browser acquired too late is given back.
+async function admitSession(session) {
+  const acquired = acquireBrowser(session);
+  let timer;
+  const timedOut = new Promise((resolve, reject) => {
+    timer = setTimeout(
+      () => reject(new OverloadedError('timed out waiting for a browser')),
+      admissionLimits.timeout);
   });
+  try {
+    await Promise.race([acquired, timedOut]);
+  } catch (e) {
+    if (e instanceof OverloadedError)
+      acquired.then(() => releaseBrowser(session), () => {});
+    throw e;
+  } finally {
+    clearTimeout(timer);
+  }
+}
+
+// Sets the `browser` of the session and the `browserContext` holding its
+// targets, see `sessionIsolation`.
+async function acquireBrowser(session) {
+  if (sessionIsolation === 'context') {
+    session.lease = await sharedBrowsers.acquire();
+    session.browser = session.lease.browser;
+    session.browserContext = session.lease.browserContext;
+  } else {
+    session.browser = await browserPool.acquire();
+    // A throwaway incognito context, so cookies, storage, cache and
+    // permissions don't outlive the session in the reused browser. It starts
+    // with a blank page, like a freshly launched browser.
+    try {
+      session.browserContext = await session.browser.createIncognitoBrowserContext();
+      await session.browserContext.newPage();
+    } catch (e) {
+      browserPool.release(session.browser);
+      throw e;
+    }
+  }
+}
+
+// Tears down the targets of the session and gives the browser back.
+function releaseBrowser(session) {
+  session.browserContext.removeAllListeners();
+  if (session.onBrowserDisconnected)
+    session.browser.off('disconnected', session.onBrowserDisconnected);
+  if (session.lease) {
+    sharedBrowsers.release(session.lease);
+  } else {
+    // Reset the browser and give it back to the pool for the next session.
+    browserPool.release(session.browser);
+  }
+}
+
+// Target events come from the browser context of the session, so a session
+// never sees the targets of the other sessions sharing its browser.
+function addBrowserEventHandlers(session) {
+  updateBrowserEventHandlers(session);
+
+  // The context tree follows the targets regardless of subscriptions.
+  const { browserContext, contexts } = session;
+  browserContext.on('targetcreated', target => trackTarget(target, session));
+  browserContext.on('targetdestroyed', target => contexts.remove(target._targetId));
+  browserContext.on('targetchanged', target => contexts.setUrl(target._targetId, target.url()));
+  for (const target of browserContext.targets())
+    trackTarget(target, session);
 
   // Debug events not specified in https://w3c.github.io/webdriver-bidi
   // should be here.
-  browser.on('disconnected', () => {
-    handle_browserDisconnected_event(connection);
-  });
+  session.onBrowserDisconnected = () => {
+    handle_browserDisconnected_event(session.connection);
+  };
+  session.browser.on('disconnected', session.onBrowserDisconnected);
+}
+
+function updateBrowserEventHandlers(session) {
+  const { browserContext, browserListeners, subscriptions } = session;
+
+  // Events specified in https://w3c.github.io/webdriver-bidi.
+  toggleListener(browserContext, browserListeners, 'targetcreated',
+    subscriptions.hasSubscribers('browsingContext.contextCreated'),
+    () => target => handle_browserTargetcreated_event(target, session));
+
+  toggleListener(browserContext, browserListeners, 'targetdestroyed',
+    subscriptions.hasSubscribers('browsingContext.contextDestroyed'),
+    () => target => handle_browserTargetdestroyed_event(target, session));
+}
+
+function updateEventHandlers(session) {
+  updateBrowserEventHandlers(session);
+  for (const pageID of Object.keys(session.pageListeners))
+    updatePageEventHandlers(pageID, session);
+}
+
+// Adds or removes the `emitter` listener of `event`, created by
+// `createListener`. `listeners` keeps the added listeners by event. Returns
+// whether the listener was toggled.
+function toggleListener(emitter, listeners, event, enabled, createListener) {
+  if (enabled === !!listeners[event])
+    return false;
+
+  if (enabled) {
+    listeners[event] = createListener();
+    emitter.on(event, listeners[event]);
+  } else {
+    emitter.off(event, listeners[event]);
+    delete listeners[event];
+  }
+  return true;
 }
 
 // Command processors.
 async function process_PROTO_browsingContext_createContext(params, session, response) {
-  const page = await session.browser.newPage(params.url);
+  if (session.contexts.topLevelSize >= sessionLimits.maxContexts)
+    throw new OverloadedError('too many contexts');
+  const page = await session.browserContext.newPage(params.url);
 
   // Use CDP targetID for mapping.
   const pageID = page.target()._targetId;
-  if (!(pageID in session.pages)) {
-    session.pages[pageID] = page;
-    addPageEventHandlers(pageID, page, session.connection);
-  }
+  trackTarget(page.target(), session);
+  registerPage(pageID, page, session);
 
   response.result = getBrowsingContextInfo(page.target());
   return response;
@@ -523,10 +1250,6 @@ async function process_PROTO_browsingContext_createContext(params, session, resp
 async function process_PROTO_browsingContext_navigate(params, session, response) {
   const page = getPage(params, session);
 
-  if (!params.url) {
-    throw new Error('missing params.url');
-  }
-
   const options = {};
   if (params.waitUntil) {
     // Possible values are in PuppeteerLifeCycleEvent: `src/common/LifecycleWatcher.ts`.
@@ -552,6 +1275,7 @@ async function process_DEBUG_Page_close(params, session, response) {
   page.close();
   // Remove page from session map.
   delete session.pages[pageID];
+  session.handles.invalidateContext(pageID);
 
   response.result = {};
 
@@ -560,49 +1284,266 @@ async function process_DEBUG_Page_close(params, session, response) {
 
 async function process_DEBUG_Page_screenshot(params, session, response) {
   const page = getPage(params, session);
-  const screenshot = await page.screenshot({ encoding: 'base64' });
-  response.result = { screenshot };
+
+  const format = params.format || 'png';
+  const binary = params.encoding === 'binary';
+  const options = { type: format, encoding: binary ? 'binary' : 'base64' };
+  if (params.quality !== undefined && params.quality !== null) {
+    if (format !== 'jpeg')
+      throw new InvalidArgumentError('params.quality is only supported for jpeg');
+    options.quality = params.quality;
+  }
+  if (params.clip) {
+    if (params.fullPage)
+      throw new InvalidArgumentError('params.clip and params.fullPage are exclusive');
+    options.clip = getClip(params.clip);
+  }
+  if (params.fullPage)
+    options.fullPage = true;
+
+  const screenshot = await page.screenshot(options);
+  if (!binary) {
+    response.result = { screenshot };
+    return response;
+  }
+
+  // The image is sent in binary frames before the response, without the
+  // base64 overhead.
+  const chunks = await session.writer.sendChunks(response.id, screenshot,
+    params.chunkSize || screenshotChunkSize);
+  response.result = { format, size: screenshot.length, chunks };
   return response;
 }
 
+function getClip(clip) {
+  for (const name of ['x', 'y', 'width', 'height']) {
+    if (typeof clip[name] !== 'number')
+      throw new InvalidArgumentError(`params.clip.${name} should be number`);
+  }
+  if (clip.width <= 0 || clip.height <= 0)
+    throw new InvalidArgumentError('params.clip should not be empty');
+  return { x: clip.x, y: clip.y, width: clip.width, height: clip.height };
+}
+
+// Frames are sent as `PROTO.browsingContext.screencastFrame` events to the
+// client which started the screencast, without a subscription. Starting a
+// screencast again restarts it with the new options.
+async function process_PROTO_browsingContext_startScreencast(params, session, response) {
+  const page = getPage(params, session);
+  const pageID = params.context;
+  await stopScreencast(pageID, session);
+
+  const options = {};
+  for (const name of ['format', 'quality', 'maxWidth', 'maxHeight', 'maxFps']) {
+    if (params[name] !== undefined && params[name] !== null)
+      options[name] = params[name];
+  }
+  const screencast = new Screencast(page._client, session.writer,
+    (frame, frameNumber) => handle_pageScreencastFrame_event(frame, frameNumber, pageID, session),
+    options);
+  session.screencasts.set(pageID, screencast);
+  await screencast.start();
+
+  response.result = {};
+  return response;
+}
+
+async function process_PROTO_browsingContext_stopScreencast(params, session, response) {
+  getPage(params, session);
+  response.result = await stopScreencast(params.context, session) ||
+    { frames: 0, dropped: 0 };
+  return response;
+}
+
+// Returns the stats of the stopped screencast, if any.
+async function stopScreencast(pageID, session) {
+  const screencast = session.screencasts.get(pageID);
+  if (!screencast)
+    return undefined;
+  session.screencasts.delete(pageID);
+  return await screencast.stop();
+}
+
+// Default of `PROTO.browsingContext.waitForSelector` `timeout`, as puppeteer's.
+const defaultWaitTimeout = 30000;
+
+// Runs in the page. Waits until the elements matching `selectors` are in the
+// expected state: present, or `visible`, or `hidden` (which a missing element
+// is). Reports each selector's state: its element, `null` for a hidden
+// selector without element, or `undefined` while not satisfied. Resolves with
+// that array as soon as one selector (or `all`) is satisfied, or with
+// 'timeout' after `timeout` ms (0 means no timeout).
+//
+// DOM changes are observed with a `MutationObserver`, so there is no polling
+// interval. Visibility can also change without mutations, e.g. on layout, so
+// visibility waits also check on every animation frame.
+function waitForSelectorsInPage(selectors, all, visible, hidden, timeout) {
+  function isVisible(element) {
+    const style = window.getComputedStyle(element);
+    const rect = element.getBoundingClientRect();
+    return !!style && style.visibility !== 'hidden' &&
+      !!(rect.top || rect.bottom || rect.width || rect.height);
+  }
+
+  function check(selector) {
+    const element = document.querySelector(selector);
+    if (!visible && !hidden)
+      return element || undefined;
+    const elementVisible = !!element && isVisible(element);
+    if (visible)
+      return elementVisible ? element : undefined;
+    return elementVisible ? undefined : element;
+  }
+
+  function poll() {
+    const states = selectors.map(check);
+    const satisfied = all ?
+      states.every(state => state !== undefined) :
+      states.some(state => state !== undefined);
+    return satisfied ? states : undefined;
+  }
+
+  const states = poll();
+  if (states)
+    return states;
+
+  return new Promise(resolve => {
+    let timer;
+    let frame;
+    let finished = false;
+    const observer = new MutationObserver(onChange);
+
+    function onChange() {
+      const states = poll();
+      if (states)
+        finish(states);
+    }
+
+    function onFrame() {
+      onChange();
+      if (!finished)
+        frame = requestAnimationFrame(onFrame);
+    }
+
+    function finish(result) {
+      finished = true;
+      observer.disconnect();
+      clearTimeout(timer);
+      cancelAnimationFrame(frame);
+      resolve(result);
+    }
+
+    observer.observe(document, {
+      childList: true, subtree: true, attributes: true, characterData: true });
+    if (visible || hidden)
+      frame = requestAnimationFrame(onFrame);
+    if (timeout)
+      timer = setTimeout(() => finish('timeout'), timeout);
+  });
+}
+
+// Waits for the selectors in the main frame with a single round trip, starting
+// over in the new document if the page navigates meanwhile. Returns the state
+// handles of `waitForSelectorsInPage`, indexed like `selectors`.
+async function waitForSelectors(page, selectors, { all, visible, hidden, timeout }) {
+  const deadline = timeout ? Date.now() + timeout : 0;
+  let statesHandle;
+  for (;;) {
+    const remaining = deadline ? Math.max(1, deadline - Date.now()) : 0;
+    try {
+      statesHandle = await page.evaluateHandle(waitForSelectorsInPage,
+        selectors, all, visible, hidden, remaining);
+      break;
+    } catch (e) {
+      if (!isContextDestroyedError(e) || (deadline && Date.now() >= deadline))
+        throw e;
+    }
+  }
+
+  // As with puppeteer's `WaitTask`, the timeout runs from the start of the
+  // command, so a result arriving after it is a timeout too, e.g. with a
+  // timeout shorter than the round trip to the page.
+  const timedOut = statesHandle._remoteObject.type === 'string' ||
+    (deadline && Date.now() >= deadline);
+  if (timedOut) {
+    await statesHandle.dispose();
+    const description = selectors.length === 1 ?
+      `selector \`${selectors[0]}\`` :
+      `selectors ${selectors.map(s => `\`${s}\``).join(', ')}`;
+    throw new Error(`waiting for ${description} failed: timeout ${timeout}ms exceeded`);
+  }
+
+  const properties = await statesHandle.getProperties();
+  statesHandle.dispose();
+  return selectors.map((_, i) => properties.get(String(i)));
+}
+
+function isContextDestroyedError(error) {
+  return error.message.includes('Execution context was destroyed') ||
+    error.message.includes('Cannot find context with specified id');
+}
+
 async function process_PROTO_browsingContext_waitForSelector(params, session, response) {
   const page = getPage(params, session);
 
-  if (!params.selector)
-    throw new Error('missing params.selector');
+  const selectors = [].concat(params.selector);
+  if (!selectors.length)
+    throw new InvalidArgumentError('params.selector should not be empty');
+  for (const selector of selectors) {
+    if (typeof selector !== 'string' || !selector)
+      throw new InvalidArgumentError('params.selector should hold non-empty strings');
+  }
 
-  const options = {};
-  if ('visible' in params)
-    options.visible = params.visible;
-  if ('hidden' in params)
-    options.hidden = params.hidden;
-  if ('timeout' in params)
-    options.timeout = params.timeout;
+  const all = !!params.all;
+  const states = await waitForSelectors(page, selectors, {
+    all,
+    visible: !!params.visible,
+    hidden: !!params.hidden,
+    timeout: 'timeout' in params ? params.timeout : defaultWaitTimeout,
+  });
 
-  const element = await page.waitForSelector(params.selector, options);
+  // Keeps the element alive for the following commands.
+  const toElementValue = state => {
+    const element = state.asElement();
+    if (!element)
+      return undefined;
+    session.handles.add(params.context, element);
+    return getElementValue(element);
+  };
+  const isSatisfied = state => state._remoteObject.type !== 'undefined';
 
-  if (element) {
-    // Store element in the local cache.
-    session.elements[getElementID(element)] = element;
-    response.result = getElementValue(element);
-  } else {
-    response.result = {};
+  if (typeof params.selector === 'string') {
+    response.result = toElementValue(states[0]) || {};
+    return response;
   }
 
+  // The first satisfied selector, or all of them.
+  const first = states.findIndex(isSatisfied);
+  const matches = [];
+  states.forEach((state, index) => {
+    if (!all && index !== first) {
+      state.dispose();
+      return;
+    }
+    const match = { selector: selectors[index], index };
+    const element = toElementValue(state);
+    if (element)
+      match.element = element;
+    matches.push(match);
+  });
+  response.result = { matches };
+
   return response;
 }
 
 async function process_PROTO_browsingContext_selectElement(params, session, response) {
   const page = getPage(params, session);
 
-  if (!params.selector)
-    throw new Error('missing params.selector');
-
   const element = await page.$(params.selector);
 
   if (element) {
-    // Store element in the local cache.
-    session.elements[getElementID(element)] = element;
+    // Keep element alive for the following commands.
+    session.handles.add(params.context, element);
     response.result = getElementValue(element);
   } else {
     response.result = {};
@@ -626,32 +1567,145 @@ async function process_PROTO_browsingContext_click(params, session, response) {
 async function process_PROTO_browsingContext_type(params, session, response) {
   const page = getPage(params, session);
   // TODO: make element optionals.
-  // TODO: add type options.
   const element = getElement(params, session);
 
-  if (!params.text)
-    throw new Error('missing params.text');
-
   const options = params.options ? params.options : {};
 
-  await element.type(params.text, options);
+  await typeText(page, element, params.text, params.mode || 'keys', options);
 
   response.result = {};
 
   return response;
 }
 
+// Types into several fields in one command, `insertText` by default.
+async function process_PROTO_browsingContext_fill(params, session, response) {
+  const page = getPage(params, session);
+  const fields = params.fields.map(getFillField);
+  const mode = params.mode || 'insertText';
+
+  for (const [index, field] of fields.entries()) {
+    const element = field.objectId !== undefined ?
+      getElement(field, session, params.context, `params.fields[${index}].objectId`) :
+      await page.$(field.selector);
+    if (!element)
+      throw new Error(`no element matches selector \`${field.selector}\` of field ${index}`);
+
+    try {
+      if (params.clear) {
+        await element.evaluate(selectContents);
+        // Typing nothing would leave the selected value.
+        if (!field.text)
+          await page.keyboard.press('Delete');
+      }
+      await typeText(page, element, field.text, mode);
+    } finally {
+      // Elements selected here are not exposed to the client.
+      if (field.objectId === undefined)
+        await element.dispose();
+    }
+  }
+
+  response.result = {};
+  return response;
+}
+
+function getFillField(field, index) {
+  const name = `params.fields[${index}]`;
+  if (jsonType(field) !== 'object')
+    throw new InvalidArgumentError(`${name} should be object but got ${jsonType(field)}`);
+  if (typeof field.text !== 'string')
+    throw new InvalidArgumentError(`${name}.text should be string`);
+  if ((field.objectId === undefined) === (field.selector === undefined))
+    throw new InvalidArgumentError(`${name} should have either objectId or selector`);
+  if (field.objectId !== undefined && typeof field.objectId !== 'string')
+    throw new InvalidArgumentError(`${name}.objectId should be string`);
+  if (field.selector !== undefined && (typeof field.selector !== 'string' || !field.selector))
+    throw new InvalidArgumentError(`${name}.selector should be a non-empty string`);
+  return field;
+}
+
+// Runs in the page. Focuses the element and selects its value, so the typed
+// text replaces it.
+function selectContents(element) {
+  element.focus();
+  if (typeof element.select === 'function') {
+    element.select();
+    return;
+  }
+  const range = document.createRange();
+  range.selectNodeContents(element);
+  const selection = window.getSelection();
+  selection.removeAllRanges();
+  selection.addRange(range);
+}
+
+// Focuses the element and sends `text` as described in `typeModes`.
+async function typeText(page, element, text, mode, options = {}) {
+  if (mode === 'keys') {
+    await element.type(text, options);
+    return;
+  }
+  if (options.delay)
+    throw new InvalidArgumentError(`options.delay is not supported in mode ${mode}`);
+
+  await element.focus();
+  const keyboard = page.keyboard;
+  if (mode === 'insertText') {
+    if (text)
+      await keyboard.sendCharacter(text);
+    return;
+  }
+
+  // Like `keyboard.type`, but each call sends its CDP message before
+  // returning, so the events go out in order without waiting for the page.
+  const sent = [];
+  for (const char of text) {
+    if (keyboard.charIsKey(char))
+      sent.push(keyboard.down(char), keyboard.up(char));
+    else
+      sent.push(keyboard.sendCharacter(char));
+  }
+  await Promise.all(sent);
+}
+
+// Scripts are compiled once per execution context, see `ScriptCache`.
 async function process_PROTO_page_evaluate(params, session, response) {
   const page = getPage(params, session);
+  const args = getEvaluateArgs(params, session);
+  const executionContext = await page.mainFrame().executionContext();
+
+  // As in puppeteer, a string without arguments is an expression.
+  const result = args.length ?
+    await session.scripts.callFunction(params.context, executionContext, params.function, args) :
+    await session.scripts.evaluate(params.context, executionContext, params.function);
+  return await serializeEvaluateResult(result, params, session, response);
+}
 
-  if (!params.function)
-    throw new Error('missing params.function');
+async function process_PROTO_page_registerFunction(params, session, response) {
+  response.result = { functionId: session.scripts.registerFunction(params.function) };
+  return response;
+}
+
+async function process_PROTO_page_callFunction(params, session, response) {
+  const page = getPage(params, session);
+  const source = session.scripts.getFunction(params.functionId);
+  if (source === undefined)
+    throw new Error('function not found');
+  const args = getEvaluateArgs(params, session);
+  const executionContext = await page.mainFrame().executionContext();
+
+  const result = await session.scripts.callFunction(
+    params.context, executionContext, source, args);
+  return await serializeEvaluateResult(result, params, session, response);
+}
 
-  const args = [params.function];
+function getEvaluateArgs(params, session) {
+  const args = [];
   if (params.args) {
-    for (const arg of params.args) {
+    for (const [index, arg] of params.args.entries()) {
       if (arg.objectId) {
-        args.push(getElement(arg, session));
+        args.push(getElement(arg, session, params.context, `params.args[${index}].objectId`));
       } else {
         // TODO: implement proper scalar deserialisation according to
         // https://w3c.github.io/webdriver-bidi/#data-types-remote-value.
@@ -659,35 +1713,145 @@ async function process_PROTO_page_evaluate(params, session, response) {
       }
     }
   }
+  return args;
+}
 
-  const result = await page.evaluateHandle.apply(page, args);
-  response.result = await serializeForBiDi(result, page);
+async function serializeEvaluateResult(result, params, session, response) {
+  const maxDepth = Number.isInteger(params.maxDepth) ? params.maxDepth : 1;
+  response.result = await commandTrace.measureSerialization(() =>
+    serializeForBiDi(result, getRealm(params.context, session), maxDepth));
 
   return response;
 }
 
-async function process_browsingContext_getTree(params, session, response) {
-  // BiDi `context` corresponds to puppeteer `target`.
-  const targets = session.browser.targets()
-    .filter(t => !ignoredTargetTypes.includes(t._targetInfo.type));
-
-  for await (const t of targets) {
-    const pageID = t._targetId;
-    const page = await t.page();
-
-    if (!(pageID in session.pages)) {
-      // After the page exposed to the BiDi client,
-      // it's events has to be processed.
-      addPageEventHandlers(pageID, page, session.connection)
-
-      // For now pages need to be stored in the map.
-      // Can be replaced with getting page object by ID on demand.
-      session.pages[pageID] = page;
+async function process_PROTO_page_releaseObjects(params, session, response) {
+  const released = params.objectIds
+    .filter(objectId => session.handles.release(objectId))
+    .length;
+  response.result = { released };
+
+  return response;
+}
+
+async function process_DEBUG_Session_handles(params, session, response) {
+  response.result = session.handles.stats();
+  return response;
+}
+
+async function process_DEBUG_Session_scripts(params, session, response) {
+  response.result = session.scripts.stats();
+  return response;
+}
+
+async function process_PROTO_session_setEventBatching(params, session, response) {
+  session.writer.setBatching(params.window, params.maxSize);
+  response.result = {};
+  return response;
+}
+
+// Thrown when a step of `PROTO.session.batch` fails. The batch fails with the
+// error code of the step.
+class BatchStepError extends Error {
+  constructor(step, method, error) {
+    super(`step ${step} (${method}): ${error.message}`);
+    this.errorCode = getErrorCode(error);
+  }
+}
+
+// Runs the steps in order within one command and returns their results. Step
+// params may refer to the results of earlier steps with
+// `{"PROTO.ref": "<step>.<path>"}`, e.g. `{"PROTO.ref": "0.objectId"}`. The
+// first failing step fails the batch, and the following steps are not run.
+async function process_PROTO_session_batch(params, session, response) {
+  if (!params.commands.length)
+    throw new InvalidArgumentError('params.commands should not be empty');
+
+  const results = [];
+  for (const [step, stepData] of params.commands.entries()) {
+    const method = stepData && stepData.method;
+    try {
+      if (jsonType(stepData) !== 'object' || typeof method !== 'string')
+        throw new InvalidArgumentError('should be an object with a string method');
+      const paramsType = jsonType(stepData.params);
+      if (paramsType !== 'object' && paramsType !== 'undefined')
+        throw new InvalidArgumentError(`expected object params but got ${paramsType}`);
+      const command = commands.get(method);
+      if (!command || method === 'PROTO.session.batch')
+        throw new InvalidArgumentError(`unknown command ${method}`);
+      const stepParams = resolveReferences(
+        { context: params.context, ...stepData.params }, results);
+      // Steps run in the scheduler slot of the batch, so they can't hold up
+      // or overtake the commands of another context.
+      if (stepParams.context !== params.context)
+        throw new InvalidArgumentError('params.context should be the context of the batch');
+      if (stepParams.context === undefined)
+        delete stepParams.context;
+      command.validateParams(stepParams, response.id);
+      const stepResponse = await command.process(stepParams, session, { id: response.id });
+      results.push(stepResponse.result);
+    } catch (e) {
+      throw new BatchStepError(step, method, e);
     }
   }
+  response.result = { results };
+
+  return response;
+}
+
+// Replaces the `{"PROTO.ref": ...}` objects in `value` with the values they
+// refer to in `results`.
+function resolveReferences(value, results) {
+  if (Array.isArray(value))
+    return value.map(item => resolveReferences(item, results));
+  if (value === null || typeof value !== 'object')
+    return value;
+  if ('PROTO.ref' in value)
+    return lookupReference(value['PROTO.ref'], results);
+  const resolved = {};
+  for (const [key, item] of Object.entries(value))
+    resolved[key] = resolveReferences(item, results);
+  return resolved;
+}
+
+function lookupReference(reference, results) {
+  if (typeof reference !== 'string')
+    throw new InvalidArgumentError('PROTO.ref should be string');
+  const [step, ...path] = reference.split('.');
+  let value = results[Number(step)];
+  if (!/^\d+$/.test(step) || value === undefined)
+    throw new InvalidArgumentError(`PROTO.ref ${reference} should refer to an earlier step`);
+  for (const key of path) {
+    if (value === null || typeof value !== 'object' || !(key in value))
+      throw new InvalidArgumentError(`PROTO.ref ${reference} not found`);
+    value = value[key];
+  }
+  return value;
+}
+
+// Attaches the CDP cost of each following command to its response, see
+// `commandTrace.js`.
+async function process_PROTO_session_setTracing(params, session, response) {
+  session.tracing = params.enabled;
+  response.result = {};
+  return response;
+}
+
+async function process_DEBUG_Session_outbound(params, session, response) {
+  response.result = session.writer.stats();
+  return response;
+}
+
+async function process_browsingContext_getTree(params, session, response) {
+  const maxDepth = Number.isInteger(params.maxDepth) ? params.maxDepth : Infinity;
+  const contexts = session.contexts.getTree(params.root || undefined, maxDepth);
 
-  const contexts = targets
-    .map(t => getBrowsingContextInfo(t));
+  // Pages of new targets are exposed asynchronously. Wait for the returned
+  // ones, so the client can use them in the following commands.
+  const registrations = contexts
+    .map(context => session.pageRegistrations.get(context.context))
+    .filter(registration => registration);
+  if (registrations.length)
+    await Promise.all(registrations);
 
   response.result = { contexts };
 
@@ -709,8 +1873,21 @@ async function process_session_status(params, session, response) {
   return response;
 }
 
+async function process_session_subscribe(params, session, response) {
+  session.subscriptions.subscribe(params.events, params.contexts);
+  updateEventHandlers(session);
+  response.result = {};
+  return response;
+}
+
+async function process_session_unsubscribe(params, session, response) {
+  session.subscriptions.unsubscribe(params.events, params.contexts);
+  updateEventHandlers(session);
+  response.result = {};
+  return response;
+}
+
 // Events handlers.
-// TODO: add events filtering.
 
 function handle_pageLoad_event(pageID, connection) {
   sendClientMessage({
@@ -721,10 +1898,12 @@ function handle_pageLoad_event(pageID, connection) {
     }
   }, connection);
 }
-async function handle_pageConsole_event(msg, pageID, page, connection) {
+async function handle_pageConsole_event(msg, pageID, session) {
+  const connection = session.connection;
+  const realm = getRealm(pageID, session);
   const args = await Promise.all(
     msg.args()
-      .map(arg => serializeForBiDi(arg, page)));
+      .map(arg => serializeForBiDi(arg, realm)));
 
   // TODO: handle `console.log('%s %s', 'foo', 'bar')` case.
   const text = msg.args()
@@ -766,26 +1945,46 @@ async function handle_pageConsole_event(msg, pageID, page, connection) {
   }, connection);
 }
 
+function handle_pageScreencastFrame_event(frame, frameNumber, pageID, session) {
+  const screencast = session.screencasts.get(pageID);
+  sendClientMessage({
+    method: 'PROTO.browsingContext.screencastFrame',
+    params: {
+      context: pageID,
+      // Base64-encoded image.
+      data: frame.data,
+      metadata: frame.metadata,
+      frame: frameNumber,
+      // Stale frames dropped so far.
+      dropped: screencast ? screencast.stats().dropped : 0,
+    }
+  }, session.connection);
+}
+
 async function handle_browserDisconnected_event(connection) {
-  respondWithError(connection, {}, "unknown error", "browser closed");
+  respondWithError(connection, undefined, "unknown error", "browser closed");
   connection.close();
 }
 
-async function handle_browserTargetcreated_event(target, connection) {
-  if (!ignoredTargetTypes.includes(target._targetInfo.type)) {
-    sendClientMessage({
-      method: 'browsingContext.contextCreated',
-      params: getBrowsingContextInfo(target)
-    }, connection);
-  }
+async function handle_browserTargetcreated_event(target, session) {
+  if (ignoredTargetTypes.includes(target._targetInfo.type))
+    return;
+  if (!session.subscriptions.isSubscribed('browsingContext.contextCreated', target._targetId))
+    return;
+  sendClientMessage({
+    method: 'browsingContext.contextCreated',
+    params: getBrowsingContextInfo(target)
+  }, session.connection);
 }
-async function handle_browserTargetdestroyed_event(target, connection) {
-  if (!ignoredTargetTypes.includes(target._targetInfo.type)) {
-    sendClientMessage({
-      method: 'browsingContext.contextDestroyed',
-      params: getBrowsingContextInfo(target)
-    }, connection);
-  }
+async function handle_browserTargetdestroyed_event(target, session) {
+  if (ignoredTargetTypes.includes(target._targetInfo.type))
+    return;
+  if (!session.subscriptions.isSubscribed('browsingContext.contextDestroyed', target._targetId))
+    return;
+  sendClientMessage({
+    method: 'browsingContext.contextDestroyed',
+    params: getBrowsingContextInfo(target)
+  }, session.connection);
 }
 
 // Data contracts:
@@ -795,7 +1994,9 @@ function getBrowsingContextInfo(target) {
     context: target._targetId,
     parent: target.opener() ? target.opener().id() : null,
     url: target.url(),
-    // TODO: add `children` field.
+    // Frames attach after their target is reported, as in
+    // `browsingContext.getTree` of a context that was just created.
+    children: [],
 
     // Debug properties not specified in https://w3c.github.io/webdriver-bidi.
     // 'DEBUG.type': target._targetInfo.type.
@@ -0,0 +1,93 @@
+/**
+ * Copyright 2021 Google Inc. All rights reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+'use strict';
+
+const debug = require('debug');
+
+const debugSharedBrowsers = debug('Server:sharedBrowsers');
+
+// Shares browsers of a `BrowserPool` between sessions. Each session gets its
+// own incognito `BrowserContext`, isolated from the other sessions (storage,
+// cookies, targets), and closing it tears down all of its pages at once.
+//
+// A browser hosts at most `maxSessionsPerBrowser` sessions. New sessions fill
+// the browsers in use before another one is taken from the pool, and a browser
+// goes back to the pool once its last session left.
+class SharedBrowsers {
+  constructor(browserPool, { maxSessionsPerBrowser = 32 } = {}) {
+    this._browserPool = browserPool;
+    this._maxSessionsPerBrowser = maxSessionsPerBrowser;
+    // Browsers in use: { browser: promise, sessions }. `sessions` counts the
+    // sessions placed on the browser, including the ones still being set up.
+    this._entries = [];
+  }
+
+  // Returns a lease `{ browser, browserContext }` for a new session, to be
+  // given back with `release`.
+  async acquire() {
+    let entry = this._entries.find(
+      entry => entry.sessions < this._maxSessionsPerBrowser);
+    if (!entry) {
+      entry = { browser: this._browserPool.acquire(), sessions: 0 };
+      this._entries.push(entry);
+    }
+    entry.sessions++;
+
+    try {
+      const browser = await entry.browser;
+      if (!browser.isConnected())
+        throw new Error('browser disconnected');
+      const browserContext = await browser.createIncognitoBrowserContext();
+      return { browser, browserContext, _entry: entry };
+    } catch (e) {
+      this._leave(entry, true);
+      throw e;
+    }
+  }
+
+  async release({ browserContext, _entry: entry }) {
+    try {
+      await browserContext.close();
+    } catch (e) {
+      debugSharedBrowsers('cannot close browser context', e);
+    }
+    this._leave(entry, false);
+  }
+
+  stats() {
+    return {
+      browsers: this._entries.length,
+      sessions: this._entries.reduce((sum, entry) => sum + entry.sessions, 0),
+    };
+  }
+
+  // Removes a session from the browser, giving the browser back to the pool
+  // after its last session. A failed browser is not used for new sessions.
+  _leave(entry, failed) {
+    entry.sessions--;
+    const index = this._entries.indexOf(entry);
+    if (index !== -1 && (failed || !entry.sessions))
+      this._entries.splice(index, 1);
+    if (entry.sessions)
+      return;
+    entry.browser.then(browser => this._browserPool.release(browser), () => {
+      // The pool already forgot the browser it could not launch.
+    });
+  }
+}
+
+module.exports = { SharedBrowsers };
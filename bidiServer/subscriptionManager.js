@@ -0,0 +1,110 @@
+/**
+ * Copyright 2021 Google Inc. All rights reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+'use strict';
+
+const { InvalidArgumentError } = require('./commandDecoder.js');
+
+// Events the client can subscribe to, by module. Subscribing to a module
+// subscribes to all its events.
+const eventsByModule = {
+  // Events specified in https://w3c.github.io/webdriver-bidi.
+  browsingContext: [
+    'browsingContext.contextCreated',
+    'browsingContext.contextDestroyed',
+  ],
+  log: ['log.entryAdded'],
+
+  // Debug events not specified in https://w3c.github.io/webdriver-bidi.
+  'DEBUG.Page': ['DEBUG.Page.load'],
+};
+
+const knownEvents = new Set(Object.values(eventsByModule).flat());
+
+// Event subscriptions of a session, either global or for specific contexts.
+// https://w3c.github.io/webdriver-bidi/#session-subscribe
+class SubscriptionManager {
+  constructor() {
+    this._global = new Set();
+    // Event -> contexts subscribed to it.
+    this._contexts = new Map();
+  }
+
+  // Subscribes to `names` (events or modules) in `contexts`, or globally if
+  // `contexts` is empty.
+  subscribe(names, contexts = []) {
+    for (const event of expandEventNames(names)) {
+      if (!contexts.length) {
+        this._global.add(event);
+        continue;
+      }
+      if (!this._contexts.has(event))
+        this._contexts.set(event, new Set());
+      for (const context of contexts)
+        this._contexts.get(event).add(context);
+    }
+  }
+
+  unsubscribe(names, contexts = []) {
+    for (const event of expandEventNames(names)) {
+      if (!contexts.length) {
+        this._global.delete(event);
+        continue;
+      }
+      const subscribedContexts = this._contexts.get(event);
+      if (!subscribedContexts)
+        continue;
+      for (const context of contexts)
+        subscribedContexts.delete(context);
+      if (!subscribedContexts.size)
+        this._contexts.delete(event);
+    }
+  }
+
+  // Forgets subscriptions of the closed context.
+  removeContext(context) {
+    for (const event of [...this._contexts.keys()])
+      this.unsubscribe([event], [context]);
+  }
+
+  isSubscribed(event, context) {
+    if (this._global.has(event))
+      return true;
+    const subscribedContexts = this._contexts.get(event);
+    return !!subscribedContexts && subscribedContexts.has(context);
+  }
+
+  // Whether the event is subscribed to in any context.
+  hasSubscribers(event) {
+    return this._global.has(event) || this._contexts.has(event);
+  }
+}
+
+function expandEventNames(names) {
+  const events = new Set();
+  for (const name of names) {
+    if (name in eventsByModule) {
+      eventsByModule[name].forEach(event => events.add(event));
+    } else if (knownEvents.has(name)) {
+      events.add(name);
+    } else {
+      throw new InvalidArgumentError(`unknown event ${name}`);
+    }
+  }
+  return events;
+}
+
+module.exports = { SubscriptionManager };